@@ -14,18 +14,18 @@ To run:
 """
 import logging
 import io
+import time
 import argparse
 from datetime import datetime
 
 import yaml
-import picamera
 
-from dencam.gui import State
+from scrubcam.startup import PhaseTimer, run_in_background
 
-from scrubcam.vision import ObjectDetectionSystem
-from scrubcam.networking import ClientSocketHandler
-from scrubcam.display import Display
-from scrubcam.lora import LoRaSender
+# Everything else, and hardware modules in particular (camera, screen,
+# LoRa radio), is imported in main() and only if enabled so that the
+# camera comes up as quickly as possible after a reboot
+timer = PhaseTimer()
 
 logging.basicConfig(level='INFO',
                     format='[%(levelname)s] %(message)s (%(name)s)')
@@ -34,86 +34,282 @@ log = logging.getLogger('main')
 parser = argparse.ArgumentParser()
 parser.add_argument('config_filename')
 parser.add_argument('-c', '--continue', dest='cont', action='store_true')
+parser.add_argument('-t',
+                    '--timing',
+                    action='store_true',
+                    help='Log how long each phase of startup took')
 args = parser.parse_args()
 CONFIG_FILE = args.config_filename
 CONTINUE_RUN = args.cont
 
-with open(CONFIG_FILE, encoding="utf-8") as f:
-    configs = yaml.load(f, Loader=yaml.SafeLoader)
+with timer.phase('config'):
+    with open(CONFIG_FILE, encoding="utf-8") as f:
+        configs = yaml.load(f, Loader=yaml.SafeLoader)
 
 RECORD = configs['RECORD']
 RECORD_CONF_THRESHOLD = configs['RECORD_CONF_THRESHOLD']
-CAMERA_RESOLUTION = configs['CAMERA_RESOLUTION']
-CAMERA_ROTATION = configs['CAMERA_ROTATION']
 FILTER_CLASSES = configs['FILTER_CLASSES']
 
 HEADLESS = configs['HEADLESS']
 CONNECT_REMOTE_SERVER = configs['CONNECT_REMOTE_SERVER']
 LORA_ON = configs['LORA_ON']
+MOTION_GATE_ON = configs.get('MOTION_GATE_ON', False)
+TRACKING_ON = configs.get('TRACKING_ON', False)
+CASCADE_ON = configs.get('CASCADE_ON', False)
+
+# seconds between logging pipeline throughput and queue state
+REPORT_INTERVAL = 60
 
 
 def main():
     """Main routine of Scrubcam
 
+    Capture, inference and each of the side effects (display, record,
+    network, LoRa) run as separate stages of a pipeline.
+
+    The model is loaded in the background while the camera starts up
+    and warms up.
+
     """
+    # pylint: disable=import-outside-toplevel
+    with timer.phase('imports'):
+        from scrubcam import vision
+        from scrubcam.capture import (create_capture_source, encode_jpeg,
+                                      ReplaySource)
+        from scrubcam.pipeline import Pipeline, BLOCK
+        from scrubcam.detections import Detections
+        from scrubcam import metrics
+        from scrubcam.sightings import SightingsLog
+
+    def load_models():
+        with timer.phase('model load'):
+            detector = vision.ObjectDetectionSystem(configs)
+            if CASCADE_ON:
+                classifier = vision.ImageClassificationSystem(configs)
+                return detector, vision.ClassifierCascade(configs, classifier)
+            return detector, None
+
+    loading_models = run_in_background(load_models)
+
+    with timer.phase('camera start'):
+        source = create_capture_source(configs)
+
     if LORA_ON:
-        lora_sender = LoRaSender()
+        with timer.phase('lora start'):
+            from scrubcam.lora import LoRaSender
+            lora_sender = LoRaSender()
     else:
         log.info('LoRa is ***DISABLED***\n\n')
 
-    detector = ObjectDetectionSystem(configs)
-    stream = io.BytesIO()
-
-    camera = picamera.PiCamera()
-    camera.rotation = CAMERA_ROTATION
-    camera.resolution = CAMERA_RESOLUTION
-
     if CONNECT_REMOTE_SERVER:
         log.info('Connecting to server enabled')
-        socket_handler = ClientSocketHandler(configs)
-        socket_handler.send_host_configs(FILTER_CLASSES, CONTINUE_RUN)
+        with timer.phase('server connect'):
+            from scrubcam.networking import (BackgroundSender,
+                                             ClientSocketHandler)
+            # connected in the background so a hub that is down
+            # doesn't stop the camera starting
+            socket_handler = BackgroundSender(
+                ClientSocketHandler(configs, connect=False),
+                configs)
+            socket_handler.start()
+            socket_handler.send_host_configs(FILTER_CLASSES, CONTINUE_RUN)
     else:
         log.info('Connecting to ScrubDash server is ***DISABLED***\n\n')
 
-    if not HEADLESS:
-        state = State(4)
-        display = Display(configs, camera, state)
+    show_display = not HEADLESS and source.camera is not None
+    if show_display:
+        with timer.phase('display start'):
+            from dencam.gui import State
+            from scrubcam.display import Display
+            state = State(4)
+            display = Display(configs, source.camera, state)
+    elif not HEADLESS:
+        log.warning('Display needs the camera, running headless.')
+
+    if MOTION_GATE_ON:
+        log.info('Motion gating of detector enabled')
+        from scrubcam.motion import MotionGate
+        motion_gate = MotionGate(configs)
+        metrics.REGISTRY.counter('scrubcam_motion_checked_total',
+                                 'Frames checked for motion',
+                                 function=lambda: motion_gate.frames_checked)
+        metrics.REGISTRY.counter('scrubcam_motion_skipped_total',
+                                 'Frames not run through the detector for '
+                                 'lack of motion',
+                                 function=lambda: motion_gate.frames_skipped)
+    else:
+        motion_gate = None
+
+    if TRACKING_ON:
+        log.info('Tracking enabled, recording/sending only on track events')
+        from scrubcam.tracking import IoUTracker
+        tracker = IoUTracker(configs)
+    else:
+        tracker = None
+
+    with timer.phase('model wait'):
+        detector, cascade = loading_models.result()
+    if cascade is not None:
+        log.info('Classifier cascade enabled')
+    sightings = SightingsLog(configs)
+    first_frame = [True]
+
+    def infer(packet):
+        if first_frame[0]:
+            first_frame[0] = False
+            timer.mark('first frame')
+            if args.timing:
+                log.info('Startup timing:\n%s', '\n'.join(timer.report()))
+
+        if motion_gate is not None:
+            if packet['frame'] is None:
+                moving = motion_gate.check_jpeg(packet['jpeg'])
+            else:
+                moving = motion_gate.check(packet['frame'])
+            if not moving:
+                packet['lboxes'] = Detections(class_table=detector.class_table)
+                return packet
+
+        detector.infer_on_packet(packet)
+        detector.print_report()
 
+        lboxes = detector.labeled_boxes
+        packet['lboxes'] = lboxes
+        if motion_gate is not None:
+            motion_gate.notify_result(len(lboxes))
+        packet['seen'] = (RECORD
+                          and len(lboxes) > 0
+                          and lboxes.scores[0] > RECORD_CONF_THRESHOLD)
+        packet['wanted'] = (packet['seen']
+                            and len(lboxes.filter_classes(FILTER_CLASSES)) > 0)
+
+        if tracker is not None:
+            # only act on tracks that are new, improved or due again
+            # rather than on every frame an animal is in view
+            actionable = [track for track in tracker.update(lboxes)
+                          if detector.class_table[track.class_id]
+                          in FILTER_CLASSES]
+            packet['wanted'] = packet['wanted'] and len(actionable) > 0
+            if packet['wanted']:
+                # tracks only count as acted on once their frame is
+                # recorded/sent, not when seen below the threshold
+                for track in actionable:
+                    tracker.mark_acted(track)
+
+        if cascade is not None and len(lboxes) > 0:
+            track_ids = tracker.track_ids if tracker is not None else None
+            cascade.classify(lboxes, packet['frame'], track_ids)
+            cascade.print_report()
+            packet['species'] = cascade.labels()
+
+        if (CONNECT_REMOTE_SERVER and packet['wanted']
+                and packet['jpeg'] is None):
+            # encoded once here, before the packet is shared by the
+            # record and network stages, rather than by either of them
+            packet['jpeg'] = encode_jpeg(packet['frame'])
+        return packet
+
+    def update_display(packet):
+        display.update(packet['lboxes'])
+
+    def record(packet):
+        lboxes = packet['lboxes']
+        filename = None
+        if packet['wanted']:
+            label = None
+            if packet['species'] and packet['species'][0] is not None:
+                # top box was classified so record it by its species
+                label = vision.label_for_filename(packet['species'][0][0])
+            filename = detector.save_current_frame(label,
+                                                   lboxes=lboxes,
+                                                   frame=packet['frame'],
+                                                   jpeg=packet['jpeg'])
+
+        sightings.log(lboxes,
+                      image=filename,
+                      timestamp=datetime.fromtimestamp(packet['timestamp']))
+
+    def send(packet):
+        socket_handler.send_heartbeat_every_15s()
+        if packet['wanted']:
+            socket_handler.send_image_and_boxes(io.BytesIO(packet['jpeg']),
+                                                packet['lboxes'],
+                                                packet['timestamp'])
+            log.debug('Image sent')
+
+    def send_lora(packet):
+        to_send = f"Top-1: {packet['lboxes'].class_name(0)}"
+        lora_sender.send(to_send)
+
+    pipeline = Pipeline(configs)
+    capture_stage = pipeline.add_source('capture', source.frames())
+    inference_policy = None
+    if isinstance(source, ReplaySource) and not source.realtime:
+        # a replay reads frames faster than they can be inferred, so
+        # wait for inference rather than dropping most of the frames
+        inference_policy = BLOCK
+    inference_stage = pipeline.add_stage('inference', infer,
+                                         policy=inference_policy)
+    pipeline.connect(capture_stage, inference_stage)
+
+    if show_display:
+        display_stage = pipeline.add_stage('display', update_display)
+        pipeline.connect(inference_stage, display_stage)
+
+    record_stage = pipeline.add_stage('record', record)
+    pipeline.connect(inference_stage,
+                     record_stage,
+                     when=lambda packet: packet['seen'])
+
+    if CONNECT_REMOTE_SERVER:
+        network_stage = pipeline.add_stage('network', send)
+        pipeline.connect(inference_stage,
+                         network_stage,
+                         when=lambda packet: (packet['wanted'] or
+                                              socket_handler.heartbeat_due()))
+
+    if LORA_ON:
+        lora_stage = pipeline.add_stage('lora', send_lora)
+        pipeline.connect(inference_stage,
+                         lora_stage,
+                         when=lambda packet: packet['wanted'])
+
+    exporters = metrics.start_exporters(configs, pipeline.stop_flag)
+    pipeline.start()
+    start = last_report = time.time()
     try:
-        for _ in camera.capture_continuous(stream, format='jpeg'):
-            if CONNECT_REMOTE_SERVER:
-                socket_handler.send_heartbeat_every_15s()
-            detector.infer(stream)
-            detector.print_report()
-
-            lboxes = detector.labeled_boxes
-            if not HEADLESS:
-                display.update(lboxes)
-
-            if len(lboxes) > 0:
-                if RECORD and lboxes[0]['confidence'] > RECORD_CONF_THRESHOLD:
-                    detected_classes = [lbox['class_name'] for lbox in lboxes]
-                    if any(itm in FILTER_CLASSES for itm in detected_classes):
-                        if CONNECT_REMOTE_SERVER:
-                            socket_handler.send_image_and_boxes(stream, lboxes)
-                            log.debug('Image sent')
-                        detector.save_current_frame(None, lboxes=lboxes)
-                        if LORA_ON:
-                            to_send = f"Top-1: {lboxes[0]['class_name']}"
-                            lora_sender.send(to_send)
-
-                    with open('what_was_seen.log', 'a+', encoding="utf-8") as seen_file:
-                        time_format = '%Y-%m-%d %H:%M:%S'
-                        tstamp = str(datetime.now().strftime(time_format))
-                        top_class = lboxes[0]['class_name']
-                        seen_file.write(f'{tstamp} | {top_class}\n')
-
-            stream.seek(0)
-            stream.truncate()
+        while pipeline.is_alive():
+            time.sleep(1)
+            if time.time() - last_report >= REPORT_INTERVAL:
+                last_report = time.time()
+                pipeline.report()
+                if motion_gate is not None:
+                    log.info('Motion gate skip ratio: %.2f',
+                             motion_gate.skip_ratio)
+        if capture_stage.is_alive():
+            log.error('A pipeline stage stopped running.')
+        else:
+            log.info('Capture source finished.')
+            pipeline.drain()
     except KeyboardInterrupt:
         log.warning('KeyboardInterrupt')
-        if CONNECT_REMOTE_SERVER:
-            socket_handler.close()
+    pipeline.stop()
+    source.close()
+    pipeline.report()
+    elapsed = time.time() - start
+    log.info('%d frames inferred (%d dropped) in %.1f s (%.2f fps)',
+             inference_stage.processed,
+             inference_stage.inbox.dropped,
+             elapsed,
+             inference_stage.processed / elapsed)
+    detector.close()
+    sightings.close()
+    if detector.recorded_image_count:
+        log.info('Record writer: %s', detector.writer.stats())
+    for exporter in exporters:
+        exporter.close()
+    if CONNECT_REMOTE_SERVER:
+        socket_handler.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,566 @@
+"""Inference backends for the vision systems
+
+The inference systems in scrubcam.vision don't talk to a particular
+piece of ML hardware directly but get their networks from a backend
+chosen in the configuration:
+
+- coral: Google Coral Edge TPU via camml/pycoral (the usual field setup)
+- cpu: TFLite interpreter on the CPU using the non-Edge-TPU versions
+  of the models
+- mock: deterministic scripted results with configurable latency, for
+  running and benchmarking the pipeline without any ML hardware
+
+A FALLBACK_BACKEND can be configured that takes over if the main one
+can't be started or fails mid-run (e.g. the Coral dropping off USB).
+
+Every backend hands out handlers with the same interface as camml's:
+detectors have infer(frame) and filter_boxes(...), classifiers have
+infer(frame) and input_size. Handlers that also have infer_input(tensor)
+and input_size can take input already resized and converted to RGB by
+the inference system's Preprocessor (see scrubcam.preprocess) instead
+of doing that themselves on every frame; boxes they find are then in
+input coordinates.
+
+"""
+import logging
+import os
+import time
+
+import numpy as np
+import cv2
+
+log = logging.getLogger(__name__)
+
+BACKENDS = {}
+
+# lowest score of the objects taken from the Edge TPU's output, as in
+# camml (boxes are then filtered by CONF_THRESHOLD)
+CORAL_SCORE_FLOOR = 0.05
+
+
+def register_backend(name):
+    """Class decorator that makes a backend available by name
+
+    """
+    def decorator(cls):
+        cls.name = name
+        BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+def get_backend(name, configs):
+    """Return instance of the backend registered under name
+
+    """
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown inference backend: {name} '
+                         f'(available: {", ".join(BACKENDS)})')
+    return BACKENDS[name](configs)
+
+
+def create_detector(configs, model, weights, input_width, input_height):
+    """Return object detector handler from configured backend(s)
+
+    """
+    return _create(configs,
+                   lambda backend: backend.detector(model,
+                                                    weights,
+                                                    input_width,
+                                                    input_height))
+
+
+def create_classifier(configs, model):
+    """Return image classifier handler from configured backend(s)
+
+    """
+    return _create(configs, lambda backend: backend.classifier(model))
+
+
+def _create(configs, make_handler):
+    primary = configs.get('INFERENCE_BACKEND', 'coral')
+    fallback = configs.get('FALLBACK_BACKEND')
+    log.info('Using %s inference backend', primary)
+
+    def make_primary():
+        return make_handler(get_backend(primary, configs))
+
+    if fallback is None:
+        return make_primary()
+
+    def make_fallback():
+        log.warning('Falling back to %s inference backend', fallback)
+        return make_handler(get_backend(fallback, configs))
+
+    return FallbackHandler(make_primary, make_fallback)
+
+
+class FallbackHandler():
+    """Handler that swaps to a fallback backend if the primary fails
+
+    Covers both failing to start (e.g. no Edge TPU found) and failing
+    during inference (e.g. Edge TPU disconnected).
+
+    """
+
+    def __init__(self, make_primary, make_fallback):
+        self._make_fallback = make_fallback
+        self.fallen_back = False
+        try:
+            self.handler = make_primary()
+        except Exception:
+            log.exception('Could not start primary inference backend.')
+            self._fall_back()
+
+    def _fall_back(self):
+        self.handler = self._make_fallback()
+        self.fallen_back = True
+
+    def infer(self, frame):
+        """Run inference on primary handler or, failing that, fallback
+
+        """
+        return self._call('infer', frame)
+
+    def infer_input(self, tensor):
+        """Run inference on preprocessed input, falling back as above
+
+        """
+        return self._call('infer_input', tensor)
+
+    def _call(self, method, data):
+        if self.fallen_back:
+            return getattr(self.handler, method)(data)
+        try:
+            return getattr(self.handler, method)(data)
+        except Exception:
+            log.exception('Primary inference backend failed.')
+            self._fall_back()
+            return getattr(self.handler, method)(data)
+
+    def __getattr__(self, name):
+        if name == 'handler':
+            raise AttributeError(name)
+        return getattr(self.handler, name)
+
+
+class Backend():
+    """Base class for inference backends
+
+    Note: is an abstract base class
+
+    """
+    name = None
+
+    def __init__(self, configs):
+        self.configs = configs
+
+    def detector(self, model, weights, input_width, input_height):
+        """Return object detector handler for model
+
+        """
+        raise NotImplementedError
+
+    def classifier(self, model):
+        """Return image classifier handler for model
+
+        """
+        raise NotImplementedError
+
+
+@register_backend('coral')
+class CoralBackend(Backend):
+    """Google Coral Edge TPU via camml
+
+    """
+
+    def detector(self, model, weights, input_width, input_height):
+        from camml import coral
+        return CoralDetectorHandler(coral.ObjectDetectorHandler(model,
+                                                                weights,
+                                                                input_width,
+                                                                input_height),
+                                    (input_width, input_height))
+
+    def classifier(self, model):
+        from camml import coral
+        return CoralClassifierHandler(coral.ImageClassifierHandler(model))
+
+
+@register_backend('cpu')
+class CpuBackend(Backend):
+    """TFLite interpreter running on the CPU
+
+    Edge TPU compiled models won't run on the CPU so the plain TFLite
+    version of the model is used: either as given by
+    CPU_OBJ_MODEL_CONFIG_FILE / CPU_MODEL_CONFIG_FILE or, by default,
+    the configured model's filename without '_edgetpu'.
+
+    """
+
+    def __init__(self, configs):
+        super().__init__(configs)
+        self.num_threads = configs.get('CPU_NUM_THREADS', 4)
+
+    def _cpu_model(self, model, key):
+        if self.configs.get(key):
+            return os.path.join(os.path.dirname(model), self.configs[key])
+        return model.replace('_edgetpu', '')
+
+    def detector(self, model, weights, input_width, input_height):
+        model = self._cpu_model(model, 'CPU_OBJ_MODEL_CONFIG_FILE')
+        return TFLiteDetectorHandler(model, self.num_threads)
+
+    def classifier(self, model):
+        model = self._cpu_model(model, 'CPU_MODEL_CONFIG_FILE')
+        return TFLiteClassifierHandler(model, self.num_threads)
+
+
+@register_backend('mock')
+class MockBackend(Backend):
+    """Deterministic scripted results with configurable latency
+
+    MOCK_DETECTIONS is a list of frames, each a list of
+    [class_id, score, left, top, width, height] boxes with coordinates
+    as fractions of frame (or, for preprocessed input, input) size.
+    MOCK_CLASSIFICATIONS is a list of frames, each a list of
+    [class_id, score]. Both are cycled through
+    one per inference. Every inference takes MOCK_LATENCY_MS.
+
+    """
+
+    def __init__(self, configs):
+        super().__init__(configs)
+        self.latency = configs.get('MOCK_LATENCY_MS', 20) / 1000
+
+    def detector(self, model, weights, input_width, input_height):
+        return MockDetectorHandler(self.configs.get('MOCK_DETECTIONS'),
+                                   self.latency,
+                                   (input_width, input_height))
+
+    def classifier(self, model):
+        input_size = self.configs.get('MOCK_CLASSIFIER_INPUT_SIZE',
+                                      (224, 224))
+        return MockClassifierHandler(self.configs.get('MOCK_CLASSIFICATIONS'),
+                                     self.latency,
+                                     tuple(input_size))
+
+
+class _CoralHandler():
+    """Wraps a camml handler to also take preprocessed input
+
+    camml resizes every frame with PIL; infer_input hands an input
+    that is already the right size straight to the Edge TPU through
+    the pycoral interpreter of the camml handler (its interpreter
+    attribute, and top_k and threshold for classifiers, as of camml
+    0.0.4). A camml handler without those gets the input converted
+    back to BGR and goes through its own infer(frame) instead.
+
+    """
+
+    def __init__(self, handler, input_size=None):
+        from pycoral.adapters import common
+        self.handler = handler
+        self.interpreter = getattr(handler, 'interpreter', None)
+        if self.interpreter is not None:
+            input_size = common.input_size(self.interpreter)
+        elif input_size is None:
+            input_size = handler.input_size
+        else:
+            log.warning('camml handler has no interpreter, preprocessed '
+                        'input goes through its infer()')
+        self.input_size = tuple(input_size)
+
+    def _invoke(self, tensor):
+        from pycoral.adapters import common
+        common.set_input(self.interpreter, tensor)
+
+        start = time.perf_counter()
+        self.interpreter.invoke()
+        return (time.perf_counter() - start) * 1000
+
+    def infer(self, frame):
+        """Perform inference on frame via camml
+
+        """
+        return self.handler.infer(frame)
+
+    def _infer_converted(self, tensor):
+        """Run preprocessed (RGB) input through camml's infer(frame)
+
+        """
+        return self.handler.infer(cv2.cvtColor(tensor, cv2.COLOR_RGB2BGR))
+
+    def __getattr__(self, name):
+        if name == 'handler':
+            raise AttributeError(name)
+        return getattr(self.handler, name)
+
+
+class CoralDetectorHandler(_CoralHandler):
+    """camml object detector that can take preprocessed input
+
+    """
+
+    def infer_input(self, tensor):
+        """Perform object detection on preprocessed input
+
+        Returns detected objects (boxes in input coordinates) and
+        inference time in milliseconds.
+
+        """
+        if self.interpreter is None:
+            return self._infer_converted(tensor)
+        from pycoral.adapters import detect
+        inference_time = self._invoke(tensor)
+        # input is already model sized so boxes need no scaling
+        objs = detect.get_objects(self.interpreter,
+                                  CORAL_SCORE_FLOOR,
+                                  (1.0, 1.0))
+
+        return objs, inference_time
+
+
+class CoralClassifierHandler(_CoralHandler):
+    """camml image classifier that can take preprocessed input
+
+    """
+
+    def infer_input(self, tensor):
+        """Perform image classification on preprocessed input
+
+        Returns classes identified and inference time in milliseconds.
+
+        """
+        if (self.interpreter is None
+                or not hasattr(self.handler, 'top_k')
+                or not hasattr(self.handler, 'threshold')):
+            return self._infer_converted(tensor)
+        from pycoral.adapters import classify
+        inference_time = self._invoke(tensor)
+        classes = classify.get_classes(self.interpreter,
+                                       self.handler.top_k,
+                                       self.handler.threshold)
+
+        return classes, inference_time
+
+
+def _make_tflite_interpreter(model, num_threads):
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    interpreter = Interpreter(model_path=model, num_threads=num_threads)
+    interpreter.allocate_tensors()
+    return interpreter
+
+
+class _TFLiteHandler():
+    """Functionality shared by the TFLite handlers
+
+    """
+
+    def __init__(self, model, num_threads):
+        self.interpreter = _make_tflite_interpreter(model, num_threads)
+        details = self.interpreter.get_input_details()[0]
+        self._input_index = details['index']
+        self._input_dtype = details['dtype']
+        _, height, width, _ = details['shape']
+        self.input_size = (int(width), int(height))
+        self._input = np.empty((1, int(height), int(width), 3),
+                               dtype=self._input_dtype)
+
+    def _invoke(self, frame):
+        """Resize frame into the input tensor and run the interpreter
+
+        Returns inference time in milliseconds.
+
+        """
+        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        return self._invoke_input(cv2.resize(rgb, self.input_size))
+
+    def _invoke_input(self, tensor):
+        """Run the interpreter on RGB input of input size
+
+        Returns inference time in milliseconds.
+
+        """
+        if self._input_dtype == np.float32:
+            np.subtract(tensor, 127.5, out=self._input[0])
+            self._input /= 127.5
+        else:
+            self._input[0] = tensor
+        self.interpreter.set_tensor(self._input_index, self._input)
+
+        start = time.perf_counter()
+        self.interpreter.invoke()
+        return (time.perf_counter() - start) * 1000
+
+    def _output(self, i):
+        details = self.interpreter.get_output_details()[i]
+        output = self.interpreter.get_tensor(details['index'])
+        scale, zero_point = details['quantization']
+        if scale:
+            output = scale * (output.astype(np.float32) - zero_point)
+        return np.squeeze(output)
+
+
+class TFLiteDetectorHandler(_TFLiteHandler):
+    """Object detection with an SSD-postprocess TFLite model on CPU
+
+    """
+
+    def infer(self, frame):
+        """Perform object detection on image
+
+        Returns outputs (boxes, class IDs, scores, count) and inference
+        time in milliseconds.
+
+        """
+        return self._results(self._invoke(frame))
+
+    def infer_input(self, tensor):
+        """Perform object detection on preprocessed input
+
+        """
+        return self._results(self._invoke_input(tensor))
+
+    def _results(self, inference_time):
+        boxes, class_ids, scores, count = (self._output(i) for i in range(4))
+        count = int(count)
+        results = (boxes[:count], class_ids[:count], scores[:count])
+
+        return results, inference_time
+
+    def filter_boxes(self,
+                     results,
+                     frame,
+                     confidence_threshold,
+                     nms_threshold):
+        """Return lboxes scoring above confidence_threshold
+
+        The model's postprocess op has already done NMS.
+
+        """
+        boxes, class_ids, scores = results
+        frame_height, frame_width = frame.shape[:2]
+
+        lboxes = []
+        for box, class_id, score in zip(boxes, class_ids, scores):
+            if score > confidence_threshold:
+                ymin, xmin, ymax, xmax = box
+                left = int(xmin * frame_width)
+                top = int(ymin * frame_height)
+                lboxes.append({'class_id': int(class_id),
+                               'confidence': float(score),
+                               'box': [left,
+                                       top,
+                                       int(xmax * frame_width) - left,
+                                       int(ymax * frame_height) - top]})
+
+        return lboxes
+
+
+class TFLiteClassifierHandler(_TFLiteHandler):
+    """Image classification with a TFLite model on CPU
+
+    """
+
+    def __init__(self, model, num_threads, top_k=5):
+        super().__init__(model, num_threads)
+        self.top_k = top_k
+
+    def infer(self, frame):
+        """Perform image classification on frame
+
+        Returns list of (class_id, score) best first and inference
+        time in milliseconds.
+
+        """
+        return self._results(self._invoke(frame))
+
+    def infer_input(self, tensor):
+        """Perform image classification on preprocessed input
+
+        """
+        return self._results(self._invoke_input(tensor))
+
+    def _results(self, inference_time):
+        scores = self._output(0)
+        top = np.argsort(-scores)[:self.top_k]
+
+        return [(int(i), float(scores[i])) for i in top], inference_time
+
+
+class MockDetectorHandler():
+    """Object detector that plays back scripted boxes
+
+    """
+
+    def __init__(self, script, latency, input_size):
+        self.script = script or [[]]
+        self.latency = latency
+        self.input_size = input_size
+        self._count = 0
+
+    def infer(self, frame):
+        """Return next frame of scripted boxes after simulated latency
+
+        """
+        time.sleep(self.latency)
+        results = self.script[self._count % len(self.script)]
+        self._count += 1
+
+        return results, 1000 * self.latency
+
+    infer_input = infer
+
+    def filter_boxes(self,
+                     results,
+                     frame,
+                     confidence_threshold,
+                     nms_threshold):
+        """Return lboxes scoring above confidence_threshold
+
+        """
+        frame_height, frame_width = frame.shape[:2]
+
+        lboxes = []
+        for class_id, score, left, top, width, height in results:
+            if score > confidence_threshold:
+                lboxes.append({'class_id': int(class_id),
+                               'confidence': float(score),
+                               'box': [int(left * frame_width),
+                                       int(top * frame_height),
+                                       int(width * frame_width),
+                                       int(height * frame_height)]})
+
+        return lboxes
+
+
+class MockClassifierHandler():
+    """Image classifier that plays back scripted results
+
+    """
+
+    def __init__(self, script, latency, input_size):
+        self.script = script or [[]]
+        self.latency = latency
+        self.input_size = input_size
+        self._count = 0
+
+    def infer(self, frame):
+        """Return next scripted classification after simulated latency
+
+        """
+        time.sleep(self.latency)
+        results = self.script[self._count % len(self.script)]
+        self._count += 1
+        results = sorted(((int(class_id), float(score))
+                          for class_id, score in results),
+                         key=lambda result: -result[1])
+
+        return results, 1000 * self.latency
+
+    infer_input = infer
@@ -0,0 +1,266 @@
+"""Tools for getting frames off of the ScrubCam camera (or elsewhere)
+
+By default frames come off the picamera as JPEG which then get
+decoded again before inference.  Capturing in one of the raw formats
+into a preallocated buffer skips that encode/decode round trip.
+
+Frames reach the rest of the system through a capture source, which
+generates frame packets (see scrubcam.pipeline). Besides the picamera
+there is a replay source that plays back a folder of JPEGs (e.g. a
+RECORD_FOLDER) or a video file, either at the original frame rate or
+as fast as possible, for measuring throughput and reproducing field
+incidents away from the camera.
+
+"""
+import io
+import logging
+import os
+import re
+import time
+from datetime import datetime
+
+import numpy as np
+import cv2
+
+from scrubcam.pipeline import create_frame_packet
+
+log = logging.getLogger(__name__)
+
+RAW_FORMATS = ('bgr', 'rgb', 'yuv')
+JPEG_EXTENSIONS = ('.jpeg', '.jpg')
+# how recorded images are timestamped in their filenames
+TIMESTAMP_FORMAT = '%Y-%m-%dT%Hh%Mm%Ss.%f'
+TIMESTAMP_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}h\d{2}m\d{2}s\.\d+')
+
+
+def padded_resolution(resolution):
+    """Return resolution rounded up the way picamera pads raw captures
+
+    Unencoded captures have their width rounded up to a multiple of
+    32 and their height to a multiple of 16.
+
+    """
+    width, height = resolution
+    return ((width + 31) // 32) * 32, ((height + 15) // 16) * 16
+
+
+class RawFrameBuffer():
+    """Preallocated buffer for capturing raw frames from picamera
+
+    The buffer attribute is what gets handed to picamera as the
+    output of a capture.  The frame method gives a BGR view (what the
+    inference systems expect) of the most recent capture cropped to
+    the actual camera resolution.
+
+    """
+
+    def __init__(self, resolution, capture_format='bgr'):
+        if capture_format not in RAW_FORMATS:
+            raise ValueError(f'Not a raw capture format: {capture_format}')
+        self.format = capture_format
+        self.width, self.height = resolution
+        pad_width, pad_height = padded_resolution(resolution)
+
+        if self.format == 'yuv':
+            self.buffer = np.empty((pad_height * 3 // 2, pad_width),
+                                   dtype=np.uint8)
+        else:
+            self.buffer = np.empty((pad_height, pad_width, 3),
+                                   dtype=np.uint8)
+
+        if self.format == 'bgr':
+            self._converted = self.buffer
+        else:
+            self._converted = np.empty((pad_height, pad_width, 3),
+                                       dtype=np.uint8)
+
+    def frame(self):
+        """Return BGR view of the latest capture
+
+        Note that the view is into memory that is overwritten by the
+        next capture.
+
+        """
+        if self.format == 'yuv':
+            cv2.cvtColor(self.buffer, cv2.COLOR_YUV2BGR_I420,
+                         dst=self._converted)
+        elif self.format == 'rgb':
+            cv2.cvtColor(self.buffer, cv2.COLOR_RGB2BGR,
+                         dst=self._converted)
+
+        return self._converted[:self.height, :self.width]
+
+
+def encode_jpeg(frame):
+    """Return frame encoded as JPEG bytes (None if encoding fails)
+
+    """
+    ok, encoded = cv2.imencode('.jpeg', frame)
+    if not ok:
+        log.warning('Did not succeed in encoding frame as JPEG.')
+        return None
+
+    return encoded.tobytes()
+
+
+def create_capture_source(configs):
+    """Return capture source chosen by CAPTURE_SOURCE in configs
+
+    """
+    source = configs.get('CAPTURE_SOURCE', 'picamera')
+    if source == 'picamera':
+        return PiCameraSource(configs)
+    if source == 'replay':
+        return ReplaySource(configs['REPLAY_PATH'],
+                            realtime=configs.get('REPLAY_REALTIME', False),
+                            fps=configs.get('REPLAY_FPS', 10),
+                            loop=configs.get('REPLAY_LOOP', False))
+    raise ValueError(f'Unknown capture source: {source}')
+
+
+class CaptureSource():
+    """Base class for sources of frames
+
+    Note: is an abstract base class
+
+    """
+    camera = None
+
+    def frames(self):
+        """Generate frame packets
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release whatever the source holds open
+
+        """
+
+
+class PiCameraSource(CaptureSource):
+    """Continuous capture from the picamera
+
+    Captures in CAPTURE_FORMAT: JPEG or one of the raw formats. The
+    first frame is held back until CAMERA_WARMUP seconds after the
+    camera was started so its exposure and gains have settled; other
+    startup work can be done in the meantime.
+
+    """
+
+    def __init__(self, configs):
+        import picamera
+
+        self.format = configs.get('CAPTURE_FORMAT', 'jpeg')
+        resolution = configs['CAMERA_RESOLUTION']
+
+        self.camera = picamera.PiCamera()
+        self.camera.rotation = configs['CAMERA_ROTATION']
+        self.camera.resolution = resolution
+        self.ready_time = time.time() + configs.get('CAMERA_WARMUP', 2)
+
+        if self.format in RAW_FORMATS:
+            log.info('Capturing raw frames in %s format', self.format)
+            self.raw = RawFrameBuffer(resolution, self.format)
+        else:
+            self.raw = None
+
+    def frames(self):
+        if self.raw is not None:
+            output = self.raw.buffer
+        else:
+            output = io.BytesIO()
+
+        time.sleep(max(0, self.ready_time - time.time()))
+        for _ in self.camera.capture_continuous(output, format=self.format):
+            if self.raw is not None:
+                # copy out since raw buffer is overwritten by next capture
+                yield create_frame_packet(frame=self.raw.frame().copy())
+            else:
+                yield create_frame_packet(jpeg=output.getvalue())
+                output.seek(0)
+                output.truncate()
+
+    def close(self):
+        self.camera.close()
+
+
+class ReplaySource(CaptureSource):
+    """Plays back a folder of JPEGs or a video file
+
+    Images in a folder are played in filename order and kept as JPEG
+    bytes (like a JPEG capture). In realtime mode frames are paced by
+    the timestamps in recorded image filenames, the video's frame rate,
+    or failing either of those fps; otherwise frames come as fast as
+    they can be read.
+
+    """
+
+    def __init__(self, path, realtime=False, fps=10, loop=False):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        self.path = path
+        self.realtime = realtime
+        self.fps = fps
+        self.loop = loop
+        self.frames_read = 0
+
+    def frames(self):
+        while True:
+            if os.path.isdir(self.path):
+                timed_packets = self._folder_frames()
+            else:
+                timed_packets = self._video_frames()
+            yield from self._paced(timed_packets)
+            if not self.loop:
+                break
+        log.info('Replay of %s finished after %d frames.',
+                 self.path, self.frames_read)
+
+    def _folder_frames(self):
+        filenames = sorted(filename for filename in os.listdir(self.path)
+                           if filename.lower().endswith(JPEG_EXTENSIONS))
+        for index, filename in enumerate(filenames):
+            with open(os.path.join(self.path, filename), 'rb') as f:
+                jpeg = f.read()
+            timestamp = filename_timestamp(filename)
+            if timestamp is None:
+                timestamp = index / self.fps
+            yield timestamp, create_frame_packet(jpeg=jpeg)
+
+    def _video_frames(self):
+        video = cv2.VideoCapture(self.path)
+        fps = video.get(cv2.CAP_PROP_FPS) or self.fps
+        index = 0
+        try:
+            while True:
+                ok, frame = video.read()
+                if not ok:
+                    break
+                yield index / fps, create_frame_packet(frame=frame)
+                index += 1
+        finally:
+            video.release()
+
+    def _paced(self, timed_packets):
+        first = None
+        for timestamp, packet in timed_packets:
+            if self.realtime:
+                if first is None:
+                    first = timestamp
+                    start = time.perf_counter()
+                delay = (timestamp - first) - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            self.frames_read += 1
+            yield packet
+
+
+def filename_timestamp(filename):
+    """Return seconds timestamp in recorded image filename or None
+
+    """
+    match = TIMESTAMP_PATTERN.search(filename)
+    if match is None:
+        return None
+    return datetime.strptime(match.group(0), TIMESTAMP_FORMAT).timestamp()
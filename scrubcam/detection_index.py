@@ -0,0 +1,343 @@
+"""Index of recorded images and their detections
+
+Recordings are a flat folder of {timestamp}_{label}.jpeg images with
+their boxes in detections files (or a CSV per image). The
+DetectionIndex here keeps the same information in an SQLite database
+(by default detections.db in the record folder) so that questions
+like "all zebras above 0.8 last week" are one indexed query rather
+than globbing and parsing thousands of files. It is filled by the
+record writer as images are written and can be rebuilt from an
+existing folder.
+
+"""
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from scrubcam.capture import filename_timestamp
+from scrubcam.detections_file import read_boxes_file, read_folder_detections
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    filename TEXT UNIQUE NOT NULL,
+    timestamp REAL,
+    label TEXT
+);
+CREATE TABLE IF NOT EXISTS detections (
+    image_id INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    class_name TEXT,
+    confidence REAL,
+    left INTEGER,
+    top INTEGER,
+    width INTEGER,
+    height INTEGER,
+    area INTEGER
+);
+CREATE INDEX IF NOT EXISTS images_timestamp ON images(timestamp);
+CREATE INDEX IF NOT EXISTS detections_class
+    ON detections(class_name, confidence);
+CREATE INDEX IF NOT EXISTS detections_image ON detections(image_id);
+"""
+
+
+def default_index_file(record_folder):
+    """Return filename of the index kept in record_folder
+
+    """
+    return os.path.join(record_folder, 'detections.db')
+
+
+def _seconds(when):
+    """Return datetime (or seconds timestamp) as seconds timestamp
+
+    """
+    if when is None or isinstance(when, (int, float)):
+        return when
+    return when.timestamp()
+
+
+def label_from_filename(filename):
+    """Return label part of a {timestamp}_{label}.jpeg filename
+
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    if '_' not in name:
+        return None
+    return name.split('_', 1)[1]
+
+
+class DetectionIndex():
+    """SQLite index of recorded images and their boxes
+
+    Inserts are batched: they are committed once batch_size images
+    have been added, batch_interval seconds have passed since the last
+    commit, or on flush()/close(). The record writer calls
+    flush_if_due() while idle so the last images of a burst aren't left
+    uncommitted until the next one is added.
+
+    """
+
+    def __init__(self, filename, batch_size=20, batch_interval=30):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_commit = time.time()
+
+        self.connection = sqlite3.connect(filename,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.connection.executescript(SCHEMA)
+
+    @classmethod
+    def from_configs(cls, configs):
+        """Create the index configured for RECORD_FOLDER
+
+        RECORD_INDEX_FILE: index database (default detections.db in
+            RECORD_FOLDER)
+        RECORD_INDEX_BATCH: images added per commit
+        RECORD_INDEX_INTERVAL: most seconds added images wait to be
+            committed
+
+        """
+        filename = configs.get('RECORD_INDEX_FILE')
+        if filename is None:
+            filename = default_index_file(configs['RECORD_FOLDER'])
+        return cls(filename,
+                   batch_size=configs.get('RECORD_INDEX_BATCH', 20),
+                   batch_interval=configs.get('RECORD_INDEX_INTERVAL', 30))
+
+    def add(self, filename, timestamp=None, lboxes=None, label=None):
+        """Add a recorded image and its boxes to the index
+
+        filename is the image's name within the record folder.
+        timestamp (datetime or seconds) and label default to what is in
+        the filename.
+
+        """
+        if timestamp is None:
+            timestamp = filename_timestamp(filename)
+        if label is None:
+            label = label_from_filename(filename)
+        boxes = []
+        for lbox in lboxes or []:
+            left, top, width, height = (int(value) for value in lbox['box'])
+            boxes.append((lbox['class_name'],
+                          float(lbox['confidence']),
+                          left, top, width, height,
+                          width * height))
+
+        with self._lock:
+            self._pending.append((os.path.basename(filename),
+                                  _seconds(timestamp),
+                                  label,
+                                  boxes))
+            due = (len(self._pending) >= self.batch_size
+                   or time.time() - self._last_commit >= self.batch_interval)
+        if due:
+            self.flush()
+
+    def flush_if_due(self):
+        """Commit pending images if batch_interval is up
+
+        """
+        with self._lock:
+            due = (self._pending
+                   and time.time() - self._last_commit >= self.batch_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Commit the images added since the last commit
+
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            self._last_commit = time.time()
+            if not pending:
+                return
+            with self.connection:
+                self._insert(pending)
+
+    def _insert(self, pending):
+        for filename, timestamp, label, boxes in pending:
+            self.connection.execute('DELETE FROM images WHERE filename = ?',
+                                    (filename,))
+            cursor = self.connection.execute(
+                'INSERT INTO images (filename, timestamp, label) '
+                'VALUES (?, ?, ?)',
+                (filename, timestamp, label))
+            self.connection.executemany(
+                'INSERT INTO detections (image_id, class_name, confidence, '
+                'left, top, width, height, area) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(cursor.lastrowid, *box) for box in boxes])
+
+    def remove(self, filenames):
+        """Remove images (e.g. deleted from disk) from the index
+
+        """
+        self.flush()
+        with self._lock, self.connection:
+            self.connection.executemany(
+                'DELETE FROM images WHERE filename = ?',
+                [(os.path.basename(filename),) for filename in filenames])
+
+    def _where(self, classes, start, end, min_confidence, max_confidence,
+               min_area, max_area):
+        clauses = []
+        params = []
+        if classes:
+            classes = list(classes)
+            clauses.append('d.class_name IN '
+                           f'({", ".join("?" * len(classes))})')
+            params.extend(classes)
+        for clause, value in (('i.timestamp >= ?', _seconds(start)),
+                              ('i.timestamp < ?', _seconds(end)),
+                              ('d.confidence >= ?', min_confidence),
+                              ('d.confidence <= ?', max_confidence),
+                              ('d.area >= ?', min_area),
+                              ('d.area <= ?', max_area)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+
+        where = ' AND '.join(clauses) if clauses else '1'
+        return where, params
+
+    def query(self, classes=None, start=None, end=None,
+              min_confidence=None, max_confidence=None,
+              min_area=None, max_area=None, limit=None):
+        """Return list of detections matching all the given filters
+
+        start and end (datetime or seconds) bound the time range and
+        area is box width times height in pixels. Each detection is a
+        dict with filename, timestamp, class_name, confidence and box.
+        Ordered by time.
+
+        """
+        self.flush()
+        where, params = self._where(classes, start, end, min_confidence,
+                                    max_confidence, min_area, max_area)
+        sql = ('SELECT i.filename, i.timestamp, d.class_name, d.confidence, '
+               'd.left, d.top, d.width, d.height '
+               'FROM detections d JOIN images i ON d.image_id = i.id '
+               f'WHERE {where} ORDER BY i.timestamp, i.filename')
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        with self._lock:
+            rows = self.connection.execute(sql, params).fetchall()
+
+        return [{'filename': filename,
+                 'timestamp': timestamp,
+                 'class_name': class_name,
+                 'confidence': confidence,
+                 'box': [left, top, width, height]}
+                for (filename, timestamp, class_name, confidence,
+                     left, top, width, height) in rows]
+
+    def query_images(self, **filters):
+        """Return list of (filename, timestamp, lboxes) of matching images
+
+        Takes the same filters as query(); each image comes with only
+        its boxes that match them.
+
+        """
+        images = {}
+        for detection in self.query(**filters):
+            filename = detection.pop('filename')
+            timestamp = detection.pop('timestamp')
+            images.setdefault((filename, timestamp), []).append(detection)
+
+        return [(filename, timestamp, lboxes)
+                for (filename, timestamp), lboxes in images.items()]
+
+    def image_summaries(self):
+        """Return dict of filename to (top confidence, set of classes)
+
+        """
+        self.flush()
+        with self._lock:
+            rows = self.connection.execute(
+                'SELECT i.filename, d.class_name, d.confidence '
+                'FROM images i LEFT JOIN detections d '
+                'ON d.image_id = i.id').fetchall()
+
+        summaries = {}
+        for filename, class_name, confidence in rows:
+            top, classes = summaries.get(filename, (0.0, set()))
+            if class_name is not None:
+                top = max(top, confidence)
+                classes.add(class_name)
+            summaries[filename] = (top, classes)
+
+        return summaries
+
+    def count(self):
+        """Return number of images in the index
+
+        """
+        self.flush()
+        with self._lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def rebuild(self, folder):
+        """Replace the index contents with what is in a record folder
+
+        Boxes are read from the folder's detections files, or from an
+        image's boxes CSV if it isn't in any of them. Returns number of
+        images indexed.
+
+        """
+        detections = read_folder_detections(folder)
+        pending = []
+        for image_path in sorted(glob.glob(os.path.join(folder, '*.jpeg'))):
+            filename = os.path.basename(image_path)
+            timestamp = filename_timestamp(filename)
+            name = os.path.splitext(filename)[0]
+            csv_path = os.path.join(folder, name.split('_')[0] + '.csv')
+            lboxes = []
+            if filename in detections:
+                lboxes = detections[filename].to_lboxes()
+            elif os.path.exists(csv_path):
+                try:
+                    lboxes = read_boxes_file(csv_path)
+                except (ValueError, IndexError):
+                    log.warning('Could not read boxes file %s', csv_path)
+            pending.append((filename, timestamp,
+                            label_from_filename(filename),
+                            [(lbox['class_name'], lbox['confidence'],
+                              *lbox['box'], lbox['box'][2] * lbox['box'][3])
+                             for lbox in lboxes]))
+
+        self.flush()
+        with self._lock, self.connection:
+            self.connection.execute('DELETE FROM detections')
+            self.connection.execute('DELETE FROM images')
+            self._insert(pending)
+        log.info('Indexed %d images from %s', len(pending), folder)
+
+        return len(pending)
+
+    def close(self):
+        """Commit pending inserts and close the database
+
+        """
+        self.flush()
+        with self._lock:
+            self.connection.close()
+
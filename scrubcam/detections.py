@@ -0,0 +1,140 @@
+"""Compact container for the labeled boxes found in a frame
+
+Detections keeps the boxes, scores and class IDs of a frame in a NumPy
+structured array rather than a list of per-box dicts, so filtering by
+score or class is vectorized and class names are only looked up (from
+a class table shared by all frames) when something asks for them.
+
+For code written around lists of lboxes (dicts with 'box',
+'confidence', 'class_id' and 'class_name' keys) indexing or iterating
+over a Detections gives those same dicts.
+
+"""
+import numpy as np
+
+DETECTION_DTYPE = np.dtype([('box', np.int32, (4,)),
+                            ('score', np.float32),
+                            ('class_id', np.int16)])
+
+
+class Detections():
+    """Array-backed set of labeled boxes from one frame
+
+    Boxes are (left, top, width, height) in frame coordinates and are
+    kept sorted highest score first.
+
+    """
+
+    def __init__(self, records=None, class_table=None):
+        if records is None:
+            records = np.empty(0, dtype=DETECTION_DTYPE)
+        self.records = records
+        self.class_table = class_table
+
+    @classmethod
+    def from_arrays(cls, boxes, scores, class_ids, class_table=None):
+        """Create from parallel sequences of boxes, scores and class IDs
+
+        """
+        scores = np.asarray(scores, dtype=np.float32)
+        records = np.empty(len(scores), dtype=DETECTION_DTYPE)
+        if len(scores) > 0:
+            records['box'] = np.asarray(boxes).reshape(-1, 4)
+            records['score'] = scores
+            records['class_id'] = class_ids
+            records = records[np.argsort(-scores, kind='stable')]
+
+        return cls(records, class_table)
+
+    @classmethod
+    def from_lboxes(cls, lboxes, class_table=None):
+        """Create from a list of lbox dicts
+
+        """
+        return cls.from_arrays([lbox['box'] for lbox in lboxes],
+                               [lbox['confidence'] for lbox in lboxes],
+                               [lbox['class_id'] for lbox in lboxes],
+                               class_table)
+
+    @property
+    def boxes(self):
+        """(N, 4) int32 array of boxes"""
+        return self.records['box']
+
+    @property
+    def scores(self):
+        """(N,) float32 array of scores"""
+        return self.records['score']
+
+    @property
+    def class_ids(self):
+        """(N,) int16 array of class IDs"""
+        return self.records['class_id']
+
+    def class_names(self):
+        """Return list of class names of the boxes
+
+        """
+        return list(self.class_table[self.class_ids])
+
+    def class_name(self, index):
+        """Return class name of box at index
+
+        """
+        return self.class_table[self.records['class_id'][index]]
+
+    def filter_score(self, threshold):
+        """Return Detections with only boxes scoring above threshold
+
+        """
+        return Detections(self.records[self.scores > threshold],
+                          self.class_table)
+
+    def filter_classes(self, classes):
+        """Return Detections with only boxes of the given classes
+
+        classes can be class names or class IDs.
+
+        """
+        classes = list(classes)
+        if classes and isinstance(classes[0], str):
+            wanted = np.isin(self.class_table, classes)
+            mask = wanted[self.class_ids]
+        else:
+            mask = np.isin(self.class_ids, classes)
+
+        return Detections(self.records[mask], self.class_table)
+
+    def lbox(self, index):
+        """Return box at index as an lbox dict
+
+        """
+        record = self.records[index]
+        lbox = {'class_id': int(record['class_id']),
+                'confidence': float(record['score']),
+                'box': record['box'].tolist()}
+        if self.class_table is not None:
+            lbox['class_name'] = self.class_table[record['class_id']]
+
+        return lbox
+
+    def to_lboxes(self):
+        """Return list of lbox dicts
+
+        """
+        return [self.lbox(i) for i in range(len(self))]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.lbox(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Detections(self.records[index], self.class_table)
+        return self.lbox(index)
+
+    def __repr__(self):
+        return f'Detections({self.to_lboxes()})'
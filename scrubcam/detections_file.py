@@ -0,0 +1,406 @@
+"""Append-only files of the detections in recorded frames
+
+Rather than a CSV of boxes for every recorded frame (tens of thousands
+of tiny files per deployment, slow directory listings and running out
+of inodes on FAT/exFAT cards) the boxes of all the frames recorded in
+a day (or a session) go into one append-only file.
+
+A file starts with MAGIC followed by records, each a type byte and a
+payload length (uint32) and then the payload:
+
+- CLASSES: JSON list of class names that later class IDs refer to
+- FRAME: timestamp (float64 seconds), image filename length (uint16),
+  box count (uint16), the image filename (UTF-8) and the boxes as
+  BOX_DTYPE records
+
+All numbers are little-endian. A record left half written by a crash
+is ignored by the reader and cut off when the file is next appended to.
+Writers sharing a file (e.g. the detector and classifier of two_step.py)
+take turns through a file lock and each writes its class table again
+whenever another has appended since its last record.
+compact_detections_file drops the frames of deleted images (e.g. ones
+evicted by scrubcam.storage) by replacing the file under that lock,
+after which writers reopen it. export_boxes_csvs turns a file back into
+the per-frame CSVs older tools expect.
+
+"""
+import csv
+import fcntl
+import glob
+import json
+import logging
+import os
+import struct
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from scrubcam.capture import filename_timestamp
+from scrubcam.detections import Detections
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'SCDET\x01'
+EXTENSION = '.scd'
+CLASSES = b'C'
+FRAME = b'F'
+RECORD_HEADER = struct.Struct('<cI')
+FRAME_HEADER = struct.Struct('<dHH')
+BOX_DTYPE = np.dtype([('box', '<i4', (4,)),
+                      ('score', '<f4'),
+                      ('class_id', '<i2')])
+
+DAY = 'day'
+SESSION = 'session'
+
+
+def write_boxes_file(folder, timestamp, lboxes):
+    """Write a list of lboxes to a CSV
+
+    The CSV is given timestamp as its name
+
+    """
+    filename = f"{timestamp}.csv"
+    full_filename = os.path.join(folder, filename)
+    with open(full_filename, 'w', encoding="utf8") as f:
+        csv_writer = csv.writer(f,
+                                delimiter=',',
+                                quotechar='"',
+                                quoting=csv.QUOTE_MINIMAL)
+        for lbox in lboxes:
+            csv_writer.writerow([lbox['class_name'],
+                                 lbox['confidence'],
+                                 *lbox['box']])
+
+
+def read_boxes_file(filename):
+    """Return list of lboxes from a boxes CSV (see write_boxes_file)
+
+    """
+    lboxes = []
+    with open(filename, encoding='utf8') as f:
+        for row in csv.reader(f, delimiter=',', quotechar='"'):
+            if not row:
+                continue
+            lboxes.append({'class_name': row[0],
+                           'confidence': float(row[1]),
+                           'box': [int(float(item)) for item in row[2:6]]})
+    return lboxes
+
+
+def _as_detections(lboxes):
+    """Return lboxes as Detections (converting a list of lbox dicts)
+
+    """
+    if isinstance(lboxes, Detections):
+        return lboxes
+    class_table = None
+    if lboxes:
+        size = max(lbox['class_id'] for lbox in lboxes) + 1
+        class_table = np.full(size, '', dtype=object)
+        for lbox in lboxes:
+            class_table[lbox['class_id']] = lbox.get('class_name', '')
+    return Detections.from_lboxes(lboxes, class_table)
+
+
+def _with_id_names(class_table, class_ids):
+    """Return class_table extended to name every one of class_ids
+
+    Class IDs without a name in the table are named by their ID.
+
+    """
+    size = int(class_ids.max()) + 1 if len(class_ids) else 0
+    if size == 0 or (class_table is not None and len(class_table) >= size):
+        return class_table
+    names = np.array([str(class_id) for class_id in range(size)],
+                     dtype=object)
+    if class_table is not None:
+        names[:len(class_table)] = class_table
+    return names
+
+
+def _complete_length(f):
+    """Return length of the complete records at the start of f
+
+    """
+    size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f'Not a detections file: {f.name}')
+    end = f.tell()
+    while end + RECORD_HEADER.size <= size:
+        _, length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        if end + RECORD_HEADER.size + length > size:
+            break
+        end += RECORD_HEADER.size + length
+        f.seek(end)
+    return end
+
+
+def _records(data, filename):
+    """Generate (kind, start, end, payload) of each complete record
+
+    start and end are the record's (header included) offsets in data.
+
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'Not a detections file: {filename}')
+
+    position = len(MAGIC)
+    while position + RECORD_HEADER.size <= len(data):
+        kind, length = RECORD_HEADER.unpack_from(data, position)
+        start = position
+        position += RECORD_HEADER.size
+        if position + length > len(data):
+            log.warning('Ignoring partly written record at end of %s',
+                        filename)
+            break
+        payload = data[position:position + length]
+        position += length
+        yield kind, start, position, payload
+
+
+def _frame_image(payload):
+    """Return (timestamp, image filename, box count, boxes offset) of FRAME
+
+    """
+    timestamp, name_length, count = FRAME_HEADER.unpack_from(payload)
+    start = FRAME_HEADER.size
+    image = payload[start:start + name_length].decode('utf-8')
+    return timestamp, image, count, start + name_length
+
+
+def read_detections_file(filename):
+    """Generate (image filename, timestamp, Detections) of each frame
+
+    Boxes of classes the file has no name for (e.g. frames before its
+    first class table) are named by their class ID.
+
+    """
+    class_table = None
+    warned = False
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    for kind, _, _, payload in _records(data, filename):
+        if kind == CLASSES:
+            class_table = np.array(json.loads(payload), dtype=object)
+        elif kind == FRAME:
+            timestamp, image, count, start = _frame_image(payload)
+            boxes = np.frombuffer(payload, BOX_DTYPE, count, start)
+            records = boxes.astype(Detections().records.dtype)
+            frame_table = _with_id_names(class_table, records['class_id'])
+            if frame_table is not class_table and not warned:
+                log.warning('Boxes without class names in %s, naming '
+                            'them by class ID', filename)
+                warned = True
+            yield image, timestamp, Detections(records, frame_table)
+
+
+def find_detections_files(folder):
+    """Return sorted list of the detections files in folder
+
+    """
+    return sorted(glob.glob(os.path.join(folder, f'*{EXTENSION}')))
+
+
+def read_folder_detections(folder):
+    """Return dict of image filename to Detections from folder's files
+
+    """
+    detections = {}
+    for filename in find_detections_files(folder):
+        try:
+            for image, _, lboxes in read_detections_file(filename):
+                detections[image] = lboxes
+        except (OSError, ValueError):
+            log.exception('Could not read detections file %s', filename)
+    return detections
+
+
+def compact_detections_file(filename, images):
+    """Rewrite a detections file without the frames of the given images
+
+    The new file replaces the old one while holding the old one's lock,
+    so writers appending to it finish first and reopen it after (see
+    DetectionsFile.append). Class tables are kept. Returns number of
+    bytes freed.
+
+    """
+    images = set(images)
+    with open(filename, 'rb') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            data = f.read()
+            kept = [MAGIC]
+            removed = False
+            for kind, start, end, payload in _records(data, filename):
+                if kind == FRAME and _frame_image(payload)[1] in images:
+                    removed = True
+                else:
+                    kept.append(data[start:end])
+            if not removed:
+                return 0
+
+            compacted = b''.join(kept)
+            temporary = filename + '.tmp'
+            with open(temporary, 'wb') as out:
+                out.write(compacted)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(temporary, filename)
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    return len(data) - len(compacted)
+
+
+def export_boxes_csvs(filename, folder):
+    """Write the per-frame boxes CSVs of a detections file to folder
+
+    The CSVs are named by the timestamp in the image filename, as
+    write_boxes_file does. Returns number of CSVs written.
+
+    """
+    count = 0
+    for image, _, lboxes in read_detections_file(filename):
+        timestamp = os.path.splitext(image)[0].split('_')[0]
+        write_boxes_file(folder, timestamp, lboxes)
+        count += 1
+    return count
+
+
+class DetectionsFile():
+    """Appends the detections of recorded frames to a file per day/session
+
+    """
+
+    def __init__(self, folder, per=DAY):
+        if per not in (DAY, SESSION):
+            raise ValueError(f'Unknown detections file period: {per}')
+        self.folder = folder
+        self.per = per
+        self.session = datetime.now().strftime('%Y-%m-%dT%Hh%Mm%Ss')
+
+        self.records_written = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._filename = None
+        self._class_table = None
+        self._end = 0
+
+    def filename_for(self, when):
+        """Return the file for frames recorded at datetime when
+
+        """
+        if self.per == DAY:
+            name = when.strftime('%Y-%m-%d')
+        else:
+            name = self.session
+        return os.path.join(self.folder, f'detections_{name}{EXTENSION}')
+
+    def _open(self, filename):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(filename, 'ab+')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            if self._file.seek(0, os.SEEK_END) == 0:
+                self._file.write(MAGIC)
+                self._file.flush()
+            else:
+                end = _complete_length(self._file)
+                if end < self._file.seek(0, os.SEEK_END):
+                    log.warning('Cutting off partly written record in %s',
+                                filename)
+                    self._file.truncate(end)
+            self._end = self._file.seek(0, os.SEEK_END)
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._filename = filename
+        self._class_table = None
+
+    def _replaced(self):
+        """Return whether the open file has been replaced (compacted)
+
+        """
+        try:
+            current = os.stat(self._filename).st_ino
+        except FileNotFoundError:
+            return True
+        return current != os.fstat(self._file.fileno()).st_ino
+
+    @staticmethod
+    def _record(kind, payload):
+        return RECORD_HEADER.pack(kind, len(payload)) + payload
+
+    def append(self, image_filename, lboxes, timestamp=None):
+        """Append frame recorded as image_filename with its lboxes
+
+        timestamp (seconds) defaults to the one in the filename.
+        Returns number of bytes written.
+
+        """
+        if timestamp is None:
+            timestamp = filename_timestamp(image_filename)
+        if timestamp is None:
+            timestamp = datetime.now().timestamp()
+        detections = _as_detections(lboxes)
+        name = os.path.basename(image_filename).encode('utf-8')
+        boxes = detections.records.astype(BOX_DTYPE)
+
+        with self._lock:
+            filename = self.filename_for(datetime.fromtimestamp(timestamp))
+            if filename != self._filename:
+                self._open(filename)
+
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            if self._replaced():
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+                self._open(filename)
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                if self._file.seek(0, os.SEEK_END) != self._end:
+                    # another writer has appended, maybe its own classes
+                    self._class_table = None
+
+                data = b''
+                class_table = detections.class_table
+                if class_table is not None and (
+                        self._class_table is None
+                        or (class_table is not self._class_table
+                            and list(class_table)
+                            != list(self._class_table))):
+                    data += self._record(
+                        CLASSES,
+                        json.dumps(list(class_table)).encode('utf-8'))
+                    self._class_table = class_table
+
+                data += self._record(
+                    FRAME,
+                    FRAME_HEADER.pack(timestamp, len(name), len(boxes))
+                    + name
+                    + boxes.tobytes())
+                self._file.write(data)
+                self._file.flush()
+                self._end = self._file.tell()
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+            self.records_written += 1
+
+        return len(data)
+
+    def close(self, fsync=True):
+        """Close the current file (after fsyncing it)
+
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            if fsync:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+            self._filename = None
@@ -0,0 +1,386 @@
+"""ScrubHub server for many ScrubCams at once
+
+ServerSocketHandler serves one camera connection at a time. The
+HubServer here runs on asyncio with a task per camera connection, so
+one hub machine can take in a fleet of ScrubCams talking the protocol
+in scrubcam.protocol. It keeps the state each camera has told it about
+itself (hostname, filter classes, continue run flag), drops cameras
+that go quiet for longer than the idle timeout (cameras send a
+heartbeat every 15 s) and hands what comes in to consumers as
+HubEvents, either from an asyncio coroutine:
+
+    hub = HubServer(('0.0.0.0', 65432))
+    await hub.start()
+    while True:
+        event = await hub.next_event()
+
+or, for code that isn't asyncio (e.g. an OpenCV viewer), through a
+HubThread that runs the hub in the background:
+
+    hub = HubThread(('0.0.0.0', 65432))
+    hub.start()
+    event = hub.get_event(timeout=1)
+
+Events are queued for consumers up to a limit beyond which the oldest
+are dropped, so a slow consumer can't hold up the cameras.
+
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from threading import Thread
+
+import cv2
+import numpy as np
+
+from scrubcam import protocol
+from scrubcam.metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+CONNECT = 'connect'
+CONFIG = 'config'
+IMAGE = 'image'
+HEARTBEAT = 'heartbeat'
+DISCONNECT = 'disconnect'
+TIMEOUT = 'timeout'
+
+# three missed heartbeats
+IDLE_TIMEOUT = 45
+EVENT_QUEUE_SIZE = 1000
+
+MESSAGES_RECEIVED = REGISTRY.counter('scrubhub_messages_received_total',
+                                     'Messages received from cameras')
+BYTES_RECEIVED = REGISTRY.counter('scrubhub_bytes_received_total',
+                                  'Bytes received from cameras')
+EVENTS_DROPPED = REGISTRY.counter('scrubhub_events_dropped_total',
+                                  'Events dropped from full event queue')
+
+
+class CameraState():
+    """What the hub knows about a connected camera
+
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.hostname = None
+        self.filter_classes = []
+        self.continue_run = None
+        self.class_table = None
+        self.connected_time = time.time()
+        self.last_message_time = self.connected_time
+        self.last_heartbeat = None
+        self.messages = 0
+        self.images = 0
+
+    @property
+    def name(self):
+        """Hostname if the camera has sent it, otherwise address
+
+        """
+        if self.hostname is not None:
+            return self.hostname
+        return '{}:{}'.format(*self.address[:2])
+
+
+class HubEvent():
+    """Something that happened on a camera connection
+
+    kind is one of CONNECT, CONFIG, IMAGE, HEARTBEAT, DISCONNECT or
+    TIMEOUT. IMAGE events carry the image's Detections and JPEG bytes,
+    decoded only when image() is called.
+
+    """
+
+    def __init__(self, kind, camera, timestamp=None, sequence=None,
+                 detections=None, jpeg=None):
+        self.kind = kind
+        self.camera = camera
+        self.timestamp = timestamp
+        self.sequence = sequence
+        self.detections = detections
+        self.jpeg = jpeg
+        self.received_time = time.time()
+
+    def image(self):
+        """Return the decoded image of an IMAGE event
+
+        """
+        if self.jpeg is None:
+            return None
+        return cv2.imdecode(np.frombuffer(self.jpeg, dtype=np.uint8), 1)
+
+    def __repr__(self):
+        return f'HubEvent({self.kind}, {self.camera.name})'
+
+
+class HubServer():
+    """asyncio server for many concurrent camera connections
+
+    """
+
+    def __init__(self, address, idle_timeout=IDLE_TIMEOUT,
+                 event_queue_size=EVENT_QUEUE_SIZE, command=0):
+        self.address = address
+        self.idle_timeout = idle_timeout
+        self.command = command
+
+        self.cameras = {}
+        self.messages_received = 0
+        self.events_dropped = 0
+
+        self._events = deque(maxlen=event_queue_size)
+        self._event_ready = None
+        self._server = None
+        self._connections = set()
+
+        REGISTRY.gauge('scrubhub_connected_cameras',
+                       'Cameras connected to the hub',
+                       function=lambda: len(self.cameras))
+
+    async def start(self):
+        """Start listening for cameras
+
+        """
+        self._event_ready = asyncio.Event()
+        host, port = self.address
+        self._server = await asyncio.start_server(self._handle_camera,
+                                                  host,
+                                                  port,
+                                                  backlog=1024)
+        self.address = self._server.sockets[0].getsockname()[:2]
+        log.info('Hub listening on %s:%s', *self.address)
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        """Stop listening and disconnect all cameras
+
+        """
+        if self._server is not None:
+            self._server.close()
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+
+    def _emit(self, event):
+        if len(self._events) == self._events.maxlen:
+            self.events_dropped += 1
+            EVENTS_DROPPED.inc()
+        self._events.append(event)
+        self._event_ready.set()
+
+    async def next_event(self):
+        """Return the next event (oldest first), waiting for one
+
+        """
+        while not self._events:
+            self._event_ready.clear()
+            await self._event_ready.wait()
+        return self._events.popleft()
+
+    def pending_events(self):
+        """Return number of events waiting for consumers
+
+        """
+        return len(self._events)
+
+    async def _read(self, reader, size):
+        return await asyncio.wait_for(reader.readexactly(size),
+                                      self.idle_timeout)
+
+    async def _read_message(self, reader):
+        """Return next Message from a camera (None if it hung up)
+
+        Raises asyncio.TimeoutError if idle_timeout passes before the
+        message starts or while waiting for any part of it, so a camera
+        stalling mid-message doesn't hold its connection forever.
+
+        """
+        try:
+            header = await self._read(reader, protocol.HEADER.size)
+            (msg_type, sequence, timestamp,
+             meta_length, payload_length) = protocol.unpack_header(header)
+            meta = b''
+            if meta_length:
+                meta = await self._read(reader, meta_length)
+            payload = b''
+            if payload_length:
+                payload = await self._read(reader, payload_length)
+        except asyncio.IncompleteReadError:
+            return None
+
+        MESSAGES_RECEIVED.inc()
+        BYTES_RECEIVED.inc(protocol.HEADER.size + meta_length
+                           + payload_length)
+        return protocol.Message(msg_type, sequence, timestamp, meta, payload)
+
+    async def _handle_camera(self, reader, writer):
+        """Serve one camera connection until it ends or times out
+
+        """
+        task = asyncio.current_task()
+        self._connections.add(task)
+        camera = CameraState(writer.get_extra_info('peername'))
+        self.cameras[camera.address] = camera
+        log.info('Camera connected from %s', camera.name)
+        self._emit(HubEvent(CONNECT, camera))
+        end = DISCONNECT
+
+        try:
+            writer.write(protocol.pack_header(
+                protocol.COMMAND, 0, time.time(),
+                meta_length=protocol.COMMAND_FORMAT.size))
+            writer.write(protocol.COMMAND_FORMAT.pack(self.command))
+            await writer.drain()
+
+            while True:
+                message = await self._read_message(reader)
+                if message is None:
+                    break
+                self._handle_message(camera, message)
+        except asyncio.TimeoutError:
+            log.warning('No messages from %s in %d s, disconnecting.',
+                        camera.name, self.idle_timeout)
+            end = TIMEOUT
+        except ValueError as e:
+            log.error('Closing connection to %s: %s', camera.name, e)
+        except ConnectionResetError:
+            # cameras that never read the command reset on closing
+            pass
+        except OSError as e:
+            log.warning('Connection to %s failed: %s', camera.name, e)
+        except asyncio.CancelledError:
+            # hub closing, end quietly rather than re-raising
+            pass
+        finally:
+            self._connections.discard(task)
+            del self.cameras[camera.address]
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, asyncio.CancelledError):
+                pass
+            log.info('Camera %s disconnected.', camera.name)
+            self._emit(HubEvent(end, camera))
+
+    def _handle_message(self, camera, message):
+        camera.messages += 1
+        camera.last_message_time = time.time()
+        self.messages_received += 1
+
+        if message.type == protocol.IMAGE:
+            camera.images += 1
+            detections = protocol.unpack_detections(message.meta,
+                                                    camera.class_table)
+            self._emit(HubEvent(IMAGE, camera, message.timestamp,
+                                message.sequence, detections,
+                                message.payload))
+        elif message.type == protocol.CLASS_TABLE:
+            camera.class_table = protocol.unpack_class_table(message.meta)
+        elif message.type == protocol.HEARTBEAT:
+            camera.last_heartbeat = message.timestamp
+            self._emit(HubEvent(HEARTBEAT, camera, message.timestamp,
+                                message.sequence))
+        elif message.type == protocol.CONFIG:
+            config = protocol.unpack_config(message.meta)
+            camera.hostname = config['hostname']
+            camera.continue_run = config['continue_run']
+            camera.filter_classes = config['classes']
+            log.info('Camera %s configured: classes %s',
+                     camera.name, camera.filter_classes)
+            self._emit(HubEvent(CONFIG, camera, message.timestamp,
+                                message.sequence))
+        elif message.type != protocol.NO_IMAGE:
+            log.warning('Ignoring message of type %d from %s.',
+                        message.type, camera.name)
+
+
+class HubThread(Thread):
+    """Runs a HubServer on its own event loop in a background thread
+
+    Events are handed over through a thread-safe queue (get_event).
+
+    """
+
+    def __init__(self, address, idle_timeout=IDLE_TIMEOUT,
+                 event_queue_size=EVENT_QUEUE_SIZE):
+        super().__init__(name='scrubhub', daemon=True)
+        self.hub = HubServer(address, idle_timeout, event_queue_size)
+        self.events = queue.Queue(event_queue_size)
+        self._loop = None
+        self._listening = threading.Event()
+        self._error = None
+
+    @property
+    def address(self):
+        return self.hub.address
+
+    def start(self):
+        """Start the hub and wait until it is listening
+
+        """
+        super().start()
+        self._listening.wait()
+        if self._error is not None:
+            raise self._error
+
+    def run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self.hub.start())
+        except Exception as e:
+            # handed to start() to raise rather than left to kill this
+            # thread while start() waits for it to be listening
+            self._error = e
+            self._loop.close()
+            return
+        finally:
+            self._listening.set()
+
+        self._loop.run_until_complete(self._forward_events())
+        self._loop.run_until_complete(self.hub.close())
+        self._loop.close()
+
+    async def _forward_events(self):
+        while True:
+            event = await self.hub.next_event()
+            if event is None:
+                break
+            try:
+                self.events.put_nowait(event)
+            except queue.Full:
+                # drop oldest for the newest
+                try:
+                    self.events.get_nowait()
+                except queue.Empty:
+                    pass
+                self.hub.events_dropped += 1
+                EVENTS_DROPPED.inc()
+                self.events.put_nowait(event)
+
+    def get_event(self, timeout=None):
+        """Return next event (None if none arrives within timeout)
+
+        """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self, timeout=5):
+        """Stop the hub
+
+        """
+        if self._loop is None or self._loop.is_closed():
+            return
+        # a None event ends the forwarding loop
+        self._loop.call_soon_threadsafe(self.hub._emit, None)
+        self.join(timeout)
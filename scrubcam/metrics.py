@@ -0,0 +1,343 @@
+"""Low-overhead metrics for the ScrubCam
+
+Counters, gauges and histograms are kept in a registry and can be
+served in the Prometheus text format over a small local HTTP endpoint
+and/or dumped periodically to a size-rotated file, giving something
+better to look at trends with than INFO log lines.
+
+Instrumented modules register their metrics with the module-level
+REGISTRY when imported. Metrics whose values already live elsewhere
+(e.g. a queue's depth) can be registered with a function that is only
+called when the metrics are rendered, so they cost nothing on the hot
+path.
+
+"""
+import logging
+import os
+import time
+import bisect
+import threading
+from threading import Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+# seconds, suits inference and write latencies on a Pi
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+                   5)
+
+
+def _escape_label_value(value):
+    return (str(value).replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(labels, extra=None):
+    labels = dict(labels or {})
+    if extra:
+        labels.update(extra)
+    if not labels:
+        return ''
+    inner = ','.join(f'{key}="{_escape_label_value(value)}"'
+                     for key, value in labels.items())
+    return '{' + inner + '}'
+
+
+class Counter():
+    """Value that only goes up
+
+    """
+    kind = 'counter'
+
+    def __init__(self, name, labels=None, function=None):
+        self.name = name
+        self.labels = labels
+        self.function = function
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Increase counter by amount
+
+        """
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        """Current value of counter"""
+        if self.function is not None:
+            return self.function()
+        return self._value
+
+    def samples(self):
+        """Return list of (name, labels string, value) to render
+
+        """
+        return [(self.name, _format_labels(self.labels), self.value)]
+
+
+class Gauge(Counter):
+    """Value that can go up and down
+
+    """
+    kind = 'gauge'
+
+    def set(self, value):
+        """Set gauge to value
+
+        """
+        self._value = value
+
+
+class Histogram():
+    """Distribution of observed values in cumulative buckets
+
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, labels=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Add an observed value
+
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def samples(self):
+        """Return list of (name, labels string, value) to render
+
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            labels = _format_labels(self.labels, {'le': bound})
+            samples.append((f'{self.name}_bucket', labels, cumulative))
+        labels = _format_labels(self.labels)
+        samples.append((f'{self.name}_sum', labels, total))
+        samples.append((f'{self.name}_count', labels, cumulative))
+
+        return samples
+
+
+class MetricsRegistry():
+    """Collection of metrics that can be rendered as text
+
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric, help_text):
+        """Add metric, or return the one already under its name and labels
+
+        A function-backed metric registered again (e.g. by a new
+        instance of the object it reports on) takes over the existing
+        metric's function so it doesn't keep reporting the old object.
+
+        """
+        key = (metric.name, _format_labels(metric.labels))
+        with self._lock:
+            if key in self._metrics:
+                existing = self._metrics[key]
+                if getattr(metric, 'function', None) is not None:
+                    existing.function = metric.function
+                return existing
+            self._metrics[key] = metric
+            self._help.setdefault(metric.name, (metric.kind, help_text))
+        return metric
+
+    def counter(self, name, help_text, labels=None, function=None):
+        """Return counter registered under name (and labels)
+
+        """
+        return self._register(Counter(name, labels, function), help_text)
+
+    def gauge(self, name, help_text, labels=None, function=None):
+        """Return gauge registered under name (and labels)
+
+        """
+        return self._register(Gauge(name, labels, function), help_text)
+
+    def histogram(self, name, help_text, labels=None,
+                  buckets=DEFAULT_BUCKETS):
+        """Return histogram registered under name (and labels)
+
+        """
+        return self._register(Histogram(name, labels, buckets), help_text)
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format
+
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+            help_texts = dict(self._help)
+
+        lines = []
+        described = set()
+        for (name, _), metric in metrics:
+            if name not in described:
+                kind, help_text = help_texts[name]
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                described.add(name)
+            try:
+                samples = metric.samples()
+            except Exception:
+                log.exception('Could not get value of metric %s', name)
+                continue
+            for sample_name, labels, value in samples:
+                lines.append(f'{sample_name}{labels} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class MetricsServer(Thread):
+    """Serves the registry's metrics as text over HTTP
+
+    """
+
+    def __init__(self, address, registry=REGISTRY):
+        super().__init__(daemon=True)
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        self.server = ThreadingHTTPServer(address, Handler)
+
+    def run(self):
+        log.info('Serving metrics on %s:%d', *self.server.server_address)
+        self.server.serve_forever()
+
+    def close(self):
+        """Stop serving
+
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsDumper(Thread):
+    """Periodically appends the registry's metrics to a rotating file
+
+    """
+
+    def __init__(self, filename, interval, max_bytes, backups,
+                 stop_flag, registry=REGISTRY):
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.stop_flag = stop_flag
+        self.registry = registry
+
+    def run(self):
+        next_dump = time.time() + self.interval
+        while not self.stop_flag():
+            time.sleep(min(1, self.interval))
+            if time.time() >= next_dump:
+                next_dump += self.interval
+                try:
+                    self.dump()
+                except OSError:
+                    log.exception('Could not dump metrics.')
+
+    def close(self):
+        """Write a last dump of the metrics
+
+        """
+        try:
+            self.dump()
+        except OSError:
+            log.exception('Could not dump metrics.')
+
+    def dump(self):
+        """Append current metrics to the file, rotating it if too big
+
+        """
+        if (os.path.exists(self.filename)
+                and os.path.getsize(self.filename) >= self.max_bytes):
+            rotate_file(self.filename, self.backups)
+        with open(self.filename, 'a', encoding='utf-8') as f:
+            f.write(f'# time {time.time():.3f}\n')
+            f.write(self.registry.render())
+
+
+def rotate_file(filename, backups):
+    """Shift filename to filename.1, filename.1 to filename.2, etc.
+
+    Keeps at most backups old files.
+
+    """
+    for i in range(backups - 1, 0, -1):
+        older = f'{filename}.{i}'
+        if os.path.exists(older):
+            os.replace(older, f'{filename}.{i + 1}')
+    if backups > 0:
+        os.replace(filename, f'{filename}.1')
+    else:
+        os.remove(filename)
+
+
+def start_exporters(configs, stop_flag):
+    """Start the HTTP endpoint and/or file dumper enabled in configs
+
+    METRICS_PORT: port to serve metrics on (not served if not given)
+    METRICS_HOST: address to serve on, local only by default
+    METRICS_FILE: file to dump metrics to (not dumped if not given)
+    METRICS_DUMP_INTERVAL: seconds between dumps
+    METRICS_FILE_MAX_BYTES, METRICS_FILE_BACKUPS: rotation of the file
+
+    Returns list of the started exporter threads, each with a close()
+    method for shutting down.
+
+    """
+    exporters = []
+    if configs.get('METRICS_PORT') is not None:
+        server = MetricsServer((configs.get('METRICS_HOST', '127.0.0.1'),
+                                configs['METRICS_PORT']))
+        server.start()
+        exporters.append(server)
+    if configs.get('METRICS_FILE') is not None:
+        dumper = MetricsDumper(configs['METRICS_FILE'],
+                               configs.get('METRICS_DUMP_INTERVAL', 60),
+                               configs.get('METRICS_FILE_MAX_BYTES', 1000000),
+                               configs.get('METRICS_FILE_BACKUPS', 3),
+                               stop_flag)
+        dumper.start()
+        exporters.append(dumper)
+
+    return exporters
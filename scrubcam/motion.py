@@ -0,0 +1,137 @@
+"""Motion gating for skipping inference on static frames
+
+Most frames a field camera captures are of empty, unchanging scrub.
+The MotionGate here is a cheap check run before the object detector:
+it compares a heavily downscaled grayscale copy of each frame with a
+running background model and only lets frames through to the detector
+when enough of the scene has changed. A full inference is still
+forced every so many frames and for as long as the detector keeps
+finding boxes, so stationary animals aren't lost.
+
+"""
+import logging
+
+import numpy as np
+import cv2
+
+log = logging.getLogger(__name__)
+
+
+class MotionGate():
+    """Decides whether a frame is worth running the detector on
+
+    Configured by:
+
+    MOTION_DOWNSCALE_WIDTH: width (px) frames are shrunk to for the check
+    MOTION_PIXEL_THRESHOLD: grayscale difference for a pixel to count
+        as changed
+    MOTION_MIN_CHANGED: fraction of pixels that must change for a frame
+        to count as having motion
+    MOTION_BACKGROUND_RATE: how quickly (0-1) the background model
+        takes on new frames
+    MOTION_FORCE_EVERY: run the detector at least every this many frames
+
+    """
+
+    def __init__(self, configs):
+        self.width = configs.get('MOTION_DOWNSCALE_WIDTH', 160)
+        self.pixel_threshold = configs.get('MOTION_PIXEL_THRESHOLD', 25)
+        self.min_changed = configs.get('MOTION_MIN_CHANGED', 0.002)
+        self.background_rate = configs.get('MOTION_BACKGROUND_RATE', 0.05)
+        self.force_every = configs.get('MOTION_FORCE_EVERY', 30)
+
+        self.frames_checked = 0
+        self.frames_skipped = 0
+        self.holding = False
+        self._since_inference = 0
+
+        self._size = None
+        self._small = None
+        self._gray = None
+        self._background = None
+        self._background_u8 = None
+        self._diff = None
+
+    @property
+    def skip_ratio(self):
+        """Fraction of checked frames that were skipped
+
+        """
+        if self.frames_checked == 0:
+            return 0.0
+        return self.frames_skipped / self.frames_checked
+
+    def _allocate(self, frame_shape):
+        frame_height, frame_width = frame_shape[:2]
+        height = max(1, round(self.width * frame_height / frame_width))
+        self._size = (self.width, height)
+        self._small = np.empty((height, self.width, 3), dtype=np.uint8)
+        self._gray = np.empty((height, self.width), dtype=np.uint8)
+        self._background_u8 = np.empty_like(self._gray)
+        self._diff = np.empty_like(self._gray)
+
+    def check(self, frame):
+        """Return whether detector should run on BGR frame
+
+        """
+        if self._size is None:
+            self._allocate(frame.shape)
+        cv2.resize(frame, self._size, dst=self._small,
+                   interpolation=cv2.INTER_NEAREST)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+
+        return self._check_gray()
+
+    def check_jpeg(self, jpeg):
+        """Return whether detector should run on JPEG frame
+
+        Uses libjpeg's reduced-size grayscale decode so the full frame
+        never has to be decoded for frames that get skipped.
+
+        """
+        data = np.frombuffer(jpeg, dtype=np.uint8)
+        reduced = cv2.imdecode(data, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if self._size is None:
+            self._allocate(reduced.shape)
+        cv2.resize(reduced, self._size, dst=self._gray,
+                   interpolation=cv2.INTER_AREA)
+
+        return self._check_gray()
+
+    def _check_gray(self):
+        self.frames_checked += 1
+        cv2.GaussianBlur(self._gray, (5, 5), 0, dst=self._gray)
+
+        if self._background is None:
+            self._background = self._gray.astype(np.float32)
+            return self._pass()
+
+        cv2.convertScaleAbs(self._background, dst=self._background_u8)
+        cv2.absdiff(self._gray, self._background_u8, dst=self._diff)
+        cv2.threshold(self._diff, self.pixel_threshold, 255,
+                      cv2.THRESH_BINARY, dst=self._diff)
+        changed = cv2.countNonZero(self._diff) / self._diff.size
+        cv2.accumulateWeighted(self._gray, self._background,
+                               self.background_rate)
+
+        if (changed >= self.min_changed
+                or self.holding
+                or self._since_inference + 1 >= self.force_every):
+            return self._pass()
+
+        self._since_inference += 1
+        self.frames_skipped += 1
+        return False
+
+    def _pass(self):
+        self._since_inference = 0
+        return True
+
+    def notify_result(self, num_boxes):
+        """Tell gate how many boxes the detector found on last frame
+
+        Frames keep being let through while the detector is finding
+        boxes so that an animal that stops moving isn't dropped.
+
+        """
+        self.holding = num_boxes > 0
@@ -5,21 +5,47 @@ for communications.  This module contains the pieces associated with
 that. In particular, if a ScrubCam is associated with a ScrubHub it is
 on the same TCP/IP network with it.
 
+Cameras and hubs talk the versioned binary protocol defined in
+scrubcam.protocol.
+
 """
 
-import logging
 import io
+import logging
+import random
 import time
 import socket
-import struct
-import pickle
+import threading
+from collections import deque
 from threading import Thread
 
 import cv2
 import numpy as np
 
+from scrubcam import protocol
+from scrubcam.metrics import REGISTRY
+from scrubcam.pipeline import POLL_INTERVAL
+from scrubcam.spool import Spool
+
 log = logging.getLogger(__name__)
 
+BYTES_SENT = REGISTRY.counter('scrubcam_bytes_sent_total',
+                              'Bytes sent to the remote server')
+IMAGES_SENT = REGISTRY.counter('scrubcam_images_sent_total',
+                               'Images sent to the remote server')
+SOCKET_CONNECTS = REGISTRY.counter('scrubcam_socket_connects_total',
+                                   'Connections made to the remote server '
+                                   '(any beyond the first are reconnects)')
+
+# messages waiting to be sent by a BackgroundSender, control (config
+# and heartbeat) ahead of image
+CONTROL = 'control'
+IMAGE = 'image'
+CONFIG = 'config'
+HEARTBEAT = 'heartbeat'
+# heartbeats and configs kept at most (oldest dropped beyond)
+CONTROL_QUEUE_SIZE = 8
+
 
 def create_image_dict():
     """Creates the image dictionary 
@@ -29,7 +55,131 @@ def create_image_dict():
     of the program.
 
     """
-    return {'img': None, 'lboxes': None}
+    return ImageDict(img=None, lboxes=None, timestamp=None)
+
+
+class ImageDict(dict):
+    """Image dictionary that decodes a received image on first access
+
+    A ServerSocketHandler puts a DeferredImage under 'img', which is
+    swapped for its decoded pixels when 'img' is first looked up, so
+    images replaced by a newer one before anything looks at them are
+    never decoded. Lookups and replacements take turns, so an image is
+    either decoded before a newer one replaces it or not at all, and a
+    reader never sees one released from under it.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = super().__getitem__(key)
+            if isinstance(value, DeferredImage):
+                value = value.decode()
+                super().__setitem__(key, value)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            previous = super().get(key)
+            super().__setitem__(key, value)
+        if isinstance(previous, DeferredImage) and previous is not value:
+            # replaced before anything looked at it
+            previous.release()
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
+class BufferPool():
+    """Reusable receive buffers
+
+    A buffer too small for what is to be received is replaced by a
+    bigger one rather than resized (a bytearray can't be while a view
+    of it exists).
+
+    """
+
+    def __init__(self, size=1 << 20):
+        self.size = size
+        self.allocated = 0
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        """Return a bytearray of at least size bytes
+
+        """
+        with self._lock:
+            while self._free:
+                buffer = self._free.pop()
+                if len(buffer) >= size:
+                    return buffer
+            self.size = max(self.size, size)
+            self.allocated += 1
+            return bytearray(self.size)
+
+    def release(self, buffer):
+        """Return a buffer to the pool for reuse
+
+        """
+        with self._lock:
+            self._free.append(buffer)
+
+
+class DeferredImage():
+    """JPEG received into a pooled buffer, decoded only when needed
+
+    """
+
+    def __init__(self, buffer, length, pool):
+        self.length = length
+        self._buffer = buffer
+        self._pool = pool
+        self._pixels = None
+        self._lock = threading.Lock()
+
+    def decode(self):
+        """Return decoded image (None if released before decoding)
+
+        The buffer goes back to the pool once decoded.
+
+        """
+        with self._lock:
+            if self._pixels is None and self._buffer is not None:
+                data = np.frombuffer(self._buffer, np.uint8, self.length)
+                self._pixels = cv2.imdecode(data, 1)
+                del data
+                self._pool.release(self._buffer)
+                self._buffer = None
+            return self._pixels
+
+    def release(self):
+        """Give the buffer back to the pool
+
+        """
+        with self._lock:
+            if self._buffer is not None:
+                self._pool.release(self._buffer)
+                self._buffer = None
+
+
+def recv_exactly_into(sock, view):
+    """Fill memoryview view from sock (False if it closes first)
+
+    """
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            return False
+        received += count
+    return True
 
 
 class ServerSocketHandler(Thread):
@@ -43,218 +193,272 @@ class ServerSocketHandler(Thread):
         self.sock = socket.socket()
         self.sock.bind(address)
         self.sock.listen()
+        self.address = self.sock.getsockname()
 
         # command to send image no matter what. so far no real control
         # of this is implemented as evidenced in its here being just set
         self.command = 0
 
+        # what the connected camera has told us about itself
+        self.config = None
+        self.last_heartbeat = None
+        self.messages_received = 0
+
+        # messages are received into these rather than new bytes
+        self.pool = BufferPool()
+        self._header = bytearray(protocol.HEADER.size)
+        self._meta = bytearray(4096)
+
     def run(self):
         while True:
             log.info('Waiting for client connection.')
             connection, address = self.sock.accept()
-            stream = connection.makefile('rwb')
             log.info('Connection made to {}'.format(address))
 
             if self.stop_flag():
                 break
 
-            while True:
-                # write command to connection
-                stream.write(struct.pack('<L', self.command))
-                stream.flush()
+            try:
+                self._send_command(connection)
+                self._serve(connection)
+            except ValueError as e:
+                log.error('Closing connection to %s: %s', address, e)
+            except ConnectionResetError:
+                # cameras that never read the command reset on closing
+                log.info('Connection to %s closed.', address)
+            except OSError:
+                log.exception('Connection to %s failed.', address)
 
-                # read the message type
-                data = stream.read(struct.calcsize('<L'))
-                if not data:
-                    break
-                msg_type = struct.unpack('<L', data)[0]
-
-                # execute appropriate reads based off message type
-                if msg_type == 0:  # no image
-                    pass
-                elif msg_type == 1:  # image without box
-                    ok = self._read_image_data(stream)
-                    if not ok:
-                        break
-                elif msg_type == 2:  # image with boxes
-                    log.info('Receiving image with boxes.')
-                    ok = self._read_box(stream)
-                    if not ok:
-                        log.error('Trouble reading boxes')
-                        break
-
-                    ok = self._read_image_data(stream)
-                    if not ok:
-                        log.error('trouble reading image')
-                        break
-
-            stream.close()
+            connection.close()
 
         self.sock.close()
 
-    def _read_box(self, stream):
-        """Read the labeled bounding box info
+    def _send_command(self, connection):
+        connection.sendall(protocol.pack_header(
+            protocol.COMMAND, 0, time.time(),
+            meta_length=protocol.COMMAND_FORMAT.size)
+            + protocol.COMMAND_FORMAT.pack(self.command))
 
-        """
-        data = stream.read(struct.calcsize('<L'))
-        if not data:
-            return False
-        size = struct.unpack('<L', data)[0]
-        log.debug(f'length of data told {size}.')
-
-        data = stream.read(size)
-        log.debug(f'length of data received {len(data)}.')
-        if not data:
-            return False
-        self.image['lboxes'] = pickle.loads(data)
+    def _serve(self, connection):
+        """Handle messages from a connected camera until it disconnects
 
-        return True
+        """
+        class_table = None
+        header = memoryview(self._header)
+        while True:
+            if not recv_exactly_into(connection, header):
+                break
+            (msg_type, _, timestamp,
+             meta_length, payload_length) = protocol.unpack_header(header)
 
-    def _read_image_data(self, stream):
-        """Extract the actual image from the data stream
+            if meta_length > len(self._meta):
+                self._meta = bytearray(meta_length)
+            meta = memoryview(self._meta)[:meta_length]
+            if not recv_exactly_into(connection, meta):
+                break
+            payload = None
+            if payload_length:
+                buffer = self.pool.acquire(payload_length)
+                payload = DeferredImage(buffer, payload_length, self.pool)
+                view = memoryview(buffer)[:payload_length]
+                if not recv_exactly_into(connection, view):
+                    payload.release()
+                    break
+            self.messages_received += 1
+
+            if msg_type == protocol.IMAGE:
+                log.info('Receiving image with boxes.')
+                detections = protocol.unpack_detections(meta, class_table)
+                self._read_image_data(timestamp, detections, payload)
+                continue
+            if msg_type == protocol.CLASS_TABLE:
+                class_table = protocol.unpack_class_table(meta)
+            elif msg_type == protocol.CONFIG:
+                self.config = protocol.unpack_config(meta)
+                log.info('Camera config: %s', self.config)
+            elif msg_type == protocol.HEARTBEAT:
+                self.last_heartbeat = timestamp
+            elif msg_type != protocol.NO_IMAGE:
+                log.warning('Ignoring message of type %d from camera.',
+                            msg_type)
+            if payload is not None:
+                payload.release()
+
+    def _read_image_data(self, timestamp, detections, payload):
+        """Hand the image of an IMAGE message to the viewer
+
+        The image is decoded when the viewer looks at it (see
+        ImageDict). Its buffer goes back to the pool once decoded or
+        once a newer image replaces it.
 
         """
-        
-        data = stream.read(struct.calcsize('<L'))
-        if not data:
-            return False
-        image_len = struct.unpack('<L', data)[0]
-        image_stream = io.BytesIO()
-        image_stream.write(stream.read(image_len))
-        image_stream.seek(0)
-        data = np.fromstring(image_stream.getvalue(), dtype=np.uint8)
-        self.image['img'] = cv2.imdecode(data, 1)
-
-        return True
+        if len(detections) > 0:
+            self.image['lboxes'] = detections.to_lboxes()
+        else:
+            self.image['lboxes'] = None
+        self.image['timestamp'] = timestamp
+        if payload is None:
+            self.image['img'] = None
+            return
+        if isinstance(self.image, ImageDict):
+            self.image['img'] = payload
+        else:
+            self.image['img'] = payload.decode()
 
 
 class ClientSocketHandler():
 
-    def __init__(self, configs):
+    def __init__(self, configs, connect=True):
         self.CONFIG_FILE = configs
-        REMOTE_SERVER_IP = configs['REMOTE_SERVER_IP']
-        PORT = configs['REMOTE_SERVER_PORT']
+        self.address = (configs['REMOTE_SERVER_IP'],
+                        configs['REMOTE_SERVER_PORT'])
+        self.timeout = configs.get('REMOTE_SERVER_TIMEOUT', 10)
+        self.sock = None
+        self.socket_stream = None
+        self.LAST_ALERT_TIME = None
 
-        strg = 'Attempting to connect to server at: {} {}'
-        strg = strg.format(REMOTE_SERVER_IP,
-                           PORT)
-        log.info(strg)
+        self.sequence = 0
+        self._class_table = None
 
-        self.sock = socket.socket()
-        self.sock.connect((REMOTE_SERVER_IP, PORT))
-        self.socket_stream = self.sock.makefile('rwb')
-        self.LAST_ALERT_TIME = None
+        if connect:
+            self.connect()
 
-    def send_no_image(self):
-        """Send a message with no image
+    @property
+    def connected(self):
+        return self.sock is not None
 
-        """
-        self.socket_stream.write(struct.pack('<L', 0))
-        self.socket_stream.flush()
+    def connect(self):
+        """(Re)connect to the server
 
-    def send_image(self, image_stream):
-        """Send an image across the socket
+        Raises OSError if the server can't be reached.
 
         """
-        self.socket_stream.write(struct.pack('<L', 1))
-        self.socket_stream.flush()
+        self.disconnect()
 
-        self._send_image_data(image_stream)
+        strg = 'Attempting to connect to server at: {} {}'
+        strg = strg.format(*self.address)
+        log.info(strg)
 
-    # def send_image_and_box(self, image_stream, box):
-    #     self.socket_stream.write(struct.pack('<L', 2))
-    #     self.socket_stream.flush()
+        self.sock = socket.create_connection(self.address, self.timeout)
+        SOCKET_CONNECTS.inc()
+        self.socket_stream = self.sock.makefile('rwb')
 
-    #     self._send_object(box)
-    #     self._send_image_data(image_stream)
+        # a new connection starts a new sequence and class table
+        self.sequence = 0
+        self._class_table = None
 
-    def send_image_and_boxes(self, image_stream, boxes):
-        # send header
-        header = "IMAGE"
-        self._send_non_image_data(header)
-        # send lboxes and image
-        self._send_non_image_data(boxes)
-        self._send_image_data(image_stream)
+    def disconnect(self):
+        """Close the connection to the server, if there is one
 
-    def _send_image_data(self, image_stream):
-        # send size of data in image image_stream
-        image_stream.seek(0, 2)
-        self.socket_stream.write(struct.pack('<L', image_stream.tell()))
-        self.socket_stream.flush()
-        # send image data
-        image_stream.seek(0)
-        self.socket_stream.write(image_stream.read())
-        self.socket_stream.flush()
+        """
+        if self.sock is None:
+            return
+        try:
+            self.socket_stream.close()
+        except OSError:
+            # unsent data on a broken connection
+            pass
+        self.sock.close()
+        self.sock = None
+        self.socket_stream = None
 
-    def _send_non_image_data(self, a_object):
-        data = pickle.dumps(a_object)
-        size = len(data)
+    def _send(self, msg_type, timestamp=None, meta=b'', payload=b''):
+        """Write a message as a single flush of header, meta and payload
 
-        # send data size
-        self.socket_stream.write(struct.pack('<L', size))
-        self.socket_stream.flush()
-        # send data
-        self.socket_stream.write(data)
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        header = protocol.pack_header(msg_type,
+                                      self.sequence,
+                                      timestamp,
+                                      len(meta),
+                                      len(payload))
+        self.socket_stream.write(header)
+        if meta:
+            self.socket_stream.write(meta)
+        if payload:
+            self.socket_stream.write(payload)
         self.socket_stream.flush()
+        self.sequence += 1
+        BYTES_SENT.inc(len(header) + len(meta) + len(payload))
 
-    def recv_command(self):
-        message = self.socket_stream.read(struct.calcsize('<L'))
-        if not message:
-            return None
-        command = struct.unpack('<L', message)[0]
-        return command
+    def send_no_image(self):
+        """Send a message with no image
 
-    def send_image_classes(self, filter_classes):
-        # send header
-        header = "CLASSES"
-        self._send_non_image_data(header)
+        """
+        self._send(protocol.NO_IMAGE)
 
-        # send image classes list
-        self._send_non_image_data(filter_classes)
+    def send_image(self, image_stream, timestamp=None):
+        """Send an image across the socket
 
-        log.info('Classes sent to Scrubdash')
+        """
+        self._send_image_data(image_stream, b'', timestamp)
 
-    def send_hostname(self):
-        # send header
-        header = "HOSTNAME"
-        self._send_non_image_data(header)
+    def send_image_and_boxes(self, image_stream, boxes, timestamp=None):
+        """Send an image and its boxes (Detections or lbox dicts)
 
-        # send hostname
-        hostname = socket.gethostname()
-        self._send_non_image_data(hostname)
+        timestamp is the capture time (default now).
 
-    def send_continue_run(self, continue_run):
-        # send header
-        header = "CONTINUE_RUN"
-        self._send_non_image_data(header)
+        """
+        detections = protocol.as_detections(boxes)
+        self._send_class_table(detections.class_table)
+        self._send_image_data(image_stream,
+                              protocol.pack_detections(detections),
+                              timestamp)
 
-        # send continue run flag
-        self._send_non_image_data(continue_run)  
+    def _send_class_table(self, class_table):
+        """Send class table if boxes refer to a different one than last
 
-    def send_host_configs(self, filter_classes, continue_run):
-        # send header to alert asyncio server of config messages
-        header = "CONFIG"
-        self._send_non_image_data(header)
+        """
+        if class_table is None or class_table is self._class_table:
+            return
+        if (self._class_table is not None
+                and list(class_table) == list(self._class_table)):
+            return
+        self._send(protocol.CLASS_TABLE,
+                   meta=protocol.pack_class_table(class_table))
+        self._class_table = class_table
+
+    def _send_image_data(self, image_stream, meta, timestamp):
+        if hasattr(image_stream, 'getbuffer'):
+            # send from the BytesIO's own buffer rather than a copy
+            with image_stream.getbuffer() as data:
+                self._send(protocol.IMAGE, timestamp, meta, data)
+        else:
+            image_stream.seek(0)
+            self._send(protocol.IMAGE, timestamp, meta, image_stream.read())
+        IMAGES_SENT.inc()
 
-        # sending rest of configuration settings
-        self.send_hostname()
-        self.send_continue_run(continue_run)
-        self.send_image_classes(filter_classes)
+    def recv_command(self):
+        """Return next command sent by the server (None if it hung up)
 
-        # send header to alert asyncio server of finished configuration
-        header = "DONE"
-        self._send_non_image_data(header)
+        """
+        while True:
+            message = protocol.read_message(self.socket_stream)
+            if message is None:
+                return None
+            if message.type == protocol.COMMAND:
+                return protocol.COMMAND_FORMAT.unpack(message.meta)[0]
+
+    def send_host_configs(self, filter_classes, continue_run):
+        """Tell the server our hostname, continue run flag and classes
+
+        """
+        self._send(protocol.CONFIG,
+                   meta=protocol.pack_config(socket.gethostname(),
+                                             continue_run,
+                                             filter_classes))
+        log.info('Configs sent to Scrubdash')
 
     def _send_heartbeat(self, timestamp):
-        # send header
-        header = "CONNECTION"
-        self._send_non_image_data(header)
+        self._send(protocol.HEARTBEAT, timestamp)
 
-        # send timestamp
-        self._send_non_image_data(timestamp)
+    def heartbeat_due(self, now=None):
+        """Return whether 15s cooldown since last heartbeat has elapsed
 
-    def send_heartbeat_every_15s(self):
-        now = time.time()
+        """
+        if now is None:
+            now = time.time()
 
         # check if cooldown time has elapsed since most recent alert
         if self.LAST_ALERT_TIME is None:
@@ -269,15 +473,308 @@ class ClientSocketHandler():
             else:
                 cooldown_elapsed = False
 
+        return cooldown_elapsed
+
+    def send_heartbeat_every_15s(self):
+        now = time.time()
+
         # send heartbeat if cooldown time has elapsed
-        if cooldown_elapsed:
+        if self.heartbeat_due(now):
             self._send_heartbeat(now)
             self.LAST_ALERT_TIME = now
 
     def close(self):
         log.info('Cleaning up SocketHandler')
-        self.socket_stream.close()
-        self.sock.close()
+        self.disconnect()
+
+
+class SendQueue():
+    """Outbound messages, control messages ahead of images
+
+    Both kinds are kept in order and bounded; when full the oldest of
+    the kind is dropped to make room.
+
+    """
+
+    def __init__(self, image_size, control_size=CONTROL_QUEUE_SIZE):
+        self._queues = {CONTROL: deque(), IMAGE: deque()}
+        self._sizes = {CONTROL: control_size, IMAGE: image_size}
+        self.dropped = {CONTROL: 0, IMAGE: 0}
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def put(self, kind, item):
+        """Queue item as CONTROL or IMAGE message
+
+        Returns dropped item, if any.
+
+        """
+        dropped = None
+        with self._not_empty:
+            queue = self._queues[kind]
+            if len(queue) >= self._sizes[kind]:
+                dropped = queue.popleft()
+                self.dropped[kind] += 1
+            queue.append(item)
+            self._not_empty.notify()
+
+        return dropped
+
+    def get(self, timeout=None):
+        """Remove and return next item, or None if timeout expires
+
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(
+                    lambda: any(self._queues.values()), timeout):
+                return None
+            if self._queues[CONTROL]:
+                return self._queues[CONTROL].popleft()
+            return self._queues[IMAGE].popleft()
+
+
+class BackgroundSender(Thread):
+    """Sends a ClientSocketHandler's messages from a background thread
+
+    Has the same sending methods as ClientSocketHandler but they only
+    queue the message, so the caller never waits on the network.
+    Heartbeats and configs go ahead of images.
+
+    The connection is made (and, when lost, remade) by the sender
+    thread, waiting exponentially longer (with jitter) between failed
+    attempts. While there is no connection, images with boxes go to an
+    on-disk Spool (see scrubcam.spool), which is drained at a limited
+    rate once the connection is back. The last config is sent again
+    on every new connection. Configured by:
+
+    SEND_QUEUE_SIZE: images waiting to be sent at most (the oldest is
+        dropped to make room for a new one)
+    RECONNECT_MIN_DELAY: seconds before the first reconnect attempt
+    RECONNECT_MAX_DELAY: most seconds between reconnect attempts
+    SPOOL_ON: spool images while there is no connection
+    SPOOL_DRAIN_RATE: spooled images sent per second at most once
+        reconnected (0 for no limit)
+
+    """
+
+    def __init__(self, socket_handler, configs):
+        super().__init__(name='background-sender', daemon=True)
+        self.socket_handler = socket_handler
+        self.queue = SendQueue(configs.get('SEND_QUEUE_SIZE', 16))
+        self.min_delay = configs.get('RECONNECT_MIN_DELAY', 1)
+        self.max_delay = configs.get('RECONNECT_MAX_DELAY', 300)
+        self.drain_rate = configs.get('SPOOL_DRAIN_RATE', 2)
+        if configs.get('SPOOL_ON', True):
+            self.spool = Spool.from_configs(configs)
+        else:
+            self.spool = None
+
+        self.sent = 0
+        self.failed = 0
+        self._config = None
+        self._attempts = 0
+        self._next_connect = 0.0
+        self._next_drain = 0.0
+        self._stopped = False
+        # set by close() when it gives up waiting, after which the
+        # thread spools rather than sends and closes up when it ends
+        self._gave_up = False
+        self._finished = False
+        self._close_lock = threading.Lock()
+
+        REGISTRY.gauge('scrubcam_send_queue_depth',
+                       'Messages waiting to be sent to the remote server',
+                       function=lambda: len(self.queue))
+        for kind in (CONTROL, IMAGE):
+            REGISTRY.counter('scrubcam_send_dropped_total',
+                             'Messages dropped from full send queue',
+                             {'kind': kind},
+                             function=lambda kind=kind:
+                             self.queue.dropped[kind])
+        REGISTRY.counter('scrubcam_send_failed_total',
+                         'Messages that failed to be sent',
+                         function=lambda: self.failed)
+        if self.spool is not None:
+            REGISTRY.gauge('scrubcam_spool_messages',
+                           'Images spooled waiting for a connection',
+                           function=lambda: len(self.spool))
+            REGISTRY.gauge('scrubcam_spool_bytes',
+                           'Bytes of spooled images on disk',
+                           function=lambda: self.spool.size)
+            REGISTRY.counter('scrubcam_spool_evicted_total',
+                             'Spooled images deleted to stay within size',
+                             function=lambda: self.spool.evicted)
+
+    @property
+    def queue_depth(self):
+        """Number of messages waiting to be sent
+
+        """
+        return len(self.queue)
+
+    @property
+    def dropped(self):
+        """Number of messages dropped from the full queue
+
+        """
+        return sum(self.queue.dropped.values())
+
+    def _put(self, kind, message, *args):
+        if self.queue.put(kind, (message, args)) is not None:
+            log.debug('Send queue full, dropped oldest %s message.', kind)
+
+    def send_image_and_boxes(self, image_stream, boxes, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._put(IMAGE, IMAGE, image_stream, boxes, timestamp)
+
+    def send_host_configs(self, filter_classes, continue_run):
+        self._put(CONTROL, CONFIG, filter_classes, continue_run)
+
+    def heartbeat_due(self, now=None):
+        return self.socket_handler.heartbeat_due(now)
+
+    def send_heartbeat_every_15s(self):
+        now = time.time()
+        if self.heartbeat_due(now):
+            self.socket_handler.LAST_ALERT_TIME = now
+            self._put(CONTROL, HEARTBEAT, now)
+
+    def _send(self, message, args):
+        if message == IMAGE:
+            self.socket_handler.send_image_and_boxes(*args)
+        elif message == CONFIG:
+            self.socket_handler.send_host_configs(*args)
+        elif message == HEARTBEAT:
+            self.socket_handler._send_heartbeat(*args)
+
+    def _handle(self, message, args):
+        """Send a message, or hold on to it if there is no connection
+
+        """
+        if message == CONFIG:
+            self._config = args
+        if not self.socket_handler.connected or self._gave_up:
+            self._hold(message, args)
+            return
+
+        try:
+            self._send(message, args)
+            self.sent += 1
+        except OSError as e:
+            log.warning('Lost connection to server: %s', e)
+            self.failed += 1
+            self.socket_handler.disconnect()
+            self._schedule_connect()
+            self._hold(message, args)
+
+    def _hold(self, message, args):
+        """Spool an image that can't be sent (others are dropped)
+
+        Configs are sent on the next connection and heartbeats are
+        out of date by then.
+
+        """
+        if message != IMAGE or self.spool is None:
+            return
+        image_stream, boxes, timestamp = args
+        if hasattr(image_stream, 'getvalue'):
+            jpeg = image_stream.getvalue()
+        else:
+            image_stream.seek(0)
+            jpeg = image_stream.read()
+        try:
+            self.spool.put(jpeg, protocol.as_detections(boxes), timestamp)
+        except OSError:
+            log.exception('Could not spool image.')
+
+    def _schedule_connect(self):
+        """Set time of next connection attempt (exponential backoff)
+
+        """
+        delay = min(self.max_delay, self.min_delay * 2 ** self._attempts)
+        # jitter so a fleet of cameras doesn't reconnect in lockstep
+        delay = random.uniform(delay / 2, delay)
+        self._attempts += 1
+        self._next_connect = time.time() + delay
+        log.info('Reconnecting to server in %.1f s.', delay)
+
+    def _connect(self):
+        try:
+            self.socket_handler.connect()
+        except OSError as e:
+            log.warning('Could not connect to server: %s', e)
+            self._schedule_connect()
+            return
+        if self._attempts:
+            log.info('Reconnected to server after %d attempts.',
+                     self._attempts)
+        self._attempts = 0
+        if self._config is not None:
+            self._handle(CONFIG, self._config)
+
+    def _drain(self):
+        """Send a spooled image if the drain rate allows
+
+        """
+        if self.spool is None or not len(self.spool):
+            return
+        now = time.time()
+        if now < self._next_drain:
+            return
+        spooled = self.spool.get()
+        if spooled is None:
+            return
+        jpeg, detections, timestamp = spooled
+        self._handle(IMAGE, (io.BytesIO(jpeg), detections, timestamp))
+        if self.drain_rate > 0:
+            self._next_drain = now + 1 / self.drain_rate
+
+    def run(self):
+        try:
+            while not (self._stopped and self.queue_depth == 0):
+                if (not self.socket_handler.connected
+                        and not self._stopped
+                        and time.time() >= self._next_connect):
+                    self._connect()
+                item = self.queue.get(timeout=POLL_INTERVAL)
+                if item is not None:
+                    self._handle(*item)
+                if self.socket_handler.connected and not self._stopped:
+                    self._drain()
+        finally:
+            with self._close_lock:
+                self._finished = True
+                if self._gave_up:
+                    self._shutdown()
+
+    def _shutdown(self):
+        self.socket_handler.close()
+        if self.spool is not None:
+            self.spool.close()
+
+    def close(self, timeout=5):
+        """Send (or spool) what is queued, waiting up to timeout
+
+        If the sender is still busy after timeout (e.g. stuck sending
+        on a poor link) what is left is spooled and the sender closes
+        the connection and spool itself once done, so they aren't
+        closed under it.
+
+        """
+        self._stopped = True
+        self.join(timeout)
+        with self._close_lock:
+            if self.is_alive() and not self._finished:
+                log.warning('Sender still busy after %.1f s, leaving it '
+                            'to spool what is left and close up.', timeout)
+                self._gave_up = True
+                return
+        self._shutdown()
 
 
 # class CommandsSocketHandler():
@@ -0,0 +1,335 @@
+"""Staged pipeline for running the ScrubCam main loop
+
+Rather than one serial loop that captures a frame, runs inference on
+it and then performs every side effect (display, network, recording,
+LoRa) before capturing the next one, the work is split into stages
+that each run in their own thread. Stages are connected by bounded
+queues so that a slow stage (e.g. a disk write or a network send on a
+poor link) only holds up itself rather than the camera, and overall
+throughput is limited by the slowest stage instead of the sum of all
+of them.
+
+Each queue has a policy for when it is full:
+
+- drop_oldest: the oldest waiting item is discarded to make room
+- block: the upstream stage waits until there is room
+
+"""
+import logging
+import time
+import threading
+from collections import deque
+from threading import Thread
+
+from scrubcam.metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, BLOCK)
+
+# seconds to wait on a queue before checking whether to stop
+POLL_INTERVAL = .1
+
+
+def create_frame_packet(frame=None, jpeg=None):
+    """Creates the dictionary that carries a frame through the pipeline
+
+    A frame comes into the pipeline either decoded (frame) or as
+    captured JPEG bytes (jpeg). Stages add their results to it as it
+    passes through.
+
+    """
+    return {'frame': frame,
+            'jpeg': jpeg,
+            'timestamp': time.time(),
+            'lboxes': None,
+            'species': None,
+            'seen': False,
+            'wanted': False}
+
+
+class BoundedQueue():
+    """Thread-safe FIFO queue with a maximum size and a full policy
+
+    """
+
+    def __init__(self, maxsize, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown queue policy: {policy}')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def put(self, item, timeout=None):
+        """Put item on the queue
+
+        Returns False if the queue has block policy and there was
+        still no room after timeout seconds, otherwise True.
+
+        """
+        with self._not_full:
+            if len(self._items) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    has_room = self._not_full.wait_for(
+                        lambda: len(self._items) < self.maxsize,
+                        timeout)
+                    if not has_room:
+                        return False
+            self._items.append(item)
+            self._not_empty.notify()
+
+        return True
+
+    def get(self, timeout=None):
+        """Remove and return next item, or None if timeout expires
+
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._items, timeout):
+                return None
+            item = self._items.popleft()
+            self._not_full.notify()
+
+        return item
+
+
+class _BaseStage(Thread):
+    """Functionality shared by all stages
+
+    """
+
+    def __init__(self, name, stop_flag):
+        super().__init__(name=name, daemon=True)
+        self.stop_flag = stop_flag
+        self.outboxes = []
+        self.processed = 0
+        self.busy_time = 0.0
+
+    def _emit(self, item):
+        """Pass item on to each outbox whose condition it meets
+
+        """
+        for queue, when in self.outboxes:
+            if when is not None and not when(item):
+                continue
+            while not queue.put(item, timeout=POLL_INTERVAL):
+                if self.stop_flag():
+                    return
+
+
+class SourceStage(_BaseStage):
+    """Stage that feeds items from an iterable into the pipeline
+
+    Typically wraps a generator of frame packets from the camera.
+
+    """
+
+    def __init__(self, name, source, stop_flag):
+        super().__init__(name, stop_flag)
+        self.source = source
+
+    def run(self):
+        try:
+            for item in self.source:
+                if self.stop_flag():
+                    break
+                self.processed += 1
+                self._emit(item)
+        except Exception:
+            log.exception('Exception in %s stage.', self.name)
+        log.info('%s stage finished.', self.name)
+
+
+class Stage(_BaseStage):
+    """Stage that handles items taken off of its inbox queue
+
+    Whatever the handler returns (if not None) is passed on to the
+    stage's outboxes.
+
+    """
+
+    def __init__(self, name, handler, inbox, stop_flag):
+        super().__init__(name, stop_flag)
+        self.handler = handler
+        self.inbox = inbox
+        self.busy = False
+
+    def run(self):
+        while not self.stop_flag():
+            item = self.inbox.get(timeout=POLL_INTERVAL)
+            if item is None:
+                continue
+
+            self.busy = True
+            start = time.perf_counter()
+            try:
+                result = self.handler(item)
+            except Exception:
+                log.exception('Exception in %s stage.', self.name)
+                result = None
+            else:
+                self.busy_time += time.perf_counter() - start
+                self.processed += 1
+
+            if result is not None:
+                self._emit(result)
+            self.busy = False
+
+
+class Pipeline():
+    """Set of stages and the queues connecting them
+
+    Queue sizes and policies come from the configuration, with
+    optional per-stage overrides of the policy:
+
+    PIPELINE_QUEUE_SIZE: 4
+    PIPELINE_QUEUE_POLICY: drop_oldest
+    PIPELINE_STAGE_POLICIES: {record: block}
+
+    """
+
+    def __init__(self, configs):
+        self.queue_size = configs.get('PIPELINE_QUEUE_SIZE', 4)
+        self.default_policy = configs.get('PIPELINE_QUEUE_POLICY',
+                                          DROP_OLDEST)
+        self.stage_policies = configs.get('PIPELINE_STAGE_POLICIES') or {}
+        self.stages = []
+        self._stopped = False
+
+    def stop_flag(self):
+        """Return whether pipeline has been told to stop
+
+        """
+        return self._stopped
+
+    def add_source(self, name, source):
+        """Add a stage that feeds the pipeline from an iterable
+
+        """
+        stage = SourceStage(name, source, self.stop_flag)
+        self.stages.append(stage)
+        self._register_metrics(stage)
+        return stage
+
+    def add_stage(self, name, handler, policy=None):
+        """Add a stage that runs handler on each item it receives
+
+        A policy given here takes precedence over the configured one.
+
+        """
+        if policy is None:
+            policy = self.stage_policies.get(name, self.default_policy)
+        inbox = BoundedQueue(self.queue_size, policy)
+        stage = Stage(name, handler, inbox, self.stop_flag)
+        self.stages.append(stage)
+        self._register_metrics(stage)
+        return stage
+
+    @staticmethod
+    def _register_metrics(stage):
+        """Expose stage's counters as metrics
+
+        The values are only read when the metrics are rendered.
+
+        """
+        labels = {'stage': stage.name}
+        REGISTRY.counter('scrubcam_stage_processed_total',
+                         'Items handled by pipeline stage (frames '
+                         'captured for the capture stage)',
+                         labels,
+                         function=lambda: stage.processed)
+        REGISTRY.counter('scrubcam_stage_busy_seconds_total',
+                         'Time pipeline stage spent handling items',
+                         labels,
+                         function=lambda: stage.busy_time)
+        if isinstance(stage, Stage):
+            REGISTRY.gauge('scrubcam_stage_queue_depth',
+                           'Items waiting in pipeline stage inbox',
+                           labels,
+                           function=lambda: len(stage.inbox))
+            REGISTRY.counter('scrubcam_stage_dropped_total',
+                             'Items dropped from full pipeline stage inbox',
+                             labels,
+                             function=lambda: stage.inbox.dropped)
+
+    @staticmethod
+    def connect(source, destination, when=None):
+        """Send output of source stage to destination stage
+
+        If when is given it is called with each item and the item is
+        only passed on if it returns True.
+
+        """
+        source.outboxes.append((destination.inbox, when))
+
+    def start(self):
+        """Start all the stages
+
+        """
+        for stage in self.stages:
+            stage.start()
+
+    def is_alive(self):
+        """Return whether every stage is still running
+
+        """
+        return all(stage.is_alive() for stage in self.stages)
+
+    def drain(self, timeout=10):
+        """Wait (up to timeout) for all queued items to be handled
+
+        Returns whether the pipeline emptied in time.
+
+        """
+        end = time.time() + timeout
+        idle_checks = 0
+        while time.time() < end:
+            if any(isinstance(stage, Stage)
+                   and (stage.busy or len(stage.inbox) > 0)
+                   for stage in self.stages):
+                idle_checks = 0
+            else:
+                # twice in a row to not catch an item between a stage
+                # taking it off its queue and starting on it
+                idle_checks += 1
+                if idle_checks >= 2:
+                    return True
+            time.sleep(POLL_INTERVAL)
+
+        return False
+
+    def stop(self, timeout=2):
+        """Stop all the stages and wait (up to timeout each) for them
+
+        """
+        self._stopped = True
+        for stage in self.stages:
+            stage.join(timeout)
+
+    def report(self):
+        """Log throughput and queue state of each stage
+
+        """
+        for stage in self.stages:
+            strg = f'{stage.name}: {stage.processed} processed'
+            if isinstance(stage, Stage):
+                if stage.processed:
+                    mean_ms = 1000 * stage.busy_time / stage.processed
+                    strg += f', {mean_ms:.1f} ms mean'
+                strg += (f', queue {len(stage.inbox)}/{stage.inbox.maxsize}'
+                         f', {stage.inbox.dropped} dropped')
+            log.info(strg)
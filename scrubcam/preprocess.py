@@ -0,0 +1,108 @@
+"""Preparing frames as model input without per-frame allocations
+
+Every frame (or tile, or crop) that goes through a network has to be
+resized to the network's input size and converted from OpenCV's BGR
+to RGB. Done the obvious way that allocates a couple of fresh arrays
+per frame, which on a 1080p stream is a noticeable share of the
+per-frame time and makes for garbage collection jitter. The
+Preprocessor here does both into one buffer allocated up front and
+keeps what's needed to map boxes found on the model input back to the
+frame they came from.
+
+"""
+import numpy as np
+import cv2
+
+
+class Preprocessor():
+    """Resizes (optionally letterboxing) frames into a model input buffer
+
+    In letterbox mode frames are scaled to fit the input keeping their
+    aspect ratio and centred with the rest filled with pad_value,
+    otherwise they are stretched to the input size. After prepare(),
+    scale and offset describe where the frame ended up in the input:
+    input = frame * scale + offset (per axis, x then y).
+
+    """
+
+    def __init__(self, input_size, letterbox=True, pad_value=0):
+        self.input_width, self.input_height = input_size
+        self.letterbox = letterbox
+        self.pad_value = pad_value
+        self.buffer = np.empty((self.input_height, self.input_width, 3),
+                               dtype=np.uint8)
+        self.scale = (1.0, 1.0)
+        self.offset = (0, 0)
+        self._geometry = {}
+        self._frame_shape = None
+        self._region = self.buffer
+
+    def _layout(self, frame_shape):
+        """Return scale, offset and resized size of frame in the input
+
+        """
+        frame_height, frame_width = frame_shape[:2]
+        if not self.letterbox:
+            scale = (self.input_width / frame_width,
+                     self.input_height / frame_height)
+            return scale, (0, 0), (self.input_width, self.input_height)
+
+        factor = min(self.input_width / frame_width,
+                     self.input_height / frame_height)
+        width = max(1, min(self.input_width, round(frame_width * factor)))
+        height = max(1, min(self.input_height, round(frame_height * factor)))
+        offset = ((self.input_width - width) // 2,
+                  (self.input_height - height) // 2)
+        return (factor, factor), offset, (width, height)
+
+    def prepare(self, frame):
+        """Resize and colour convert BGR frame into the input buffer
+
+        Returns the buffer (RGB, model input size). It is overwritten
+        by the next call.
+
+        """
+        shape = frame.shape[:2]
+        if shape != self._frame_shape:
+            if shape not in self._geometry:
+                self._geometry[shape] = self._layout(shape)
+            self.scale, self.offset, size = self._geometry[shape]
+            left, top = self.offset
+            width, height = size
+            # bars around a letterboxed frame are only filled when the
+            # layout changes since nothing else writes to them
+            self.buffer[:] = self.pad_value
+            self._region = self.buffer[top:top + height, left:left + width]
+            self._frame_shape = shape
+
+        cv2.resize(frame,
+                   self._region.shape[1::-1],
+                   dst=self._region,
+                   interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._region, cv2.COLOR_BGR2RGB, dst=self._region)
+
+        return self.buffer
+
+    def to_frame(self, boxes):
+        """Map (left, top, width, height) boxes from input to frame
+
+        boxes is an (N, 4) array and is updated in place (and
+        returned) using the scale and offset of the last prepare().
+
+        """
+        if len(boxes) == 0:
+            return boxes
+        scale = np.array(self.scale * 2, dtype=np.float32)
+        offset = np.array(self.offset + (0, 0), dtype=np.float32)
+        mapped = (boxes - offset) / scale
+        # clip the corners rather than left/top and width/height so
+        # boxes reaching into the letterbox bars end at the frame edge
+        mapped[:, 2:] += mapped[:, :2]
+        frame_height, frame_width = self._frame_shape
+        np.clip(mapped[:, 0::2], 0, frame_width, out=mapped[:, 0::2])
+        np.clip(mapped[:, 1::2], 0, frame_height, out=mapped[:, 1::2])
+        mapped[:, 2:] -= mapped[:, :2]
+        np.round(mapped, out=mapped)
+        boxes[:] = mapped
+
+        return boxes
@@ -0,0 +1,192 @@
+"""Wire protocol between ScrubCams and a ScrubHub
+
+Every message is a fixed size HEADER followed by two variable length
+parts, meta and payload:
+
+    magic       4s      b'SCRB'
+    version     uint8   VERSION
+    type        uint8   one of the message types below
+    flags       uint16  reserved (0)
+    sequence    uint32  per-connection message counter of the sender
+    timestamp   float64 capture (or send) time in seconds
+    meta_len    uint32  length of meta
+    payload_len uint32  length of payload
+
+All numbers are little-endian. Message types:
+
+- COMMAND (hub to camera): meta is the command as a uint32
+- NO_IMAGE: nothing but the header
+- IMAGE: meta is the image's boxes as DETECTION_RECORD records and
+  payload is the JPEG (boxes' class IDs refer to the last CLASS_TABLE)
+- CLASS_TABLE: meta is the class names, UTF-8, separated by newlines
+- CONFIG: meta is JSON with hostname, continue_run and classes
+- HEARTBEAT: nothing but the header, timestamp is when it was sent
+
+A receiver closes the connection on a bad magic or another version.
+
+"""
+import json
+import struct
+
+import numpy as np
+
+from scrubcam.detections import Detections
+
+MAGIC = b'SCRB'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHIdII')
+COMMAND_FORMAT = struct.Struct('<L')
+DETECTION_RECORD = np.dtype([('box', '<i4', (4,)),
+                             ('score', '<f4'),
+                             ('class_id', '<i2')])
+
+COMMAND = 0
+NO_IMAGE = 1
+IMAGE = 2
+CLASS_TABLE = 3
+CONFIG = 4
+HEARTBEAT = 5
+MESSAGE_TYPES = (COMMAND, NO_IMAGE, IMAGE, CLASS_TABLE, CONFIG, HEARTBEAT)
+
+
+class Message():
+    """A received message
+
+    """
+
+    def __init__(self, msg_type, sequence, timestamp, meta, payload):
+        self.type = msg_type
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.meta = meta
+        self.payload = payload
+
+
+def pack_header(msg_type, sequence, timestamp=0.0,
+                meta_length=0, payload_length=0):
+    """Return the header bytes for a message
+
+    """
+    return HEADER.pack(MAGIC, VERSION, msg_type, 0,
+                       sequence & 0xFFFFFFFF, timestamp,
+                       meta_length, payload_length)
+
+
+def unpack_header(data):
+    """Return (type, sequence, timestamp, meta length, payload length)
+
+    Raises ValueError if data isn't a header of this protocol version.
+
+    """
+    (magic, version, msg_type, _, sequence, timestamp,
+     meta_length, payload_length) = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ValueError(f'Bad message magic {magic!r}')
+    if version != VERSION:
+        raise ValueError(f'Unsupported protocol version {version} '
+                         f'(expected {VERSION})')
+    if msg_type not in MESSAGE_TYPES:
+        raise ValueError(f'Unknown message type {msg_type}')
+
+    return msg_type, sequence, timestamp, meta_length, payload_length
+
+
+def as_detections(lboxes):
+    """Return lboxes (Detections or list of lbox dicts) as Detections
+
+    lbox dicts without class IDs get them from a class table made of
+    their class names.
+
+    """
+    if isinstance(lboxes, Detections):
+        return lboxes
+    names = sorted({lbox['class_name'] for lbox in lboxes})
+    class_table = np.array(names, dtype=object)
+    return Detections.from_arrays(
+        [lbox['box'] for lbox in lboxes],
+        [lbox['confidence'] for lbox in lboxes],
+        [names.index(lbox['class_name']) for lbox in lboxes],
+        class_table)
+
+
+def pack_detections(detections):
+    """Return boxes of Detections packed as DETECTION_RECORDs
+
+    """
+    return detections.records.astype(DETECTION_RECORD).tobytes()
+
+
+def unpack_detections(meta, class_table=None):
+    """Return Detections of boxes packed by pack_detections
+
+    """
+    records = np.frombuffer(meta, dtype=DETECTION_RECORD)
+    return Detections(records.astype(Detections().records.dtype),
+                      class_table)
+
+
+def pack_class_table(class_table):
+    """Return class names packed for a CLASS_TABLE message
+
+    """
+    return '\n'.join(str(name) for name in class_table).encode('utf-8')
+
+
+def unpack_class_table(meta):
+    """Return class table (object array of names) of a CLASS_TABLE
+
+    """
+    names = bytes(meta).decode('utf-8').split('\n') if meta else []
+    return np.array(names, dtype=object)
+
+
+def pack_config(hostname, continue_run, classes):
+    """Return the meta of a CONFIG message
+
+    """
+    return json.dumps({'hostname': hostname,
+                       'continue_run': continue_run,
+                       'classes': list(classes or [])}).encode('utf-8')
+
+
+def unpack_config(meta):
+    """Return dict of hostname, continue_run and classes of a CONFIG
+
+    """
+    return json.loads(bytes(meta).decode('utf-8'))
+
+
+def _read_exactly(stream, size):
+    """Return size bytes read from stream (None if it ends first)
+
+    """
+    data = stream.read(size)
+    if data is None or len(data) < size:
+        return None
+    return data
+
+
+def read_message(stream):
+    """Return the next Message read from a binary stream
+
+    Returns None if the stream ends.
+
+    """
+    data = _read_exactly(stream, HEADER.size)
+    if data is None:
+        return None
+    (msg_type, sequence, timestamp,
+     meta_length, payload_length) = unpack_header(data)
+
+    meta = b''
+    if meta_length:
+        meta = _read_exactly(stream, meta_length)
+        if meta is None:
+            return None
+    payload = b''
+    if payload_length:
+        payload = _read_exactly(stream, payload_length)
+        if payload is None:
+            return None
+
+    return Message(msg_type, sequence, timestamp, meta, payload)
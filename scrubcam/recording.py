@@ -0,0 +1,281 @@
+"""Tools for writing recorded frames to disk
+
+Writing images to an SD card can take long enough to hold up the
+detection loop, especially during bursts of detections. The
+RecordWriter here does those writes on a pool of background threads
+fed by a bounded queue. Where the JPEG bytes the camera produced are
+still available they are written out as is rather than re-encoding
+the decoded frame.
+
+"""
+import logging
+import os
+import time
+import threading
+from collections import deque
+from threading import Thread
+
+import cv2
+
+from scrubcam.detection_index import DetectionIndex
+from scrubcam.detections_file import DAY, DetectionsFile, write_boxes_file
+from scrubcam.metrics import REGISTRY
+from scrubcam.pipeline import BoundedQueue, BLOCK, POLL_INTERVAL
+from scrubcam.storage import StorageManager, boxes_filename
+
+log = logging.getLogger(__name__)
+
+# number of recent writes used for latency statistics
+LATENCY_WINDOW = 100
+
+# ways of writing the boxes of recorded images
+FILE = 'file'
+CSV = 'csv'
+
+
+class RecordWriter():
+    """Writes recorded frames and their boxes files in the background
+
+    Configured by:
+
+    RECORD_WRITER_WORKERS: number of writer threads (0 writes
+        synchronously in the caller)
+    RECORD_WRITER_QUEUE_SIZE: maximum number of queued writes
+    RECORD_WRITER_QUEUE_POLICY: block or drop_oldest when queue full
+    RECORD_FSYNC_EVERY: fsync written files in batches of this many
+        (0 leaves flushing to the OS)
+    RECORD_INDEX_ON: add written images to the detection index (see
+        scrubcam.detection_index)
+    RECORD_BOXES_FORMAT: file (append boxes to one detections file per
+        RECORD_BOXES_FILE_PER day or session, see
+        scrubcam.detections_file) or csv (a boxes CSV per image)
+
+    If a STORAGE_QUOTA_BYTES or STORAGE_QUOTA_PERCENT is configured
+    written images are also reported to a StorageManager (see
+    scrubcam.storage) that keeps the folder within quota.
+
+    """
+
+    def __init__(self, configs):
+        self.record_folder = configs['RECORD_FOLDER']
+        self.num_workers = configs.get('RECORD_WRITER_WORKERS', 1)
+        self.fsync_every = configs.get('RECORD_FSYNC_EVERY', 0)
+        self.queue = BoundedQueue(configs.get('RECORD_WRITER_QUEUE_SIZE', 16),
+                                  configs.get('RECORD_WRITER_QUEUE_POLICY',
+                                              BLOCK))
+        boxes_format = configs.get('RECORD_BOXES_FORMAT', FILE)
+        if boxes_format not in (FILE, CSV):
+            raise ValueError(f'Unknown boxes format: {boxes_format}')
+        if boxes_format == FILE:
+            self.detections_file = DetectionsFile(
+                self.record_folder,
+                configs.get('RECORD_BOXES_FILE_PER', DAY))
+        else:
+            self.detections_file = None
+        if configs.get('RECORD_INDEX_ON', True):
+            self.index = DetectionIndex.from_configs(configs)
+        else:
+            self.index = None
+        if (configs.get('STORAGE_QUOTA_BYTES') is not None
+                or configs.get('STORAGE_QUOTA_PERCENT') is not None):
+            self.storage = StorageManager(configs, self.index)
+            self.storage.start()
+        else:
+            self.storage = None
+
+        self.writes = 0
+        self.failed_writes = 0
+        self.bytes_written = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.max_latency = 0.0
+
+        self._write_seconds = None
+
+        self._lock = threading.Lock()
+        self._unsynced = []
+        self._stopped = False
+        self._workers = []
+        for i in range(self.num_workers):
+            worker = Thread(target=self._work,
+                            name=f'record-writer-{i}',
+                            daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def register_metrics(self, labels=None):
+        """Expose writer's counters as metrics under labels
+
+        """
+        REGISTRY.gauge('scrubcam_record_queue_depth',
+                       'Writes waiting in the record writer queue',
+                       labels,
+                       function=lambda: self.queue_depth)
+        REGISTRY.counter('scrubcam_record_writes_total',
+                         'Recorded images written to disk',
+                         labels,
+                         function=lambda: self.writes)
+        REGISTRY.counter('scrubcam_record_failed_writes_total',
+                         'Recorded images that failed to be written',
+                         labels,
+                         function=lambda: self.failed_writes)
+        REGISTRY.counter('scrubcam_record_dropped_total',
+                         'Recorded images dropped from full writer queue',
+                         labels,
+                         function=lambda: self.queue.dropped)
+        REGISTRY.counter('scrubcam_record_bytes_written_total',
+                         'Bytes of recorded images written to disk',
+                         labels,
+                         function=lambda: self.bytes_written)
+        self._write_seconds = REGISTRY.histogram(
+            'scrubcam_record_write_seconds',
+            'Time taken to write a recorded image (and its boxes)',
+            labels)
+
+    @property
+    def queue_depth(self):
+        """Number of writes waiting to be done
+
+        """
+        return len(self.queue)
+
+    def submit(self, filename, frame=None, jpeg=None,
+               timestamp=None, lboxes=None):
+        """Queue an image (and optionally its boxes) to be written
+
+        If jpeg bytes are given they are written directly, otherwise
+        frame is encoded. If lboxes are given they are appended to the
+        detections file (or written to a boxes CSV named by timestamp).
+
+        """
+        if jpeg is None and not frame.flags['OWNDATA']:
+            # frame is a view into memory (e.g. a raw capture buffer)
+            # that may be overwritten before a worker gets to it
+            frame = frame.copy()
+
+        job = {'filename': filename,
+               'frame': frame,
+               'jpeg': jpeg,
+               'timestamp': timestamp,
+               'lboxes': lboxes}
+
+        if self.num_workers == 0:
+            self._write(job)
+        elif not self.queue.put(job):
+            log.warning('Record writer queue full, image not saved.')
+
+    def _work(self):
+        while not (self._stopped and self.queue_depth == 0):
+            job = self.queue.get(timeout=POLL_INTERVAL)
+            if job is None:
+                # idle so flush any partial batch
+                self._sync(force=True)
+                if self.index is not None:
+                    self.index.flush_if_due()
+                continue
+            try:
+                self._write(job)
+            except Exception:
+                log.exception('Exception writing %s', job['filename'])
+                self.failed_writes += 1
+
+    def _write(self, job):
+        start = time.perf_counter()
+        full_filename = os.path.join(self.record_folder, job['filename'])
+
+        data = job['jpeg']
+        if data is None:
+            ok, encoded = cv2.imencode('.jpeg', job['frame'])
+            if not ok:
+                log.warning('Did not succeed in image saving.')
+                self.failed_writes += 1
+                return
+            data = encoded
+
+        with open(full_filename, 'wb') as f:
+            f.write(data)
+            if self.fsync_every:
+                f.flush()
+                self._add_unsynced(os.dup(f.fileno()))
+
+        size = len(data)
+        boxes_size = 0
+        if job['lboxes'] is not None and self.detections_file is not None:
+            boxes_size = self.detections_file.append(job['filename'],
+                                                     job['lboxes'])
+        elif job['lboxes'] is not None:
+            log.debug('Writing csv files of boxes.')
+            write_boxes_file(self.record_folder,
+                             job['timestamp'],
+                             job['lboxes'])
+            size += os.path.getsize(os.path.join(
+                self.record_folder,
+                boxes_filename(job['filename'])))
+
+        if self.index is not None:
+            self.index.add(job['filename'], lboxes=job['lboxes'])
+        if self.storage is not None:
+            self.storage.add(job['filename'], size, job['lboxes'],
+                             boxes_size)
+
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.writes += 1
+            self.bytes_written += len(data)
+            self.latencies.append(latency)
+            self.max_latency = max(self.max_latency, latency)
+        if self._write_seconds is not None:
+            self._write_seconds.observe(latency)
+
+    def _add_unsynced(self, fd):
+        with self._lock:
+            self._unsynced.append(fd)
+        self._sync()
+
+    def _sync(self, force=False):
+        """fsync the current batch of written files if it is complete
+
+        """
+        with self._lock:
+            if not self._unsynced:
+                return
+            if not force and len(self._unsynced) < self.fsync_every:
+                return
+            batch = self._unsynced
+            self._unsynced = []
+
+        for fd in batch:
+            os.fsync(fd)
+            os.close(fd)
+
+    def stats(self):
+        """Return dict of writer counters
+
+        """
+        with self._lock:
+            latencies = list(self.latencies)
+        if latencies:
+            mean_latency = sum(latencies) / len(latencies)
+        else:
+            mean_latency = 0.0
+
+        return {'queue_depth': self.queue_depth,
+                'writes': self.writes,
+                'failed_writes': self.failed_writes,
+                'bytes_written': self.bytes_written,
+                'mean_write_ms': 1000 * mean_latency,
+                'max_write_ms': 1000 * self.max_latency}
+
+    def close(self, timeout=5):
+        """Finish queued writes and stop the workers
+
+        """
+        self._stopped = True
+        for worker in self._workers:
+            worker.join(timeout)
+        self._sync(force=True)
+        if self.detections_file is not None:
+            self.detections_file.close()
+        if self.storage is not None:
+            self.storage.close()
+        if self.index is not None:
+            self.index.close()
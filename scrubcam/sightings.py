@@ -0,0 +1,190 @@
+"""Log of what the ScrubCam has seen
+
+Each frame in which something was seen gets a structured record
+(JSON, one per line) with its time, the classes and scores of all its
+boxes and the filename of the image recorded for it, if any. Records
+are buffered in memory and written out in batches, either once enough
+of them have piled up or every so often, rather than opening the file
+for every frame, which during long detection bursts costs I/O and
+wears out SD cards. The log rotates by size or by date.
+
+A crash loses at most the records still in the buffer. A record left
+half written by one is cut off when the log is next opened.
+
+"""
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from threading import Thread
+
+from scrubcam.metrics import rotate_file
+
+log = logging.getLogger(__name__)
+
+SIZE = 'size'
+DAILY = 'daily'
+
+
+def repair_log(filename):
+    """Cut off a partly written last record left by a crash
+
+    Returns number of bytes removed.
+
+    """
+    if not os.path.exists(filename):
+        return 0
+
+    with open(filename, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return 0
+        # look back for the end of the last complete record
+        position = size
+        while position > 0:
+            step = min(4096, position)
+            f.seek(position - step)
+            chunk = f.read(step)
+            newline = chunk.rfind(b'\n')
+            if newline != -1:
+                end = position - step + newline + 1
+                break
+            position -= step
+        else:
+            end = 0
+        if end < size:
+            f.truncate(end)
+
+    return size - end
+
+
+def read_sightings(filename):
+    """Generate the sighting records (dicts) in a log file
+
+    """
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class SightingsLog():
+    """Buffered, rotating log of sighting records
+
+    Configured by:
+
+    SIGHTINGS_FILE: log file (default sightings.jsonl in RECORD_FOLDER)
+    SIGHTINGS_FLUSH_RECORDS: write out once this many are buffered
+    SIGHTINGS_FLUSH_INTERVAL: write out at least every this many seconds
+    SIGHTINGS_ROTATE: size (at SIGHTINGS_MAX_BYTES, keeping
+        SIGHTINGS_BACKUPS old files) or daily (one file per date)
+
+    """
+
+    def __init__(self, configs):
+        self.filename = configs.get('SIGHTINGS_FILE')
+        if self.filename is None:
+            self.filename = os.path.join(configs['RECORD_FOLDER'],
+                                         'sightings.jsonl')
+        self.flush_records = configs.get('SIGHTINGS_FLUSH_RECORDS', 50)
+        self.flush_interval = configs.get('SIGHTINGS_FLUSH_INTERVAL', 30)
+        self.rotate = configs.get('SIGHTINGS_ROTATE', SIZE)
+        self.max_bytes = configs.get('SIGHTINGS_MAX_BYTES', 10000000)
+        self.backups = configs.get('SIGHTINGS_BACKUPS', 5)
+
+        self.records_written = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        removed = repair_log(self.current_filename())
+        if removed:
+            log.warning('Removed %d bytes of partly written sighting '
+                        'from %s', removed, self.current_filename())
+
+        self._flusher = Thread(target=self._flush_periodically,
+                               name='sightings-flusher',
+                               daemon=True)
+        self._flusher.start()
+
+    def current_filename(self, now=None):
+        """Return name of the file records are being written to
+
+        """
+        if self.rotate != DAILY:
+            return self.filename
+        if now is None:
+            now = datetime.now()
+        root, ext = os.path.splitext(self.filename)
+        return f'{root}_{now.strftime("%Y-%m-%d")}{ext}'
+
+    def log(self, lboxes, image=None, timestamp=None):
+        """Add a sighting of lboxes (recorded as image, if any)
+
+        """
+        if timestamp is None:
+            timestamp = datetime.now()
+        record = {'time': timestamp.isoformat(timespec='milliseconds'),
+                  'classes': [lbox['class_name'] for lbox in lboxes],
+                  'scores': [round(lbox['confidence'], 4)
+                             for lbox in lboxes],
+                  'boxes': len(lboxes),
+                  'image': image}
+        line = json.dumps(record) + '\n'
+
+        with self._lock:
+            self._buffer.append((timestamp, line))
+            full = len(self._buffer) >= self.flush_records
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write buffered records out to the log file
+
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = self._buffer
+                self._buffer = []
+            if not batch:
+                return
+
+            # records are grouped by the file they belong in so that
+            # a batch spanning midnight is split between daily files
+            groups = {}
+            for timestamp, line in batch:
+                groups.setdefault(self.current_filename(timestamp),
+                                  []).append(line)
+
+            for filename, lines in groups.items():
+                self._write(filename, ''.join(lines))
+            self.records_written += len(batch)
+
+    def _write(self, filename, data):
+        if (self.rotate == SIZE
+                and os.path.exists(filename)
+                and os.path.getsize(filename) >= self.max_bytes):
+            rotate_file(filename, self.backups)
+
+        try:
+            with open(filename, 'a', encoding='utf-8') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError:
+            log.exception('Could not write sightings to %s', filename)
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Write out what is buffered and stop periodic flushing
+
+        """
+        self._stopped.set()
+        self._flusher.join(1)
+        self.flush()
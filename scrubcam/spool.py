@@ -0,0 +1,279 @@
+"""On-disk spool of detections waiting to be sent to the server
+
+While the link to the server is down, images with boxes that would
+have been sent are appended to the spool instead so that they can be
+sent once it is back up. The spool is a folder of segment files that
+are only ever appended to, each a run of records:
+
+    timestamp        float64  capture time in seconds
+    score            float32  top box score (for best-first draining)
+    class table len  uint32
+    boxes len        uint32
+    JPEG len         uint32
+
+followed by the class table and boxes (as in scrubcam.protocol) and
+the JPEG. All numbers are little-endian. A segment is deleted once
+everything in it has been taken out. When the spool is over its size
+cap the oldest segment is deleted to make room, so in a long outage
+the most recent detections are kept.
+
+Records are taken out oldest first or best (highest score) first.
+Taking out isn't recorded on disk, so what is taken from a segment
+that still has records in it when the program stops is spooled again
+on the next start (delivered at least once rather than at most once).
+
+"""
+import glob
+import heapq
+import logging
+import os
+import struct
+import threading
+
+from scrubcam import protocol
+
+log = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('<dfIII')
+EXTENSION = '.spool'
+
+OLDEST = 'oldest'
+BEST = 'best'
+ORDERS = (OLDEST, BEST)
+
+
+class _Segment():
+
+    def __init__(self, filename, size=0):
+        self.filename = filename
+        self.size = size
+        self.remaining = 0
+
+
+class Spool():
+    """Size-capped folder of spooled images and their boxes
+
+    """
+
+    def __init__(self, folder, max_bytes, order=OLDEST,
+                 segment_bytes=None):
+        if order not in ORDERS:
+            raise ValueError(f'Unknown spool order: {order}')
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.order = order
+        if segment_bytes is None:
+            segment_bytes = max(max_bytes // 16, 1)
+        self.segment_bytes = segment_bytes
+
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._segments = {}
+        self._heap = []
+        self._count = 0
+        self._next_number = 0
+        self._file = None
+        self._current = None
+
+        os.makedirs(folder, exist_ok=True)
+        self._scan()
+        if len(self):
+            log.info('%d spooled messages (%.1f MB) waiting to be sent',
+                     len(self), self.size / 1e6)
+
+    @classmethod
+    def from_configs(cls, configs):
+        """Create the spool configured by:
+
+        SPOOL_FOLDER: folder to spool to (default spool in
+            RECORD_FOLDER)
+        SPOOL_MAX_BYTES: size cap of the spool
+        SPOOL_ORDER: oldest or best (highest scoring) sent first
+
+        """
+        folder = configs.get('SPOOL_FOLDER')
+        if folder is None:
+            folder = os.path.join(configs['RECORD_FOLDER'], 'spool')
+        return cls(folder,
+                   configs.get('SPOOL_MAX_BYTES', 200000000),
+                   configs.get('SPOOL_ORDER', OLDEST))
+
+    def __len__(self):
+        return sum(segment.remaining
+                   for segment in list(self._segments.values()))
+
+    @property
+    def size(self):
+        """Bytes taken up by the spool on disk
+
+        """
+        return sum(segment.size for segment in list(self._segments.values()))
+
+    def _key(self, timestamp, score):
+        self._count += 1
+        if self.order == BEST:
+            return (-score, timestamp, self._count)
+        return (timestamp, self._count)
+
+    def _push(self, segment, offset, length, timestamp, score):
+        heapq.heappush(self._heap, (self._key(timestamp, score),
+                                    segment.filename, offset, length))
+        segment.remaining += 1
+
+    def _scan(self):
+        """Take stock of segments left by an earlier run
+
+        """
+        for filename in sorted(glob.glob(os.path.join(self.folder,
+                                                      f'*{EXTENSION}'))):
+            name = os.path.splitext(os.path.basename(filename))[0]
+            try:
+                self._next_number = max(self._next_number, int(name) + 1)
+            except ValueError:
+                continue
+            segment = _Segment(filename)
+            with open(filename, 'rb+') as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(0)
+                offset = 0
+                while offset + RECORD_HEADER.size <= size:
+                    (timestamp, score, *lengths) = RECORD_HEADER.unpack(
+                        f.read(RECORD_HEADER.size))
+                    length = RECORD_HEADER.size + sum(lengths)
+                    if offset + length > size:
+                        break
+                    self._push(segment, offset, length, timestamp, score)
+                    offset += length
+                    f.seek(offset)
+                if offset < size:
+                    log.warning('Cutting off partly written record in %s',
+                                filename)
+                    f.truncate(offset)
+            segment.size = offset
+            if segment.remaining:
+                self._segments[filename] = segment
+            else:
+                os.remove(filename)
+
+    def _roll(self):
+        """Start a new segment to append to
+
+        """
+        if self._file is not None:
+            self._file.close()
+        filename = os.path.join(self.folder,
+                                f'{self._next_number:012d}{EXTENSION}')
+        self._next_number += 1
+        self._file = open(filename, 'ab')
+        self._current = _Segment(filename)
+        self._segments[filename] = self._current
+
+    def _evict(self, needed):
+        """Delete oldest segments until there is room for needed bytes
+
+        """
+        while self._segments and self.size + needed > self.max_bytes:
+            filename = next(iter(self._segments))
+            current = self._current
+            if current is not None and filename == current.filename:
+                self._file.close()
+                self._file = None
+                self._current = None
+            segment = self._segments.pop(filename)
+            self.evicted += segment.remaining
+            log.warning('Spool full, deleted %d oldest messages.',
+                        segment.remaining)
+            try:
+                os.remove(filename)
+            except OSError:
+                log.exception('Could not delete %s', filename)
+
+    def put(self, jpeg, detections, timestamp):
+        """Append an image (JPEG bytes) and its Detections
+
+        """
+        class_table = b''
+        if detections.class_table is not None:
+            class_table = protocol.pack_class_table(detections.class_table)
+        meta = protocol.pack_detections(detections)
+        score = float(detections.scores.max()) if len(detections) else 0.0
+        header = RECORD_HEADER.pack(timestamp, score, len(class_table),
+                                    len(meta), len(jpeg))
+        length = len(header) + len(class_table) + len(meta) + len(jpeg)
+
+        with self._lock:
+            self._evict(length)
+            if (self._current is None
+                    or self._current.size >= self.segment_bytes):
+                self._roll()
+            offset = self._current.size
+            self._file.write(header)
+            self._file.write(class_table)
+            self._file.write(meta)
+            self._file.write(jpeg)
+            self._file.flush()
+            self._current.size += length
+            self._push(self._current, offset, length, timestamp, score)
+
+    def get(self):
+        """Remove and return next (JPEG bytes, Detections, timestamp)
+
+        Returns None if the spool is empty.
+
+        """
+        with self._lock:
+            while self._heap:
+                _, filename, offset, length = heapq.heappop(self._heap)
+                segment = self._segments.get(filename)
+                if segment is not None:
+                    break
+            else:
+                return None
+
+            with open(filename, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+
+            segment.remaining -= 1
+            if segment.remaining == 0:
+                self._remove(segment)
+
+        (timestamp, _, table_length,
+         meta_length, jpeg_length) = RECORD_HEADER.unpack_from(data)
+        start = RECORD_HEADER.size
+        class_table = None
+        if table_length:
+            class_table = protocol.unpack_class_table(
+                data[start:start + table_length])
+        start += table_length
+        detections = protocol.unpack_detections(
+            data[start:start + meta_length], class_table)
+        start += meta_length
+        jpeg = data[start:start + jpeg_length]
+
+        return jpeg, detections, timestamp
+
+    def _remove(self, segment):
+        """Delete a segment everything has been taken out of
+
+        """
+        if self._current is segment:
+            self._file.close()
+            self._file = None
+            self._current = None
+        del self._segments[segment.filename]
+        try:
+            os.remove(segment.filename)
+        except OSError:
+            log.exception('Could not delete %s', segment.filename)
+
+    def close(self):
+        """Close the segment being appended to (after fsyncing it)
+
+        """
+        with self._lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+                self._current = None
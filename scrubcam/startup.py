@@ -0,0 +1,105 @@
+"""Tools for timing and speeding up ScrubCam startup
+
+ScrubCams in the field reboot on a power schedule so every second of
+startup is frames missed. The PhaseTimer here records how long each
+phase of startup takes (phases may overlap, e.g. model loading running
+while the camera warms up) and run_in_background lets a slow phase run
+alongside others.
+
+"""
+import logging
+import time
+from contextlib import contextmanager
+from threading import Thread
+
+log = logging.getLogger(__name__)
+
+
+class PhaseTimer():
+    """Records start and duration of named phases
+
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager that times the phase in its block
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name,
+                                start - self.start,
+                                time.perf_counter() - start))
+
+    def mark(self, name):
+        """Record a point in time (e.g. first frame inferred)
+
+        """
+        self.phases.append((name, time.perf_counter() - self.start, None))
+
+    def report(self):
+        """Return lines of the phase breakdown
+
+        Each phase is given with its start (relative to the timer's
+        creation) and its duration (none for marks).
+
+        """
+        lines = [f'{"phase":<16} {"start s":>8} {"took s":>8}']
+        for name, start, duration in sorted(self.phases,
+                                            key=lambda phase: phase[1]):
+            if duration is None:
+                lines.append(f'{name:<16} {start:>8.2f} {"-":>8}')
+            else:
+                lines.append(f'{name:<16} {start:>8.2f} {duration:>8.2f}')
+        total = time.perf_counter() - self.start
+        lines.append(f'{"total":<16} {0:>8.2f} {total:>8.2f}')
+
+        return lines
+
+
+class BackgroundCall(Thread):
+    """Calls a function in a thread and hands back its result
+
+    """
+
+    def __init__(self, function, *args):
+        super().__init__(daemon=True)
+        self.function = function
+        self.args = args
+        self._result = None
+        self._exception = None
+
+    def run(self):
+        try:
+            self._result = self.function(*self.args)
+        except BaseException as exception:  # re-raised in result()
+            self._exception = exception
+
+    def result(self):
+        """Wait for the call to finish and return what it returned
+
+        Any exception raised by the call is raised here.
+
+        """
+        self.join()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def run_in_background(function, *args):
+    """Start calling function(*args) in a thread
+
+    Returns a BackgroundCall whose result() waits for and returns the
+    function's return value.
+
+    """
+    call = BackgroundCall(function, *args)
+    call.start()
+    return call
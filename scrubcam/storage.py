@@ -0,0 +1,304 @@
+"""Keeping the record folder within a disk quota
+
+Left alone the record folder grows until the SD card is full, at which
+point writing recordings starts to fail. The StorageManager here keeps
+a running total of what has been recorded (the folder is only scanned
+once, at startup, after which the record writer reports each image it
+writes) and when that goes over quota deletes recordings, in a
+background thread, in the order given by the eviction policy:
+
+- oldest: oldest first
+- lowest_confidence: lowest top box confidence first (oldest first
+  among equals)
+- unwanted: recordings with no FILTER_CLASSES boxes first, then oldest
+
+Recorded images, their boxes CSVs and the detections files count
+towards the quota. After evicting, the records of the deleted images
+are dropped from the detections files (see
+scrubcam.detections_file.compact_detections_file).
+
+"""
+import logging
+import os
+import shutil
+import threading
+from threading import Thread
+
+from scrubcam.capture import filename_timestamp
+from scrubcam.detections_file import (EXTENSION, compact_detections_file,
+                                      find_detections_files, read_boxes_file,
+                                      read_folder_detections)
+from scrubcam.metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+OLDEST = 'oldest'
+LOWEST_CONFIDENCE = 'lowest_confidence'
+UNWANTED = 'unwanted'
+# sort keys putting recordings in the order they are to be evicted
+EVICTION_KEYS = {
+    OLDEST: lambda recording: recording.timestamp,
+    LOWEST_CONFIDENCE: lambda recording: (recording.confidence,
+                                          recording.timestamp),
+    UNWANTED: lambda recording: (recording.wanted, recording.timestamp),
+}
+
+
+def boxes_filename(image_filename):
+    """Return name of the boxes CSV that goes with a recorded image
+
+    """
+    name = os.path.splitext(os.path.basename(image_filename))[0]
+    return name.split('_')[0] + '.csv'
+
+
+class Recording():
+    """A recorded image (and its boxes CSV) as far as the quota goes
+
+    """
+
+    def __init__(self, filename, size, timestamp, confidence, wanted):
+        self.filename = filename
+        self.size = size
+        self.timestamp = timestamp
+        self.confidence = confidence
+        self.wanted = wanted
+
+
+class StorageManager(Thread):
+    """Tracks record folder usage and evicts recordings over quota
+
+    Configured by:
+
+    STORAGE_QUOTA_BYTES: bytes the recordings may take up
+    STORAGE_QUOTA_PERCENT: percent of the disk they may take up (the
+        smaller of the two quotas applies if both are given)
+    STORAGE_EVICTION_POLICY: oldest, lowest_confidence or unwanted
+    STORAGE_EVICT_TO: fraction of quota to evict down to, so eviction
+        doesn't run for every new recording
+    STORAGE_CHECK_INTERVAL: seconds between checks of usage
+
+    """
+
+    def __init__(self, configs, index=None):
+        super().__init__(name='storage-manager', daemon=True)
+        self.record_folder = configs['RECORD_FOLDER']
+        self.filter_classes = set(configs.get('FILTER_CLASSES') or [])
+        self.policy = configs.get('STORAGE_EVICTION_POLICY', OLDEST)
+        if self.policy not in EVICTION_KEYS:
+            raise ValueError(f'Unknown eviction policy: {self.policy}')
+        self.evict_to = configs.get('STORAGE_EVICT_TO', 0.9)
+        self.check_interval = configs.get('STORAGE_CHECK_INTERVAL', 60)
+        self.index = index
+
+        self.quota = self._quota(configs.get('STORAGE_QUOTA_BYTES'),
+                                 configs.get('STORAGE_QUOTA_PERCENT'))
+        self.used = 0
+        # bytes of the detections files, part of used
+        self.detections_size = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+
+        self._recordings = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+
+        self._scan()
+        log.info('Recordings use %.1f MB of %.1f MB quota',
+                 self.used / 1e6, self.quota / 1e6)
+
+        REGISTRY.gauge('scrubcam_storage_used_bytes',
+                       'Bytes taken up by recordings',
+                       function=lambda: self.used)
+        REGISTRY.gauge('scrubcam_storage_quota_bytes',
+                       'Bytes recordings may take up',
+                       function=lambda: self.quota)
+        REGISTRY.gauge('scrubcam_storage_disk_free_bytes',
+                       'Free bytes on the record folder disk',
+                       function=self.disk_free)
+        REGISTRY.counter('scrubcam_storage_evicted_files_total',
+                         'Recordings deleted to stay within quota',
+                         function=lambda: self.evicted_files)
+        REGISTRY.counter('scrubcam_storage_evicted_bytes_total',
+                         'Bytes deleted to stay within quota',
+                         function=lambda: self.evicted_bytes)
+
+    def _quota(self, quota_bytes, quota_percent):
+        quotas = []
+        if quota_bytes is not None:
+            quotas.append(int(quota_bytes))
+        if quota_percent is not None:
+            total = shutil.disk_usage(self.record_folder).total
+            quotas.append(int(total * quota_percent / 100))
+        if not quotas:
+            raise ValueError('STORAGE_QUOTA_BYTES or STORAGE_QUOTA_PERCENT '
+                             'needed for storage management')
+        return min(quotas)
+
+    def disk_free(self):
+        """Return free bytes on the disk holding the record folder
+
+        """
+        return shutil.disk_usage(self.record_folder).free
+
+    def _scan(self):
+        """Take stock of the recordings already in the folder
+
+        """
+        summaries = {}
+        detections = {}
+        if self.index is not None and self.policy != OLDEST:
+            summaries = self.index.image_summaries()
+        elif self.policy != OLDEST:
+            detections = read_folder_detections(self.record_folder)
+
+        with os.scandir(self.record_folder) as entries:
+            files = {entry.name: entry.stat().st_size
+                     for entry in entries if entry.is_file()}
+
+        detections_size = sum(size for filename, size in files.items()
+                              if os.path.splitext(filename)[1] == EXTENSION)
+        with self._lock:
+            self.detections_size += detections_size
+            self.used += detections_size
+
+        for filename, size in files.items():
+            if os.path.splitext(filename)[1] != '.jpeg':
+                continue
+            csv_filename = boxes_filename(filename)
+            size += files.get(csv_filename, 0)
+            if filename in summaries:
+                confidence, classes = summaries[filename]
+            elif filename in detections:
+                confidence, classes = self._summarize(
+                    detections[filename].to_lboxes())
+            elif self.policy != OLDEST and csv_filename in files:
+                lboxes = self._read_boxes(csv_filename)
+                confidence, classes = self._summarize(lboxes)
+            else:
+                confidence, classes = 0.0, set()
+            self._track(filename, size, confidence, classes)
+
+    def _read_boxes(self, csv_filename):
+        try:
+            return read_boxes_file(os.path.join(self.record_folder,
+                                                csv_filename))
+        except (OSError, ValueError, IndexError):
+            return []
+
+    @staticmethod
+    def _summarize(lboxes):
+        """Return top confidence and set of classes of lboxes
+
+        """
+        if not lboxes:
+            return 0.0, set()
+        return (max(lbox['confidence'] for lbox in lboxes),
+                {lbox['class_name'] for lbox in lboxes})
+
+    def _track(self, filename, size, confidence, classes):
+        timestamp = filename_timestamp(filename)
+        if timestamp is None:
+            timestamp = 0.0
+        recording = Recording(filename,
+                              size,
+                              timestamp,
+                              confidence,
+                              bool(classes & self.filter_classes))
+        with self._lock:
+            previous = self._recordings.get(filename)
+            if previous is not None:
+                self.used -= previous.size
+            self._recordings[filename] = recording
+            self.used += size
+
+    def add(self, filename, size, lboxes=None, boxes_size=0):
+        """Count a newly written recording
+
+        size includes its boxes CSV, boxes_size is what was appended to
+        a detections file for it.
+
+        """
+        self._track(os.path.basename(filename),
+                    size,
+                    *self._summarize(lboxes))
+        with self._lock:
+            self.detections_size += boxes_size
+            self.used += boxes_size
+        if self.used > self.quota:
+            self._wake.set()
+
+    def _eviction_order(self):
+        with self._lock:
+            recordings = list(self._recordings.values())
+        return sorted(recordings, key=EVICTION_KEYS[self.policy])
+
+    def evict(self):
+        """Delete recordings until usage is below the eviction target
+
+        Returns list of filenames of deleted images.
+
+        """
+        target = self.quota * self.evict_to
+        evicted = []
+        for recording in self._eviction_order():
+            if self.used <= target:
+                break
+            for filename in (recording.filename,
+                             boxes_filename(recording.filename)):
+                try:
+                    os.remove(os.path.join(self.record_folder, filename))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    log.exception('Could not delete %s', filename)
+            with self._lock:
+                if self._recordings.pop(recording.filename, None):
+                    self.used -= recording.size
+            self.evicted_files += 1
+            self.evicted_bytes += recording.size
+            evicted.append(recording.filename)
+
+        if evicted:
+            log.info('Deleted %d recordings (%s policy) to stay within '
+                     'quota', len(evicted), self.policy)
+            if self.index is not None:
+                self.index.remove(evicted)
+            self._compact_detections_files(evicted)
+        return evicted
+
+    def _compact_detections_files(self, evicted):
+        """Drop the records of evicted images from the detections files
+
+        """
+        freed = 0
+        for filename in find_detections_files(self.record_folder):
+            try:
+                freed += compact_detections_file(filename, evicted)
+            except (OSError, ValueError):
+                log.exception('Could not compact %s', filename)
+        with self._lock:
+            self.detections_size -= freed
+            self.used -= freed
+        self.evicted_bytes += freed
+
+    def run(self):
+        while not self._stopped:
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
+            if self._stopped:
+                break
+            if self.used > self.quota:
+                try:
+                    self.evict()
+                except Exception:
+                    log.exception('Exception evicting recordings.')
+
+    def close(self):
+        """Stop managing storage
+
+        """
+        self._stopped = True
+        self._wake.set()
+        self.join(1)
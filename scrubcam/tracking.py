@@ -0,0 +1,184 @@
+"""Lightweight multi-object tracking of detections across frames
+
+An animal that stands in frame for minutes is detected on every one
+of those frames. The IoUTracker here associates each frame's
+detections with the tracks from previous frames by box overlap so that
+recording and transmitting can happen once per animal (plus when it is
+seen better, or every so often) rather than once per frame.
+
+"""
+import logging
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+NEW = 'new'
+IMPROVED = 'improved'
+INTERVAL = 'interval'
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """Return matrix of IoU between every pair of boxes in a and b
+
+    Boxes are (left, top, width, height).
+
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    a_left, a_top = boxes_a[:, None, 0], boxes_a[:, None, 1]
+    a_right = a_left + boxes_a[:, None, 2]
+    a_bottom = a_top + boxes_a[:, None, 3]
+    b_left, b_top = boxes_b[None, :, 0], boxes_b[None, :, 1]
+    b_right = b_left + boxes_b[None, :, 2]
+    b_bottom = b_top + boxes_b[None, :, 3]
+
+    overlap_w = np.clip(np.minimum(a_right, b_right)
+                        - np.maximum(a_left, b_left), 0, None)
+    overlap_h = np.clip(np.minimum(a_bottom, b_bottom)
+                        - np.maximum(a_top, b_top), 0, None)
+    intersection = overlap_w * overlap_h
+    area_a = boxes_a[:, None, 2] * boxes_a[:, None, 3]
+    area_b = boxes_b[None, :, 2] * boxes_b[None, :, 3]
+    union = area_a + area_b - intersection
+
+    return intersection / np.maximum(union, 1e-9)
+
+
+class Track():
+    """A single object followed across frames
+
+    """
+
+    def __init__(self, track_id, box, score, class_id, now):
+        self.track_id = track_id
+        self.box = box
+        self.score = score
+        # score when last acted on
+        self.best_score = None
+        self.class_id = class_id
+        self.first_seen = now
+        self.last_seen = now
+        self.last_action = None
+        self.age = 1
+        self.action = NEW
+
+    def update(self, box, score, now):
+        """Update track with a newly associated detection
+
+        """
+        self.box = box
+        self.score = score
+        self.last_seen = now
+        self.age += 1
+
+
+class IoUTracker():
+    """Associates detections with tracks by IoU and decides on actions
+
+    A track calls for action (recording/sending) until it is first
+    acted on, then when its score beats its best acted on by a margin
+    or when an interval has passed since its last action. Whoever acts
+    on a track (e.g. records the frame) marks it with mark_acted.
+    Configured by:
+
+    TRACK_IOU_THRESHOLD: minimum IoU to associate detection with track
+    TRACK_LOST_TIMEOUT: seconds unseen before a track is dropped
+    TRACK_ACTION_INTERVAL: seconds between repeat actions for a track
+    TRACK_SCORE_IMPROVEMENT: score gain over best that calls for action
+
+    """
+
+    def __init__(self, configs):
+        self.iou_threshold = configs.get('TRACK_IOU_THRESHOLD', 0.3)
+        self.lost_timeout = configs.get('TRACK_LOST_TIMEOUT', 5)
+        self.action_interval = configs.get('TRACK_ACTION_INTERVAL', 60)
+        self.score_improvement = configs.get('TRACK_SCORE_IMPROVEMENT', 0.1)
+
+        self.tracks = []
+        self.track_ids = np.empty(0, dtype=np.int64)
+        self._next_id = 0
+
+    def update(self, detections, now=None):
+        """Associate a frame's detections with tracks
+
+        Sets track_ids to the track ID of each detection (in order)
+        and returns the list of tracks that call for action this frame.
+        Tracks keep calling for action until marked with mark_acted.
+
+        """
+        if now is None:
+            now = time.time()
+
+        self.tracks = [track for track in self.tracks
+                       if now - track.last_seen <= self.lost_timeout]
+
+        num_detections = len(detections)
+        matched = self._associate(detections)
+
+        self.track_ids = np.empty(num_detections, dtype=np.int64)
+        actionable = []
+        for i in range(num_detections):
+            box = detections.boxes[i].tolist()
+            score = float(detections.scores[i])
+            track = matched.get(i)
+            if track is None:
+                track = Track(self._next_id, box, score,
+                              int(detections.class_ids[i]), now)
+                self._next_id += 1
+                self.tracks.append(track)
+            else:
+                track.update(box, score, now)
+                track.action = self._action(track, score, now)
+
+            self.track_ids[i] = track.track_id
+            if track.action is not None:
+                actionable.append(track)
+
+        return actionable
+
+    def mark_acted(self, track, now=None):
+        """Record that track was acted on (e.g. its frame recorded)
+
+        """
+        if now is None:
+            now = time.time()
+        track.last_action = now
+        if track.best_score is None or track.score > track.best_score:
+            track.best_score = track.score
+
+    def _associate(self, detections):
+        """Return dict of detection index to matched existing track
+
+        Greedily matches highest IoU pairs of the same class first.
+
+        """
+        if len(detections) == 0 or not self.tracks:
+            return {}
+
+        track_boxes = [track.box for track in self.tracks]
+        track_classes = np.array([track.class_id for track in self.tracks])
+        ious = iou_matrix(detections.boxes, track_boxes)
+        same_class = detections.class_ids[:, None] == track_classes[None, :]
+        ious[~same_class] = 0
+
+        matched = {}
+        for flat in np.argsort(-ious, axis=None):
+            det, trk = np.unravel_index(flat, ious.shape)
+            if ious[det, trk] < self.iou_threshold:
+                break
+            if det in matched or self.tracks[trk] in matched.values():
+                continue
+            matched[int(det)] = self.tracks[trk]
+
+        return matched
+
+    def _action(self, track, score, now):
+        if track.last_action is None:
+            return NEW
+        if score >= track.best_score + self.score_improvement:
+            return IMPROVED
+        if now - track.last_action >= self.action_interval:
+            return INTERVAL
+        return None
@@ -1,28 +1,145 @@
 """Tools for handling ML inference on image data 
 
 """
-import csv
 import logging
 import re
 import os
+import time
 from datetime import datetime
 
 import numpy as np
 import cv2
 
-from camml import coral as nn
+from scrubcam import backends
+from scrubcam.metrics import REGISTRY
+from scrubcam.capture import TIMESTAMP_FORMAT
+from scrubcam.detections import Detections
+from scrubcam.preprocess import Preprocessor
+from scrubcam.detections_file import write_boxes_file
+from scrubcam.recording import RecordWriter
+from scrubcam.tracking import IoUTracker
 
 log = logging.getLogger(__name__)
 
 
+def clip_boxes(boxes, frame_shape, pad=0.0):
+    """Pad boxes and clip them to the frame
+
+    Takes boxes as (left, top, width, height), grows each by pad (a
+    fraction of its width and height) on every side and returns an
+    int array of (left, top, right, bottom) corners inside the frame.
+
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    frame_height, frame_width = frame_shape[:2]
+    pad_x = boxes[:, 2] * pad
+    pad_y = boxes[:, 3] * pad
+
+    corners = np.empty(boxes.shape, dtype=np.int32)
+    corners[:, 0] = np.clip(boxes[:, 0] - pad_x, 0, frame_width)
+    corners[:, 1] = np.clip(boxes[:, 1] - pad_y, 0, frame_height)
+    corners[:, 2] = np.clip(boxes[:, 0] + boxes[:, 2] + pad_x,
+                            0, frame_width)
+    corners[:, 3] = np.clip(boxes[:, 1] + boxes[:, 3] + pad_y,
+                            0, frame_height)
+
+    return corners
+
+
+def read_classes_from_file(classes_file):
+    """Return list of class names, one per line of file
+
+    """
+    with open(classes_file, 'r', encoding="utf8") as f:
+        return [row.strip() for row in f]
+
+
+def label_for_filename(label):
+    """Return class label made safe for use in a filename
+
+    """
+    label = re.sub('[()]', '', label)
+    return '_'.join(label.split(' '))
+
+
+def non_max_suppression(boxes, scores, threshold, class_ids=None):
+    """Return indices of boxes kept by non-maximum suppression
+
+    Boxes are (left, top, width, height). Any box overlapping a higher
+    scoring one with IoU above threshold is dropped. If class_ids are
+    given only boxes of the same class suppress each other. Indices
+    are returned highest score first.
+
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float32)
+    lefts = boxes[:, 0].copy()
+    tops = boxes[:, 1].copy()
+    if class_ids is not None:
+        # shift each class into its own region so classes never overlap
+        extent = (boxes[:, :2] + boxes[:, 2:]).max() + 1
+        shift = np.asarray(class_ids, dtype=np.float32) * extent
+        lefts += shift
+        tops += shift
+    rights = lefts + boxes[:, 2]
+    bottoms = tops + boxes[:, 3]
+    areas = boxes[:, 2] * boxes[:, 3]
+
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while order.size > 0:
+        best, rest = order[0], order[1:]
+        keep.append(int(best))
+        overlap_w = np.clip(np.minimum(rights[best], rights[rest])
+                            - np.maximum(lefts[best], lefts[rest]), 0, None)
+        overlap_h = np.clip(np.minimum(bottoms[best], bottoms[rest])
+                            - np.maximum(tops[best], tops[rest]), 0, None)
+        intersection = overlap_w * overlap_h
+        union = areas[best] + areas[rest] - intersection
+        iou = intersection / np.maximum(union, 1e-9)
+        order = rest[iou <= threshold]
+
+    return keep
+
+
+def tile_layout(frame_shape, grid, overlap):
+    """Return (left, top, width, height) of overlapping tiles over frame
+
+    grid is [columns, rows] and overlap the fraction of a tile's size
+    shared with its neighbour.
+
+    """
+    frame_height, frame_width = frame_shape[:2]
+    cols, rows = grid
+
+    def spans(length, count):
+        size = int(np.ceil(length / (count - (count - 1) * overlap)))
+        size = min(size, length)
+        if count == 1:
+            return [0], size
+        step = (length - size) / (count - 1)
+        return [int(round(i * step)) for i in range(count)], size
+
+    lefts, tile_width = spans(frame_width, cols)
+    tops, tile_height = spans(frame_height, rows)
+
+    return [(left, top, tile_width, tile_height)
+            for top in tops for left in lefts]
+
+
 class InferenceSystem():
     """Base class for inference systems
 
+    Recorded frames are written by a RecordWriter, created on the first
+    save unless one is given (e.g. to share between systems recording
+    to the same folder).
+
     Note: is an abstract base class
 
     """
 
-    def __init__(self, configs):
+    def __init__(self, configs, writer=None):
+        self.configs = configs
         # CV constants
         self.conf_threshold = configs['CONF_THRESHOLD']
         self.model_path = configs['MODEL_PATH']
@@ -30,7 +147,56 @@ class InferenceSystem():
         self.record_folder = configs['RECORD_FOLDER']
         self.recorded_image_count = 0
         self.frame = None
+        self.jpeg = None
+        # set up by subclasses once their network is known
+        self.preprocessor = None
         self._ensure_record_folder()
+        self._writer = writer
+        self._owns_writer = writer is None
+
+        labels = {'system': type(self).__name__}
+        self._labels = labels
+        self._frames_inferred = REGISTRY.counter(
+            'scrubcam_frames_inferred_total',
+            'Frames (or crops) run through inference',
+            labels)
+        self._inference_seconds = REGISTRY.histogram(
+            'scrubcam_inference_seconds',
+            'Time taken to run inference on a frame (or crop)',
+            labels)
+        self._recorded_images = REGISTRY.counter(
+            'scrubcam_recorded_images_total',
+            'Images handed off to be recorded',
+            labels)
+
+    @property
+    def writer(self):
+        """RecordWriter for recorded frames (created on first use)
+
+        """
+        if self._writer is None:
+            self._writer = RecordWriter(self.configs)
+            self._writer.register_metrics(self._labels)
+        return self._writer
+
+    def _create_preprocessor(self, configs, letterbox):
+        """Return Preprocessor for the network's input
+
+        Returns None (network does its own resizing) if the network
+        can't take preprocessed input or PREPROCESS_ON is False.
+
+        """
+        if (not configs.get('PREPROCESS_ON', True)
+                or not hasattr(self.network, 'infer_input')):
+            return None
+        return Preprocessor(self.network.input_size, letterbox=letterbox)
+
+    def _observe_inference(self, start):
+        """Count an inference that began at perf_counter time start
+
+        """
+        self._inference_seconds.observe(time.perf_counter() - start)
+        self._frames_inferred.inc()
 
     def infer_on_frame(self, frame):
         """Run inference on a single frame
@@ -42,13 +208,55 @@ class InferenceSystem():
         """Run inference on stream
 
         Is built around the stream that comes in from a picamera
+        """
+        self.decode(stream)
+        self.infer_on_frame(self.frame)
+
+    def decode(self, stream):
+        """Decode JPEG stream from picamera into the current frame
+
         """
         # may not be necessary since using .getvalue()
         stream.seek(0)
-        # Construct a numpy array from the stream
-        data = np.fromstring(stream.getvalue(), dtype=np.uint8)
+        self.decode_jpeg(stream.getvalue())
+
+    def decode_jpeg(self, jpeg):
+        """Decode JPEG bytes into the current frame
+
+        """
+        # Keep the original JPEG bytes around so they needn't be
+        # re-encoded if the frame gets sent on or saved
+        self.jpeg = jpeg
+        # Construct a numpy array from the bytes without copying
+        data = np.frombuffer(self.jpeg, dtype=np.uint8)
         # "Decode" the image from the array, preserving color
         self.frame = cv2.imdecode(data, 1)
+
+    def infer_on_buffer(self, buffer):
+        """Run inference on a raw BGR frame buffer
+
+        For use with raw captures (see scrubcam.capture) so that there
+        is no JPEG decode. The buffer is not copied so the current
+        frame is only valid until the next capture into that buffer.
+
+        """
+        self.jpeg = None
+        self.frame = buffer
+        self.infer_on_frame(self.frame)
+
+    def infer_on_packet(self, packet):
+        """Run inference on a frame packet from a capture source
+
+        JPEG packets are decoded and the decoded frame stored in the
+        packet.
+
+        """
+        if packet['frame'] is None:
+            self.decode_jpeg(packet['jpeg'])
+            packet['frame'] = self.frame
+        else:
+            self.frame = packet['frame']
+            self.jpeg = packet['jpeg']
         self.infer_on_frame(self.frame)
 
     def _write_boxes_file(self, timestamp, lboxes):
@@ -57,38 +265,48 @@ class InferenceSystem():
         The CSV is given timestamp as its name
 
         """
-        filename = f"{timestamp}.csv"
-        full_filename = os.path.join(self.record_folder, filename)
-        with open(full_filename, 'w', encoding="utf8") as f:
-            csv_writer = csv.writer(f,
-                                    delimiter=',',
-                                    quotechar='"',
-                                    quoting=csv.QUOTE_MINIMAL)
-            for lbox in lboxes:
-                csv_writer.writerow([lbox['class_name'],
-                                     lbox['confidence'],
-                                     *lbox['box']])
+        write_boxes_file(self.record_folder, timestamp, lboxes)
 
-    def save_current_frame(self, label, lboxes=None):
+    def save_current_frame(self, label, lboxes=None, frame=None, jpeg=None):
         """Save current frame to disk as JPG image
 
+        A frame other than the current one (e.g. one being carried
+        through the pipeline) can be given to save instead, along with
+        its original JPEG bytes if there are any. The write itself is
+        handed off to the record writer. Returns the image's filename.
+
         """
+        if frame is None:
+            frame = self.frame
+            if jpeg is None:
+                jpeg = self.jpeg
+
         now = datetime.now()
-        timestamp = now.strftime("%Y-%m-%dT%Hh%Mm%Ss.%f")[:-3]
+        timestamp = now.strftime(TIMESTAMP_FORMAT)[:-3]
         if label is None:
             label = lboxes[0]['class_name']
         filename = f"{timestamp}_{label}.jpeg"
         self.recorded_image_count += 1
-        full_filename = os.path.join(self.record_folder, filename)
+        self._recorded_images.inc()
         log.info('Saving image.')
-        log.debug("Image filename is %s", full_filename)
-        ok = cv2.imwrite(full_filename, self.frame)
-        if not ok:
-            log.warning('Did not succeed in image saving.')
+        log.debug("Image filename is %s", filename)
+        self.writer.submit(filename,
+                           frame=frame,
+                           jpeg=jpeg,
+                           timestamp=timestamp,
+                           lboxes=lboxes)
 
-        if lboxes is not None:
-            log.debug('Writing csv files of boxes.')
-            self._write_boxes_file(timestamp, lboxes)
+        return filename
+
+    def close(self):
+        """Finish any pending writes of recorded frames
+
+        A writer that was given rather than created is left for its
+        owner to close.
+
+        """
+        if self._owns_writer and self._writer is not None:
+            self._writer.close()
 
     def _ensure_record_folder(self):
         """Ensure recording folder in configurations exists
@@ -105,49 +323,124 @@ class ImageClassificationSystem(InferenceSystem):
 
     """
 
-    def __init__(self, configs):
-        super().__init__(configs)
+    def __init__(self, configs, writer=None):
+        super().__init__(configs, writer)
         self.model = os.path.join(self.model_path,
                                   configs['MODEL_CONFIG_FILE'])
         classes_file = os.path.join(self.model_path,
                                     configs['CLASS_NAMES_FILE'])
 
-        self.classes = nn.read_classes_from_file(classes_file)
+        self.classes = read_classes_from_file(classes_file)
         # prepare neural network
-        self.network = nn.ImageClassifierHandler(self.model)
+        self.network = backends.create_classifier(configs, self.model)
+        self.preprocessor = self._create_preprocessor(configs,
+                                                      letterbox=False)
+
+        # fraction of box size to pad crops by on each side
+        self.crop_pad = configs.get('CLASSIFIER_CROP_PAD', 0.0)
+        input_width, input_height = self.network.input_size
+        self._batch = np.empty((0, input_height, input_width, 3),
+                               dtype=np.uint8)
 
         self.result = None
+        self.crop_results = []
 
     def infer_on_frame(self, frame):
-        self.result, _ = self.network.infer(frame)
+        start = time.perf_counter()
+        if self.preprocessor is None:
+            self.result, _ = self.network.infer(frame)
+        else:
+            tensor = self.preprocessor.prepare(frame)
+            self.result, _ = self.network.infer_input(tensor)
+        self._observe_inference(start)
 
-    def _extract_label_and_score(self):
-        label = self.classes[self.result[0][0]]
-        score = self.result[0][1]
+    def infer_on_crops(self, frame, boxes):
+        """Run classification on several boxes cropped out of frame
+
+        Boxes (left, top, width, height) are padded by crop_pad and
+        clipped to the frame and every crop is resized into one
+        preallocated batch before inference. Returns list of results
+        (same form as self.result) with one entry per box, empty for
+        boxes that have no area inside the frame.
+
+        """
+        self.frame = frame
+        self.jpeg = None
+        self.crop_results = []
+        if len(boxes) == 0:
+            return self.crop_results
+
+        corners = clip_boxes(boxes, frame.shape, self.crop_pad)
+        if len(boxes) > len(self._batch):
+            self._batch = np.empty((len(boxes), *self._batch.shape[1:]),
+                                   dtype=np.uint8)
+        input_size = self._batch.shape[2:0:-1]
+
+        valid = []
+        for i, (left, top, right, bottom) in enumerate(corners):
+            if right <= left or bottom <= top:
+                continue
+            cv2.resize(frame[top:bottom, left:right],
+                       input_size,
+                       dst=self._batch[len(valid)],
+                       interpolation=cv2.INTER_AREA)
+            valid.append(i)
+
+        self.crop_results = [[] for _ in boxes]
+        for slot, i in enumerate(valid):
+            start = time.perf_counter()
+            crop = self._batch[slot]
+            if self.preprocessor is None:
+                self.crop_results[i], _ = self.network.infer(crop)
+            else:
+                # crop is already input size so only needs to be RGB
+                cv2.cvtColor(crop, cv2.COLOR_BGR2RGB, dst=crop)
+                self.crop_results[i], _ = self.network.infer_input(crop)
+            self._observe_inference(start)
+
+        return self.crop_results
+
+    def top_label_and_score(self, result=None):
+        """Return Top-1 label and score of result
+
+        Result is e.g. one from infer_on_crops; if not given the latest
+        infer_on_frame result is used.
+
+        """
+        if result is None:
+            result = self.result
+        label = self.classes[result[0][0]]
+        score = result[0][1]
 
         return label, score
 
-    def print_report(self):
+    def print_report(self, result=None):
         """Log the Top-1 label and score
 
+        Reports on result (e.g. one from infer_on_crops) if given,
+        otherwise on the latest infer_on_frame.
+
         """
-        if len(self.result) > 0:
-            label, score = self._extract_label_and_score()
+        if result is None:
+            result = self.result
+        if len(result) > 0:
+            label, score = self.top_label_and_score(result)
             strg = "***%s*** is classification (Top 1) with score: %.2f"
             log.info(strg, label, score)
         else:
             log.info('Inference resulted in no class label.')
 
-    def save_image_of_anything_but(self, excluded_class):
+    def save_image_of_anything_but(self, excluded_class, result=None):
         """Save current frame to disk unless its label is excluded class
 
         """
+        if result is None:
+            result = self.result
         # also thresholds on score threshold defined in config file
-        if len(self.result) > 0:
-            label, score = self._extract_label_and_score()
+        if len(result) > 0:
+            label, score = self.top_label_and_score(result)
             if label != excluded_class and score >= self.conf_threshold:
-                label = re.sub('[()]', '', label)
-                label = '_'.join(label.split(' '))
+                label = label_for_filename(label)
                 log.debug(label)
                 self.save_current_frame(label)
 
@@ -157,8 +450,8 @@ class ObjectDetectionSystem(InferenceSystem):
 
     """
 
-    def __init__(self, configs):
-        super().__init__(configs)
+    def __init__(self, configs, writer=None):
+        super().__init__(configs, writer)
         # CV constants
         # TRACKED_CLASS = configs['TRACKED_CLASS']
         input_width = configs['INPUT_WIDTH']
@@ -168,27 +461,95 @@ class ObjectDetectionSystem(InferenceSystem):
         obj_classes_file = os.path.join(self.model_path,
                                         configs['OBJ_CLASS_NAMES_FILE'])
 
-        self.obj_classes = []
+        self.obj_classes = read_classes_from_file(obj_classes_file)
         self.labeled_boxes = None
-        with open(obj_classes_file, 'r', encoding="utf8") as f:
-            for row in f:
-                self.obj_classes.append(row.strip())
+        # names looked up by class ID only when asked for
+        self.class_table = np.array(self.obj_classes, dtype=object)
 
         self.nms_threshold = configs['NMS_THRESHOLD']
         # prepare neural network
-        self.network = nn.ObjectDetectorHandler(model_config,
+        self.network = backends.create_detector(configs,
+                                                model_config,
                                                 self.model_weights,
                                                 input_width,
                                                 input_height)
+        # resized frames are letterboxed to keep their aspect ratio
+        # unless PREPROCESS_LETTERBOX is False
+        self.preprocessor = self._create_preprocessor(
+            configs,
+            letterbox=configs.get('PREPROCESS_LETTERBOX', True))
+
+        # tiled mode: [columns, rows] of overlapping tiles, each run
+        # through the detector separately
+        self.tile_grid = configs.get('TILE_GRID')
+        self.tile_overlap = configs.get('TILE_OVERLAP', 0.2)
+        self.tile_full_frame = configs.get('TILE_INCLUDE_FULL_FRAME', True)
+        self.tiled = (self.tile_grid is not None
+                      and self.tile_grid[0] * self.tile_grid[1] > 1)
+        self._tiles = None
+        self._tiles_shape = None
+        # per-tile inference times (ms) of last frame in tiled mode
+        self.tile_times = []
 
     def infer_on_frame(self, frame):
-        outs, _ = self.network.infer(frame)
-        self.labeled_boxes = self.network.filter_boxes(outs,
-                                                       frame,
-                                                       self.conf_threshold,
-                                                       self.nms_threshold)
-        for lbox in self.labeled_boxes:
-            lbox['class_name'] = self.class_of_box(lbox)
+        start = time.perf_counter()
+        if self.tiled:
+            self.labeled_boxes = self._infer_tiled(frame)
+        else:
+            self.labeled_boxes = self._infer_region(frame)
+        self._observe_inference(start)
+
+    def _infer_region(self, region):
+        if self.preprocessor is None:
+            outs, _ = self.network.infer(region)
+            lboxes = self.network.filter_boxes(outs,
+                                               region,
+                                               self.conf_threshold,
+                                               self.nms_threshold)
+            return Detections.from_lboxes(lboxes, self.class_table)
+
+        tensor = self.preprocessor.prepare(region)
+        outs, _ = self.network.infer_input(tensor)
+        lboxes = self.network.filter_boxes(outs,
+                                           tensor,
+                                           self.conf_threshold,
+                                           self.nms_threshold)
+        detections = Detections.from_lboxes(lboxes, self.class_table)
+        # boxes are in model input coordinates
+        self.preprocessor.to_frame(detections.boxes)
+        return detections
+
+    def _infer_tiled(self, frame):
+        """Run detector on each tile of frame and merge the boxes
+
+        """
+        if self._tiles_shape != frame.shape[:2]:
+            self._tiles = tile_layout(frame.shape,
+                                      self.tile_grid,
+                                      self.tile_overlap)
+            if self.tile_full_frame:
+                self._tiles.append((0, 0, frame.shape[1], frame.shape[0]))
+            self._tiles_shape = frame.shape[:2]
+
+        per_tile = []
+        self.tile_times = []
+        for left, top, width, height in self._tiles:
+            start = time.perf_counter()
+            detections = self._infer_region(frame[top:top + height,
+                                                  left:left + width])
+            self.tile_times.append(1000 * (time.perf_counter() - start))
+            detections.boxes[:, 0] += left
+            detections.boxes[:, 1] += top
+            per_tile.append(detections.records)
+
+        records = np.concatenate(per_tile)
+        if len(records) == 0:
+            return Detections(records, self.class_table)
+        keep = non_max_suppression(records['box'],
+                                   records['score'],
+                                   self.nms_threshold,
+                                   records['class_id'])
+        return Detections(records[keep], self.class_table)
 
     def class_of_box(self, lbox):
         """Return class of current lbox
@@ -200,6 +561,11 @@ class ObjectDetectionSystem(InferenceSystem):
         """Log information about detected boxes
 
         """
+        if self.tiled and self.tile_times:
+            log.info('%d tiles inferred in %.1f ms (slowest %.1f ms)',
+                     len(self.tile_times),
+                     sum(self.tile_times),
+                     max(self.tile_times))
         if self.labeled_boxes:
             if max_boxes is None:
                 max_boxes = len(self.labeled_boxes)
@@ -219,7 +585,7 @@ class ObjectDetectionSystem(InferenceSystem):
         """
         top_class = None
         if self.labeled_boxes:
-            top_class =  self.class_of_box(self.labeled_boxes[0])
+            top_class = self.labeled_boxes.class_name(0)
         return top_class
 
     def top_box(self):
@@ -228,5 +594,139 @@ class ObjectDetectionSystem(InferenceSystem):
         """
         top_box = None
         if self.labeled_boxes:
-            top_box = self.labeled_boxes[0]['box']
+            top_box = self.labeled_boxes.boxes[0].tolist()
         return top_box
+
+
+class ClassifierCascade():
+    """Runs the classifier on only the detections that call for it
+
+    A detection is passed on to the classifier if its class needs a
+    species-level label or if the detector wasn't sure of it (score in
+    the uncertainty band). Results are cached per track so an animal
+    that stays in view isn't classified on every frame, and at most a
+    budget of crops are classified per frame to keep latency bounded
+    (detections over budget keep their last result, if any). Configured
+    by:
+
+    CASCADE_CLASSES: detector classes needing a species-level label
+        (defaults to FILTER_CLASSES)
+    CASCADE_UNCERTAIN_BAND: [low, high) detector scores to classify
+        regardless of class (not used if not given)
+    CASCADE_CACHE_FRAMES: frames a track's classifier result is reused
+    CASCADE_BUDGET: maximum classifier runs per frame
+
+    """
+
+    def __init__(self, configs, classifier):
+        self.configs = configs
+        self.classifier = classifier
+        self.species_classes = configs.get('CASCADE_CLASSES',
+                                           configs['FILTER_CLASSES']) or []
+        band = configs.get('CASCADE_UNCERTAIN_BAND')
+        self.band = tuple(band) if band else None
+        self.cache_frames = configs.get('CASCADE_CACHE_FRAMES', 10)
+        self.budget = configs.get('CASCADE_BUDGET', 4)
+
+        # only used if no track IDs are given to classify
+        self.tracker = None
+        # track ID -> (frame index when classified, result)
+        self._cache = {}
+        self._frame_index = 0
+        self.detections = None
+        self.results = []
+        self.fresh = []
+
+        self._cache_hits = REGISTRY.counter(
+            'scrubcam_cascade_cache_hits_total',
+            'Detections given a cached classifier result')
+        self._over_budget = REGISTRY.counter(
+            'scrubcam_cascade_over_budget_total',
+            'Detections not classified for lack of per-frame budget')
+
+    def needs_label(self, detections):
+        """Return boolean mask of the detections calling for classifier
+
+        """
+        mask = np.isin(detections.class_table[detections.class_ids],
+                       self.species_classes)
+        if self.band is not None:
+            low, high = self.band
+            mask |= (detections.scores >= low) & (detections.scores < high)
+
+        return mask
+
+    def classify(self, detections, frame, track_ids=None):
+        """Classify the detections in frame that call for it
+
+        track_ids (e.g. from an IoUTracker updated with detections)
+        key the cache; if not given the cascade tracks the detections
+        itself. Returns list, one entry per detection, of classifier
+        results or None for detections that weren't classified. fresh
+        is then set to whether each detection was classified this frame
+        (rather than given a cached result).
+
+        """
+        self._frame_index += 1
+        if track_ids is None:
+            if self.tracker is None:
+                self.tracker = IoUTracker(self.configs)
+            self.tracker.update(detections)
+            track_ids = self.tracker.track_ids
+
+        self.detections = detections
+        self.results = [None] * len(detections)
+        self.fresh = [False] * len(detections)
+        to_run = []
+        # detections are highest score first so those get the budget
+        for i in np.flatnonzero(self.needs_label(detections)):
+            cached = self._cache.get(int(track_ids[i]))
+            if cached is not None:
+                classified_at, self.results[i] = cached
+                if self._frame_index - classified_at < self.cache_frames:
+                    self._cache_hits.inc()
+                    continue
+            if self.budget is None or len(to_run) < self.budget:
+                to_run.append(i)
+            else:
+                self._over_budget.inc()
+
+        if to_run:
+            results = self.classifier.infer_on_crops(frame,
+                                                     detections.boxes[to_run])
+            for i, result in zip(to_run, results):
+                self.results[i] = result
+                self.fresh[i] = True
+                self._cache[int(track_ids[i])] = (self._frame_index, result)
+
+        current = set(track_ids.tolist())
+        self._cache = {track_id: cached
+                       for track_id, cached in self._cache.items()
+                       if track_id in current
+                       or self._frame_index - cached[0] < self.cache_frames}
+
+        return self.results
+
+    def labels(self):
+        """Return (label, score) of each detection's result (or None)
+
+        """
+        labels = []
+        for result in self.results:
+            if result:
+                labels.append(self.classifier.top_label_and_score(result))
+            else:
+                labels.append(None)
+        return labels
+
+    def print_report(self):
+        """Log the classifier label of each classified detection
+
+        """
+        for i, label in enumerate(self.labels()):
+            if label is not None:
+                log.info('Box %d (%s) classified as ***%s*** '
+                         'with score: %.2f',
+                         i,
+                         self.detections.class_name(i),
+                         *label)
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
-""" Dashboard for viewing images coming in over network from a scrubcam.
+""" Dashboard for viewing images coming in over network from scrubcams.
+
+Any number of scrubcams can connect at once (see scrubcam.hub).
 
 """
 import logging
 import argparse
-import time
 
 import cv2
 import numpy as np
@@ -14,7 +15,7 @@ from viztools.visualization import FlyingPicBox
 from viztools.visualization import init_pics, create_layout, GridDisplay
 from viztools.draw import labeled_box_on_image
 
-from scrubcam.networking import ServerSocketHandler, create_image_dict
+from scrubcam import hub as scrubhub
 
 parser = argparse.ArgumentParser()
 parser.add_argument('ip')
@@ -51,12 +52,8 @@ def main():
     display_pics = init_pics(layout)
     spot = 0
 
-    image = create_image_dict()
-    threads_stop = False
-
-    comms = ServerSocketHandler((IP, PORT), image, lambda: threads_stop)
-    comms.setDaemon(True)
-    comms.start()
+    hub = scrubhub.HubThread((IP, PORT))
+    hub.start()
 
     # viewer = Viewer(image, lambda: threads_stop)
     # viewer.setDaemon(True)
@@ -100,40 +97,46 @@ def main():
 
             key = display.draw(display_pics)
             if key == ord('q'):
-                threads_stop = True
                 break
 
-            if image['img'] is not None:
-                if image['lboxes'] is not None:
-
-                    for lbox in image['lboxes']:
-                        confidence = lbox['confidence']
-                        if confidence > CONF_THRESHOLD:
-                            box = lbox['box']
-                            label = '{} {:.2f}'
-                            label = label.format(lbox['class_name'],
-                                                 confidence)
-                            image['img'] = labeled_box_on_image(image['img'],
-                                                                box,
-                                                                label,
-                                                                font_size=2.0)
-
-                for lbox in image['lboxes']:
-                    if lbox['class_name'] in spots.keys():
+            # skip over events other than images without waiting
+            event = hub.get_event(timeout=0)
+            while event is not None and event.kind != scrubhub.IMAGE:
+                event = hub.get_event(timeout=0)
+            if event is not None:
+                img = event.image()
+                lboxes = list(event.detections)
+                top_label = None
+                for lbox in lboxes:
+                    if lbox.get('class_name') in spots.keys():
                         top_label = lbox['class_name']
                         break
-
-                image['img'] = cv2.putText(image['img'],
-                                           top_label,
-                                           (50, 90),
-                                           cv2.FONT_HERSHEY_SIMPLEX,
-                                           3,
-                                           (255, 255, 255),
-                                           4,
-                                           cv2.LINE_AA)
+                if img is None or top_label is None:
+                    continue
+
+                for lbox in lboxes:
+                    confidence = lbox['confidence']
+                    if confidence > CONF_THRESHOLD:
+                        box = lbox['box']
+                        label = '{} {:.2f}'
+                        label = label.format(lbox['class_name'],
+                                             confidence)
+                        img = labeled_box_on_image(img,
+                                                   box,
+                                                   label,
+                                                   font_size=2.0)
+
+                img = cv2.putText(img,
+                                  top_label,
+                                  (50, 90),
+                                  cv2.FONT_HERSHEY_SIMPLEX,
+                                  3,
+                                  (255, 255, 255),
+                                  4,
+                                  cv2.LINE_AA)
 
                 spot = spots[top_label]
-                resized_image = imutils.resize(image['img'], width=IMAGE_WIDTH)
+                resized_image = imutils.resize(img, width=IMAGE_WIDTH)
                 flypics.append(FlyingPicBox(resized_image,
                                             np.array([layout[spot][0], 0]),
                                             np.array(layout[spot])))
@@ -148,8 +151,6 @@ def main():
                 # spot = spots[label]
                 # display_pics[spot].append(resized_image)
 
-                image['img'] = None
-
                 # cv2.imshow(window,
                 #            image['img'])
                 # key = cv2.waitKey(30)
@@ -162,8 +163,7 @@ def main():
     except KeyboardInterrupt:
         log.warning('Keyboard interrupt.')
 
-    threads_stop = True
-    time.sleep(.1)
+    hub.close()
 
 
 if __name__ == "__main__":
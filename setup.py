@@ -41,7 +41,8 @@ setuptools.setup(
                'picamera',
                'rpi.gpio',
                'adafruit-circuitpython-ssd1306',
-               'adafruit-circuitpython-rfm9x']
+               'adafruit-circuitpython-rfm9x'],
+        'cpu': ['tflite-runtime']
     },
     classifiers=[
         "Programming Language :: Python :: 3",
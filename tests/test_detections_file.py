@@ -0,0 +1,91 @@
+"""Tests of writing and reading scrubcam.detections_file files
+
+"""
+import os
+from datetime import datetime
+
+import numpy as np
+
+from scrubcam import detections_file
+from scrubcam.detections import Detections
+from scrubcam.detections_file import DetectionsFile, read_detections_file
+
+CLASS_TABLE = np.array(['person', 'giraffe', 'zebra'], dtype=object)
+FRAMES = [('2023-05-01T10h00m00s.jpg', 1682935200.0,
+           [[10, 20, 30, 40]], [.9], [1]),
+          ('2023-05-01T10h00m01s.jpg', 1682935201.0,
+           [[0, 0, 640, 480], [5, 5, 10, 10]], [.5, .25], [2, 0]),
+          ('2023-05-01T10h00m02s.jpg', 1682935202.0,
+           [], [], [])]
+
+
+def write_frames(folder, frames=FRAMES):
+    writer = DetectionsFile(str(folder))
+    for image, timestamp, boxes, scores, class_ids in frames:
+        detections = Detections.from_arrays(np.reshape(boxes, (-1, 4)),
+                                            scores,
+                                            class_ids,
+                                            CLASS_TABLE)
+        writer.append(image, detections, timestamp)
+    writer.close()
+    return writer.filename_for(datetime.fromtimestamp(frames[0][1]))
+
+
+def check_frames(read, frames):
+    assert len(read) == len(frames)
+    for (image, timestamp, detections), expected in zip(read, frames):
+        assert (image, timestamp) == expected[:2]
+        np.testing.assert_array_equal(detections.boxes,
+                                      np.reshape(expected[2], (-1, 4)))
+        np.testing.assert_allclose(detections.scores, expected[3])
+        assert list(detections.class_names()) == [CLASS_TABLE[class_id]
+                                                  for class_id in expected[4]]
+
+
+def test_round_trip(tmp_path):
+    filename = write_frames(tmp_path)
+
+    check_frames(list(read_detections_file(filename)), FRAMES)
+
+
+def test_truncated_trailing_record_is_ignored(tmp_path):
+    filename = write_frames(tmp_path)
+    size = os.path.getsize(filename)
+    with open(filename, 'r+b') as f:
+        f.truncate(size - 3)
+
+    check_frames(list(read_detections_file(filename)), FRAMES[:-1])
+
+
+def test_truncated_trailing_record_is_cut_off_on_append(tmp_path):
+    filename = write_frames(tmp_path, FRAMES[:2])
+    with open(filename, 'r+b') as f:
+        f.truncate(os.path.getsize(filename) - 3)
+
+    writer = DetectionsFile(str(tmp_path))
+    writer.append(FRAMES[2][0],
+                  Detections.from_arrays(np.empty((0, 4)), [], [],
+                                         CLASS_TABLE),
+                  FRAMES[2][1])
+    writer.close()
+
+    check_frames(list(read_detections_file(filename)),
+                 [FRAMES[0], FRAMES[2]])
+
+
+def test_unknown_class_ids_named_by_id(tmp_path):
+    filename = str(tmp_path / f'detections{detections_file.EXTENSION}')
+    boxes = np.zeros(1, detections_file.BOX_DTYPE)
+    boxes['class_id'] = 4
+    payload = (detections_file.FRAME_HEADER.pack(1.0, 5, 1) + b'a.jpg'
+               + boxes.tobytes())
+    with open(filename, 'wb') as f:
+        f.write(detections_file.MAGIC
+                + detections_file.RECORD_HEADER.pack(detections_file.FRAME,
+                                                     len(payload))
+                + payload)
+
+    (image, _, detections), = read_detections_file(filename)
+
+    assert image == 'a.jpg'
+    assert list(detections.class_names()) == ['4']
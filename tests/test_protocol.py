@@ -0,0 +1,100 @@
+"""Tests of packing and unpacking scrubcam.protocol messages
+
+"""
+import io
+
+import numpy as np
+import pytest
+
+from scrubcam import protocol
+from scrubcam.detections import Detections
+
+CLASS_TABLE = np.array(['person', 'giraffe', 'zebra'], dtype=object)
+
+
+def make_detections():
+    return Detections.from_arrays([[10, 20, 30, 40], [0, 0, 640, 480]],
+                                  [.9, .25],
+                                  [1, 2],
+                                  CLASS_TABLE)
+
+
+def test_header_round_trip():
+    header = protocol.pack_header(protocol.IMAGE, 7, 12.5, 3, 4)
+
+    assert len(header) == protocol.HEADER.size
+    assert protocol.unpack_header(header) == (protocol.IMAGE, 7, 12.5, 3, 4)
+
+
+def test_header_sequence_wraps():
+    header = protocol.pack_header(protocol.HEARTBEAT, 2**32 + 5)
+
+    assert protocol.unpack_header(header)[1] == 5
+
+
+@pytest.mark.parametrize('header', [
+    b'NOPE' + protocol.pack_header(protocol.IMAGE, 0)[4:],
+    protocol.HEADER.pack(protocol.MAGIC, protocol.VERSION + 1,
+                         protocol.IMAGE, 0, 0, 0.0, 0, 0),
+    protocol.HEADER.pack(protocol.MAGIC, protocol.VERSION,
+                         99, 0, 0, 0.0, 0, 0),
+])
+def test_bad_header_raises(header):
+    with pytest.raises(ValueError):
+        protocol.unpack_header(header)
+
+
+def test_detections_round_trip():
+    detections = make_detections()
+
+    unpacked = protocol.unpack_detections(
+        protocol.pack_detections(detections), CLASS_TABLE)
+
+    np.testing.assert_array_equal(unpacked.boxes, detections.boxes)
+    np.testing.assert_allclose(unpacked.scores, detections.scores)
+    np.testing.assert_array_equal(unpacked.class_ids, detections.class_ids)
+    assert list(unpacked.class_names()) == ['giraffe', 'zebra']
+
+
+def test_class_table_round_trip():
+    packed = protocol.pack_class_table(CLASS_TABLE)
+
+    assert list(protocol.unpack_class_table(packed)) == list(CLASS_TABLE)
+    assert len(protocol.unpack_class_table(b'')) == 0
+
+
+def test_config_round_trip():
+    meta = protocol.pack_config('scrubcam1', True, ['giraffe'])
+
+    assert protocol.unpack_config(meta) == {'hostname': 'scrubcam1',
+                                            'continue_run': True,
+                                            'classes': ['giraffe']}
+
+
+def test_read_message():
+    meta = protocol.pack_detections(make_detections())
+    payload = b'\xff\xd8jpeg\xff\xd9'
+    stream = io.BytesIO(
+        protocol.pack_header(protocol.IMAGE, 3, 1.5, len(meta), len(payload))
+        + meta + payload
+        + protocol.pack_header(protocol.HEARTBEAT, 4, 2.0))
+
+    message = protocol.read_message(stream)
+    assert message.type == protocol.IMAGE
+    assert message.sequence == 3
+    assert message.timestamp == 1.5
+    assert message.meta == meta
+    assert message.payload == payload
+
+    message = protocol.read_message(stream)
+    assert message.type == protocol.HEARTBEAT
+    assert (message.meta, message.payload) == (b'', b'')
+
+    assert protocol.read_message(stream) is None
+
+
+def test_read_message_cut_short():
+    payload = b'0123456789'
+    data = protocol.pack_header(protocol.IMAGE, 0, 0.0, 0, len(payload))
+
+    assert protocol.read_message(io.BytesIO(data + payload[:5])) is None
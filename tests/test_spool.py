@@ -0,0 +1,90 @@
+"""Tests of recovering a scrubcam.spool.Spool left by an earlier run
+
+"""
+import glob
+import os
+
+import numpy as np
+
+from scrubcam.detections import Detections
+from scrubcam.spool import Spool, BEST, EXTENSION
+
+CLASS_TABLE = np.array(['person', 'giraffe', 'zebra'], dtype=object)
+
+
+def make_detections(score):
+    return Detections.from_arrays([[1, 2, 3, 4]], [score], [1], CLASS_TABLE)
+
+
+def fill(folder, scores, **kwargs):
+    spool = Spool(str(folder), 10**6, **kwargs)
+    for i, score in enumerate(scores):
+        spool.put(f'jpeg{i}'.encode(), make_detections(score), float(i))
+    spool.close()
+
+
+def drain(spool):
+    items = []
+    while True:
+        item = spool.get()
+        if item is None:
+            return items
+        items.append(item)
+
+
+def test_recovers_spooled_records(tmp_path):
+    fill(tmp_path, [.5, .9, .7])
+
+    spool = Spool(str(tmp_path), 10**6)
+    assert len(spool) == 3
+    items = drain(spool)
+
+    assert [jpeg for jpeg, _, _ in items] == [b'jpeg0', b'jpeg1', b'jpeg2']
+    assert [timestamp for _, _, timestamp in items] == [0.0, 1.0, 2.0]
+    jpeg, detections, _ = items[1]
+    np.testing.assert_array_equal(detections.boxes, [[1, 2, 3, 4]])
+    np.testing.assert_allclose(detections.scores, [.9])
+    assert list(detections.class_names()) == ['giraffe']
+    assert glob.glob(os.path.join(tmp_path, f'*{EXTENSION}')) == []
+
+
+def test_recovers_in_best_first_order(tmp_path):
+    fill(tmp_path, [.5, .9, .7])
+
+    items = drain(Spool(str(tmp_path), 10**6, order=BEST))
+
+    assert [jpeg for jpeg, _, _ in items] == [b'jpeg1', b'jpeg2', b'jpeg0']
+
+
+def test_cuts_off_partly_written_record(tmp_path):
+    fill(tmp_path, [.5, .9])
+    segment, = glob.glob(os.path.join(tmp_path, f'*{EXTENSION}'))
+    size = os.path.getsize(segment)
+    with open(segment, 'r+b') as f:
+        f.truncate(size - 2)
+
+    spool = Spool(str(tmp_path), 10**6)
+
+    assert len(spool) == 1
+    assert [jpeg for jpeg, _, _ in drain(spool)] == [b'jpeg0']
+
+
+def test_taken_records_of_unfinished_segment_come_back(tmp_path):
+    fill(tmp_path, [.5, .9])
+    spool = Spool(str(tmp_path), 10**6)
+    assert spool.get()[0] == b'jpeg0'
+    spool.close()
+
+    spool = Spool(str(tmp_path), 10**6)
+
+    assert [jpeg for jpeg, _, _ in drain(spool)] == [b'jpeg0', b'jpeg1']
+
+
+def test_new_records_go_to_new_segment(tmp_path):
+    fill(tmp_path, [.5])
+
+    spool = Spool(str(tmp_path), 10**6)
+    spool.put(b'new', make_detections(.1), 5.0)
+
+    assert len(glob.glob(os.path.join(tmp_path, f'*{EXTENSION}'))) == 2
+    assert [jpeg for jpeg, _, _ in drain(spool)] == [b'jpeg0', b'new']
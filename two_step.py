@@ -1,14 +1,15 @@
 """Runs detector on frame, then classifier on detected boxes
 
+Which boxes get classified is decided by the classifier cascade (see
+CASCADE_* in the config), by default every box in FILTER_CLASSES.
+
 """
 import logging
-import io
 import argparse
 import yaml
 
-import picamera
-
 from scrubcam import vision
+from scrubcam.capture import create_capture_source
 
 logging.basicConfig(level='INFO',
                     format='[%(levelname)s] %(message)s (%(name)s)')
@@ -28,30 +29,32 @@ FILTER_CLASSES = configs['FILTER_CLASSES']
 
 detector = vision.ObjectDetectionSystem(configs)
 classifier = vision.ImageClassificationSystem(configs)
-
-stream = io.BytesIO()
-
-camera = picamera.PiCamera()
-camera.rotation = configs['CAMERA_ROTATION']
-if configs['PREVIEW_ON']:
-    camera.start_preview()
-
-for _ in camera.capture_continuous(stream, format='jpeg'):
-    stream.truncate()
-    stream.seek(0)
-
-    log.info('Running detector.')
-    detector.infer(stream)
-    detector.print_report(5)
-    for box in detector.labeled_boxes:
-        if detector.class_of_box(box) in FILTER_CLASSES:
-            x, y, w, h = box['box']
-
-            cropped_frame = detector.frame[y:y+h, x:x+w]
-            label = box['class_name']
-            log.info(f'Running classifier on filtered box with label {label}')
-            classifier.infer_on_frame(cropped_frame)
-            classifier.print_report()
+cascade = vision.ClassifierCascade(configs, classifier)
+
+source = create_capture_source(configs)
+if source.camera is not None and configs['PREVIEW_ON']:
+    source.camera.start_preview()
+
+try:
+    for packet in source.frames():
+        log.info('Running detector.')
+        detector.infer_on_packet(packet)
+        detector.print_report(5)
+        results = cascade.classify(detector.labeled_boxes, detector.frame)
+        for box, result, fresh in zip(detector.labeled_boxes,
+                                      results,
+                                      cascade.fresh):
+            # cached results were already reported (and saved)
+            if result is None or not fresh:
+                continue
+            log.info("Classifier result for box with label "
+                     f"{box['class_name']}")
+            classifier.print_report(result)
 
             if RECORD:
-                classifier.save_image_of_anything_but('background')
+                classifier.save_image_of_anything_but('background', result)
+finally:
+    # finish writing recorded images
+    detector.close()
+    classifier.close()
+    source.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Compare frame rate of JPEG and raw capture paths into the detector
+
+Captures a fixed number of frames from the picamera through each of
+the two paths the main ScrubCam loop can use and runs object detection
+on every one of them:
+
+- jpeg: capture as JPEG then decode (InferenceSystem.infer)
+- raw: capture unencoded into a preallocated buffer
+  (InferenceSystem.infer_on_buffer)
+
+Prints the frames per second achieved by each path.
+
+"""
+import logging
+import io
+import time
+import argparse
+
+import yaml
+import picamera
+
+from scrubcam.vision import ObjectDetectionSystem
+from scrubcam.capture import RawFrameBuffer, RAW_FORMATS
+
+logging.basicConfig(level='INFO',
+                    format='[%(levelname)s] %(message)s (%(name)s)')
+log = logging.getLogger('main')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('config',
+                    help='Filename of configuration file')
+parser.add_argument('-n',
+                    '--num_frames',
+                    type=int,
+                    default=100,
+                    help='Number of frames to capture for each path')
+parser.add_argument('-r',
+                    '--raw_format',
+                    default='bgr',
+                    choices=RAW_FORMATS,
+                    help='Format to use for the raw capture path')
+parser.add_argument('--no_inference',
+                    action='store_true',
+                    help='Only capture (and decode) frames, skip detector')
+args = parser.parse_args()
+
+with open(args.config, encoding='utf-8') as f:
+    configs = yaml.load(f, Loader=yaml.SafeLoader)
+
+
+def run_jpeg_path(camera, detector):
+    """Capture and infer on JPEG frames, return frames per second
+
+    """
+    stream = io.BytesIO()
+    count = 0
+    start = time.perf_counter()
+    for _ in camera.capture_continuous(stream, format='jpeg'):
+        if args.no_inference:
+            detector.decode(stream)
+        else:
+            detector.infer(stream)
+        stream.seek(0)
+        stream.truncate()
+        count += 1
+        if count >= args.num_frames:
+            break
+
+    return count / (time.perf_counter() - start)
+
+
+def run_raw_path(camera, detector):
+    """Capture and infer on raw frames, return frames per second
+
+    """
+    raw = RawFrameBuffer(camera.resolution, args.raw_format)
+    count = 0
+    start = time.perf_counter()
+    for _ in camera.capture_continuous(raw.buffer, format=args.raw_format):
+        frame = raw.frame()
+        if not args.no_inference:
+            detector.infer_on_buffer(frame)
+        count += 1
+        if count >= args.num_frames:
+            break
+
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    detector = ObjectDetectionSystem(configs)
+
+    with picamera.PiCamera() as camera:
+        camera.rotation = configs['CAMERA_ROTATION']
+        camera.resolution = configs['CAMERA_RESOLUTION']
+        time.sleep(2)  # let camera settle exposure
+
+        jpeg_fps = run_jpeg_path(camera, detector)
+        raw_fps = run_raw_path(camera, detector)
+
+    print(f'Frames per path: {args.num_frames}')
+    print(f'jpeg path: {jpeg_fps:.2f} fps')
+    print(f'raw ({args.raw_format}) path: {raw_fps:.2f} fps')
+    print(f'speedup: {raw_fps / jpeg_fps:.2f}x')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""Benchmark each stage of the detection loop
+
+Drives the pieces a frame passes through in the main ScrubCam loop,
+one stage at a time, from recorded frames (a folder of JPEGs or a
+video file) or synthetic ones:
+
+- decode: JPEG decode (InferenceSystem.decode_jpeg)
+- infer: decode plus detection (InferenceSystem.infer)
+- detect: detection on decoded frame (ObjectDetectionSystem.infer_on_frame)
+- filter: score and FILTER_CLASSES filtering of the detections
+- record: InferenceSystem.save_current_frame (written synchronously)
+- boxes: InferenceSystem._write_boxes_file
+- send: ClientSocketHandler.send_image_and_boxes to a loopback hub
+
+Reports p50/p95/p99 latency and throughput per stage and can write the
+results as JSON (with the git commit they were taken at) and compare
+against a previous such file. With INFERENCE_BACKEND set to mock in
+the config this runs on any machine.
+
+"""
+import io
+import os
+import json
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+from threading import Thread
+
+import yaml
+import numpy as np
+import cv2
+
+from scrubcam.vision import ObjectDetectionSystem
+from scrubcam.networking import ClientSocketHandler
+from scrubcam.capture import ReplaySource, encode_jpeg
+
+parser = argparse.ArgumentParser()
+parser.add_argument('config',
+                    help='Filename of configuration file')
+parser.add_argument('-f',
+                    '--frames',
+                    help='Folder of JPEGs or video file to take frames from '
+                    '(synthetic frames at CAMERA_RESOLUTION if not given)')
+parser.add_argument('-n',
+                    '--num_frames',
+                    type=int,
+                    default=50,
+                    help='Number of frames to run through each stage')
+parser.add_argument('-r',
+                    '--record_folder',
+                    help='Folder to benchmark writes to (temporary folder '
+                    'if not given)')
+parser.add_argument('-o',
+                    '--output',
+                    help='Write results to this JSON file')
+parser.add_argument('-c',
+                    '--compare',
+                    help='JSON file of earlier results to compare against')
+args = parser.parse_args()
+
+with open(args.config, encoding='utf-8') as f:
+    configs = yaml.load(f, Loader=yaml.SafeLoader)
+
+
+class LoopbackHub(Thread):
+    """Stand-in for ScrubHub that accepts a connection and discards data
+
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen()
+        self.address = self.sock.getsockname()
+        self.bytes_received = 0
+
+    def run(self):
+        connection, _ = self.sock.accept()
+        while True:
+            data = connection.recv(1 << 16)
+            if not data:
+                break
+            self.bytes_received += len(data)
+        connection.close()
+        self.sock.close()
+
+
+def load_jpegs():
+    """Return list of JPEG frames to benchmark with
+
+    """
+    if args.frames is None:
+        width, height = configs['CAMERA_RESOLUTION']
+        rng = np.random.default_rng(0)
+        frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        frame = cv2.GaussianBlur(frame, (31, 31), 0)
+        return [encode_jpeg(frame)] * args.num_frames
+
+    jpegs = []
+    for packet in ReplaySource(args.frames, loop=True).frames():
+        if packet['jpeg'] is None:
+            packet['jpeg'] = encode_jpeg(packet['frame'])
+        jpegs.append(packet['jpeg'])
+        if len(jpegs) >= args.num_frames:
+            break
+    return jpegs
+
+
+def time_stage(function, items):
+    """Return list of seconds function took on each item
+
+    """
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def summarize(latencies):
+    """Return dict of latency percentiles (ms) and throughput
+
+    """
+    latencies_ms = 1000 * np.asarray(latencies)
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {'count': len(latencies),
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'mean_ms': float(latencies_ms.mean()),
+            'per_sec': float(len(latencies) / (latencies_ms.sum() / 1000))}
+
+
+def git_commit():
+    """Return current git commit of the repo (or None)
+
+    """
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(__file__),
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('utf-8').strip()
+
+
+def run(record_folder):
+    configs['RECORD_FOLDER'] = record_folder
+    configs['RECORD_WRITER_WORKERS'] = 0  # time the actual writes
+    detector = ObjectDetectionSystem(configs)
+    jpegs = load_jpegs()
+    streams = [io.BytesIO(jpeg) for jpeg in jpegs]
+
+    frames = []
+    detections = []
+    for jpeg in jpegs:
+        detector.decode_jpeg(jpeg)
+        frames.append(detector.frame)
+        detector.infer_on_frame(detector.frame)
+        detections.append(detector.labeled_boxes)
+
+    def filter_detections(lboxes):
+        lboxes.filter_score(configs['RECORD_CONF_THRESHOLD'])
+        lboxes.filter_classes(configs['FILTER_CLASSES'])
+
+    def record(i):
+        detector.save_current_frame('benchmark',
+                                    lboxes=detections[i],
+                                    frame=frames[i],
+                                    jpeg=jpegs[i])
+
+    def write_boxes(i):
+        detector._write_boxes_file(f'benchmark_{i}', detections[i])
+
+    hub = LoopbackHub()
+    hub.start()
+    configs['REMOTE_SERVER_IP'], configs['REMOTE_SERVER_PORT'] = hub.address
+    socket_handler = ClientSocketHandler(configs)
+
+    def send(i):
+        socket_handler.send_image_and_boxes(streams[i], detections[i])
+
+    indices = range(len(jpegs))
+    results = {
+        'decode': summarize(time_stage(detector.decode_jpeg, jpegs)),
+        'infer': summarize(time_stage(detector.infer, streams)),
+        'detect': summarize(time_stage(detector.infer_on_frame, frames)),
+        'filter': summarize(time_stage(filter_detections, detections)),
+        'record': summarize(time_stage(record, indices)),
+        'boxes': summarize(time_stage(write_boxes, indices)),
+        'send': summarize(time_stage(send, indices)),
+    }
+
+    socket_handler.close()
+    hub.join(5)
+    detector.close()
+
+    return results
+
+
+def print_results(results, previous=None):
+    header = (f'{"stage":<8} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} '
+              f'{"per sec":>9}')
+    if previous is not None:
+        header += f' {"p50 vs prev":>12}'
+    print(header)
+    for stage, stats in results.items():
+        line = (f'{stage:<8} {stats["p50_ms"]:>9.2f} {stats["p95_ms"]:>9.2f} '
+                f'{stats["p99_ms"]:>9.2f} {stats["per_sec"]:>9.1f}')
+        if previous is not None and stage in previous:
+            change = stats['p50_ms'] / previous[stage]['p50_ms'] - 1
+            line += f' {100 * change:>+11.1f}%'
+        print(line)
+
+
+def main():
+    if args.record_folder is not None:
+        results = run(args.record_folder)
+    else:
+        with tempfile.TemporaryDirectory() as record_folder:
+            results = run(record_folder)
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)['stages']
+    print_results(results, previous)
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'commit': git_commit(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'config': os.path.basename(args.config),
+                       'frames': args.frames or 'synthetic',
+                       'stages': results},
+                      f,
+                      indent=2)
+
+
+if __name__ == "__main__":
+    main()
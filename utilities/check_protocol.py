@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Check ClientSocketHandler and ServerSocketHandler agree on the wire
+
+Runs a ServerSocketHandler on a loopback port, connects a
+ClientSocketHandler to it, sends every kind of message the camera
+sends and checks the server received what was sent. Then times
+serializing and sending a burst of images with boxes and reports
+bytes and microseconds per message.
+
+Example:
+
+./check_protocol.py -n 1000
+
+"""
+import io
+import sys
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+from scrubcam import protocol
+from scrubcam.detections import Detections
+from scrubcam.networking import (ClientSocketHandler, ServerSocketHandler,
+                                 create_image_dict, BYTES_SENT)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n',
+                    '--num_messages',
+                    type=int,
+                    default=500,
+                    help='Images with boxes sent in the timed burst')
+parser.add_argument('-b',
+                    '--boxes',
+                    type=int,
+                    default=5,
+                    help='Boxes per image in the timed burst')
+args = parser.parse_args()
+
+CLASS_TABLE = np.array(['person', 'giraffe', 'zebra'], dtype=object)
+TIMEOUT = 5
+
+
+def wait_for(server, count):
+    """Wait until server has received count messages
+
+    """
+    deadline = time.time() + TIMEOUT
+    while server.messages_received < count:
+        if time.time() > deadline:
+            raise RuntimeError(f'Server received {server.messages_received}'
+                               f' of {count} messages')
+        time.sleep(.01)
+
+
+def check(name, ok):
+    print(f'{"ok" if ok else "FAIL":4} {name}')
+    return ok
+
+
+def make_detections(num_boxes):
+    rng = np.random.default_rng(0)
+    return Detections.from_arrays(rng.integers(0, 1000, (num_boxes, 4)),
+                                  rng.random(num_boxes),
+                                  rng.integers(0, len(CLASS_TABLE),
+                                               num_boxes),
+                                  CLASS_TABLE)
+
+
+def main():
+    image = create_image_dict()
+    stop = False
+    server = ServerSocketHandler(('127.0.0.1', 0), image, lambda: stop)
+    server.daemon = True
+    server.start()
+
+    configs = {'REMOTE_SERVER_IP': server.address[0],
+               'REMOTE_SERVER_PORT': server.address[1]}
+    client = ClientSocketHandler(configs)
+
+    frame = np.zeros((120, 160, 3), np.uint8)
+    cv2.rectangle(frame, (40, 30), (120, 90), (255, 255, 255), -1)
+    jpeg = cv2.imencode('.jpeg', frame)[1].tobytes()
+
+    results = []
+    results.append(check('command', client.recv_command() == server.command))
+
+    client.send_host_configs(['giraffe', 'zebra'], True)
+    wait_for(server, 1)
+    results.append(check('config',
+                         server.config is not None
+                         and server.config['classes'] == ['giraffe', 'zebra']
+                         and server.config['continue_run'] is True))
+
+    client.send_heartbeat_every_15s()
+    wait_for(server, 2)
+    results.append(check('heartbeat',
+                         server.last_heartbeat == client.LAST_ALERT_TIME))
+
+    client.send_no_image()
+    wait_for(server, 3)
+    results.append(check('no image', server.messages_received == 3))
+
+    detections = make_detections(3)
+    client.send_image_and_boxes(io.BytesIO(jpeg), detections, 1234.5)
+    # class table then image
+    wait_for(server, 5)
+    received = image['lboxes']
+    results.append(check('image and boxes',
+                         image['img'] is not None
+                         and image['img'].shape == frame.shape
+                         and image['timestamp'] == 1234.5
+                         and received == detections.to_lboxes()))
+
+    lboxes = [{'class_name': 'person', 'confidence': 1.0,
+               'box': (0, 0, 10, 10)}]
+    client.send_image_and_boxes(io.BytesIO(jpeg), lboxes)
+    wait_for(server, 7)
+    results.append(check('image and lbox dicts',
+                         image['lboxes'] is not None
+                         and image['lboxes'][0]['class_name'] == 'person'
+                         and image['lboxes'][0]['box'] == [0, 0, 10, 10]))
+
+    client.send_image(io.BytesIO(jpeg))
+    wait_for(server, 8)
+    results.append(check('image without boxes', image['lboxes'] is None))
+
+    detections = make_detections(args.boxes)
+    received_before = server.messages_received
+    bytes_before = BYTES_SENT.value
+    start = time.perf_counter()
+    for _ in range(args.num_messages):
+        client.send_image_and_boxes(io.BytesIO(jpeg), detections)
+    elapsed = time.perf_counter() - start
+    # a class table goes first as the last image's table differs
+    wait_for(server, received_before + args.num_messages + 1)
+    results.append(check('burst',
+                         image['lboxes'] == detections.to_lboxes()))
+
+    per_message = (BYTES_SENT.value - bytes_before) / args.num_messages
+    overhead = per_message - len(jpeg)
+    print(f'{args.num_messages} images with {args.boxes} boxes: '
+          f'{1e6 * elapsed / args.num_messages:.1f} us and '
+          f'{overhead:.0f} bytes (header and boxes) per message '
+          f'besides the {len(jpeg)} byte JPEG')
+    print(f'header is {protocol.HEADER.size} bytes, each box '
+          f'{protocol.DETECTION_RECORD.itemsize} bytes')
+
+    client.close()
+    stop = True
+    return all(results)
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -35,12 +35,16 @@ camera.rotation = configs['CAMERA_ROTATION']
 if configs['PREVIEW_ON']:
     camera.start_preview()
 
-for _ in camera.capture_continuous(stream, format='jpeg'):
-    stream.truncate()
-    stream.seek(0)
-
-    classifier.infer(stream)
-    classifier.print_report()
-
-    if RECORD:
-        classifier.save_image_of_anything_but('background')
+try:
+    for _ in camera.capture_continuous(stream, format='jpeg'):
+        stream.truncate()
+        stream.seek(0)
+
+        classifier.infer(stream)
+        classifier.print_report()
+
+        if RECORD:
+            classifier.save_image_of_anything_but('background')
+finally:
+    # finish writing recorded images
+    classifier.close()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""Write out per-frame boxes CSVs from ScrubCam detections files
+
+Recordings keep their boxes in append-only detections files (see
+scrubcam.detections_file) rather than a CSV per image. This writes the
+per-image CSVs older tools expect, by default next to the images in
+the record folder.
+
+Example, CSVs for every detections file in a record folder:
+
+./export_boxes_csvs.py RECORD_FOLDER
+
+"""
+import os
+import argparse
+
+from scrubcam.detections_file import export_boxes_csvs, find_detections_files
+
+parser = argparse.ArgumentParser()
+parser.add_argument('path',
+                    help='Record folder or a single detections file')
+parser.add_argument('-o',
+                    '--output',
+                    help='Folder to write CSVs to (default record folder)')
+args = parser.parse_args()
+
+
+def main():
+    if os.path.isdir(args.path):
+        filenames = find_detections_files(args.path)
+        folder = args.path
+    else:
+        filenames = [args.path]
+        folder = os.path.dirname(args.path)
+    if args.output:
+        folder = args.output
+        os.makedirs(folder, exist_ok=True)
+
+    for filename in filenames:
+        count = export_boxes_csvs(filename, folder)
+        print(f'{filename}: wrote {count} CSVs to {folder}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""Load test the asyncio hub with a simulated fleet of ScrubCams
+
+Starts a HubServer (or, given --address, uses a hub that is already
+running) and connects a fleet of simulated cameras to it, each of which
+sends its config and then images with boxes at a fixed rate plus a
+heartbeat every so often, as a ScrubCam does. Reports the messages per
+second the hub sustained and, for the in-process hub, how long
+messages took to reach the event consumer.
+
+Example, 200 cameras each sending 5 images a second for 30 seconds:
+
+./load_test_hub.py -c 200 -r 5 -d 30
+
+"""
+import time
+import asyncio
+import logging
+import argparse
+
+import cv2
+import numpy as np
+
+from scrubcam import hub as scrubhub
+from scrubcam import protocol
+from scrubcam.detections import Detections
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-c',
+                    '--cameras',
+                    type=int,
+                    default=100,
+                    help='Number of simulated cameras')
+parser.add_argument('-r',
+                    '--rate',
+                    type=float,
+                    default=2.0,
+                    help='Images per second sent by each camera')
+parser.add_argument('-d',
+                    '--duration',
+                    type=float,
+                    default=20.0,
+                    help='Seconds to run the test for')
+parser.add_argument('-b',
+                    '--heartbeat',
+                    type=float,
+                    default=15.0,
+                    help='Seconds between heartbeats of each camera')
+parser.add_argument('-s',
+                    '--image_size',
+                    type=int,
+                    nargs=2,
+                    default=[640, 480],
+                    help='Width and height of the JPEGs sent')
+parser.add_argument('-a',
+                    '--address',
+                    nargs=2,
+                    help='Host and port of a running hub to test instead')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.WARNING,
+                    format='[%(levelname)s] %(message)s (%(name)s)')
+
+CLASS_TABLE = np.array(['person', 'giraffe', 'zebra'], dtype=object)
+
+
+def make_jpeg(width, height):
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, (height // 8, width // 8, 3), np.uint8)
+    frame = cv2.resize(frame, (width, height))
+    return cv2.imencode('.jpeg', frame)[1].tobytes()
+
+
+def message(msg_type, sequence, meta=b'', payload=b'', timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
+    return (protocol.pack_header(msg_type, sequence, timestamp,
+                                 len(meta), len(payload))
+            + meta + payload)
+
+
+async def simulate_camera(number, address, jpeg, meta, stop_time, counts):
+    """Connect to hub and send images until stop_time
+
+    """
+    reader, writer = await asyncio.open_connection(*address)
+    header = await reader.readexactly(protocol.HEADER.size)
+    _, _, _, meta_length, _ = protocol.unpack_header(header)
+    await reader.readexactly(meta_length)
+
+    config = protocol.pack_config(f'simcam{number:04d}', True, ['giraffe'])
+    class_table = protocol.pack_class_table(CLASS_TABLE)
+    writer.write(message(protocol.CONFIG, 0, config))
+    writer.write(message(protocol.CLASS_TABLE, 1, class_table))
+    sequence = 2
+
+    # spread cameras' sends out over the interval between them
+    interval = 1 / args.rate
+    next_send = time.time() + interval * number / args.cameras
+    next_heartbeat = next_send
+    while True:
+        now = time.time()
+        if now >= stop_time:
+            break
+        if now >= next_heartbeat:
+            writer.write(message(protocol.HEARTBEAT, sequence))
+            sequence += 1
+            counts['sent'] += 1
+            next_heartbeat += args.heartbeat
+        writer.write(message(protocol.IMAGE, sequence, meta, jpeg))
+        sequence += 1
+        counts['sent'] += 1
+        await writer.drain()
+        next_send += interval
+        await asyncio.sleep(max(0, next_send - time.time()))
+
+    writer.close()
+    await writer.wait_closed()
+
+
+async def consume(hub, counts, latencies):
+    while True:
+        event = await hub.next_event()
+        if event.kind in (scrubhub.IMAGE, scrubhub.HEARTBEAT):
+            counts['received'] += 1
+            latencies.append(event.received_time - event.timestamp)
+
+
+async def main():
+    hub = None
+    if args.address is None:
+        hub = scrubhub.HubServer(('127.0.0.1', 0),
+                                 event_queue_size=100000)
+        await hub.start()
+        address = hub.address
+    else:
+        address = (args.address[0], int(args.address[1]))
+
+    jpeg = make_jpeg(*args.image_size)
+    rng = np.random.default_rng(0)
+    detections = Detections.from_arrays(rng.integers(0, 1000, (3, 4)),
+                                        rng.random(3),
+                                        [1, 1, 2],
+                                        CLASS_TABLE)
+    meta = protocol.pack_detections(detections)
+
+    counts = {'sent': 0, 'received': 0}
+    latencies = []
+    consumer = None
+    if hub is not None:
+        consumer = asyncio.ensure_future(consume(hub, counts, latencies))
+
+    print(f'{args.cameras} cameras sending {args.rate} images/s each of '
+          f'{len(jpeg)} bytes to {address[0]}:{address[1]} '
+          f'for {args.duration} s')
+    start = time.time()
+    stop_time = start + args.duration
+    cameras = [simulate_camera(number, address, jpeg, meta,
+                               stop_time, counts)
+               for number in range(args.cameras)]
+    results = await asyncio.gather(*cameras, return_exceptions=True)
+    elapsed = time.time() - start
+    failed = [result for result in results if isinstance(result, Exception)]
+    if failed:
+        print(f'{len(failed)} cameras failed, first with: {failed[0]!r}')
+
+    print(f'sent {counts["sent"]} messages, '
+          f'{counts["sent"] / elapsed:.0f} messages/s')
+    if hub is not None:
+        # let the consumer catch up on what is in flight
+        await asyncio.sleep(.5)
+        consumer.cancel()
+        print(f'hub received {hub.messages_received} messages '
+              f'({hub.messages_received / elapsed:.0f} messages/s), '
+              f'consumer got {counts["received"]} events, '
+              f'{hub.events_dropped} dropped')
+        if latencies:
+            latencies = np.array(latencies) * 1000
+            print(f'camera to consumer latency: '
+                  f'{np.median(latencies):.1f} ms median, '
+                  f'{np.percentile(latencies, 99):.1f} ms 99th percentile')
+        await hub.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -15,8 +15,6 @@ import io
 import argparse
 import yaml
 
-from datetime import datetime
-
 from dencam import logs
 from dencam.buttons import ButtonHandler
 from dencam.gui import State, BaseController
@@ -24,6 +22,7 @@ from dencam.recorder import BaseRecorder
 
 from scrubcam.vision import ObjectDetectionSystem
 from scrubcam.display import Display
+from scrubcam.sightings import SightingsLog
 
 parser = argparse.ArgumentParser()
 parser.add_argument('config',
@@ -62,6 +61,7 @@ class Recorder(BaseRecorder):
         super().__init__(configs)
 
         self.vid_count = 0
+        self.sightings = SightingsLog(configs)
         self.start_recording()
 
     def start_recording(self):
@@ -74,18 +74,15 @@ class Recorder(BaseRecorder):
         self.recording = False
         log.info('Recording turned off.')
 
-    def update(self, lboxes):
+    def update(self, lboxes, image=None):
         self.vid_count += 1
-        with open('what_was_seen.log', 'a+') as f:
-            time_strg = '%Y-%m-%d %H:%M:%S'
-            tstamp = str(datetime.now().strftime(time_strg))
-            top_class = lboxes[0]['class_name']
-            f.write('{} | {}\n'.format(tstamp,
-                                       top_class))
+        self.sightings.log(lboxes, image=image)
 
 
 def main():
 
+    recorder = None
+    detector = None
     try:
         flags = {'stop_buttons_flag': False}
 
@@ -127,8 +124,10 @@ def main():
                         log.info('A box labeled w/ target class '
                                  + 'and over thresh detected.')
                         if (recorder.recording):
-                            detector.save_current_frame(None, lboxes=lboxes)
-                            recorder.update(lboxes)
+                            filename = detector.save_current_frame(
+                                None,
+                                lboxes=lboxes)
+                            recorder.update(lboxes, filename)
 
             # reset the stream for the next capture
             stream.seek(0)
@@ -139,6 +138,12 @@ def main():
     except Exception:
         log.exception('Exception in primary try block.')
         cleanup(flags)
+    finally:
+        if detector is not None:
+            # finish writing recorded images
+            detector.close()
+        if recorder is not None:
+            recorder.sightings.close()
 
 
 if __name__ == '__main__':
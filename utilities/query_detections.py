@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Query the detection index of a ScrubCam record folder
+
+Prints the detections matching the given filters as CSV (filename,
+time, class, confidence, left, top, width, height). The index is
+built from the folder's images and CSVs first if there isn't one yet
+or if --rebuild is given.
+
+Example, all zebras above 0.8 in a week:
+
+./query_detections.py RECORD_FOLDER -c zebra -m 0.8 \
+    -s 2023-06-01 -u 2023-06-08
+
+"""
+import os
+import csv
+import sys
+import argparse
+from datetime import datetime
+
+from scrubcam.detection_index import DetectionIndex, default_index_file
+
+parser = argparse.ArgumentParser()
+parser.add_argument('folder',
+                    help='Record folder of images and boxes CSVs')
+parser.add_argument('-i',
+                    '--index',
+                    help='Index database (default detections.db in folder)')
+parser.add_argument('-r',
+                    '--rebuild',
+                    action='store_true',
+                    help='Rebuild index from the folder before querying')
+parser.add_argument('-c',
+                    '--classes',
+                    nargs='+',
+                    help='Only detections of these classes')
+parser.add_argument('-s',
+                    '--since',
+                    type=datetime.fromisoformat,
+                    help='Only detections at or after this ISO date/time')
+parser.add_argument('-u',
+                    '--until',
+                    type=datetime.fromisoformat,
+                    help='Only detections before this ISO date/time')
+parser.add_argument('-m',
+                    '--min_conf',
+                    type=float,
+                    help='Only detections with at least this confidence')
+parser.add_argument('--max_conf',
+                    type=float,
+                    help='Only detections with at most this confidence')
+parser.add_argument('--min_area',
+                    type=int,
+                    help='Only boxes of at least this many pixels')
+parser.add_argument('--max_area',
+                    type=int,
+                    help='Only boxes of at most this many pixels')
+parser.add_argument('-n',
+                    '--limit',
+                    type=int,
+                    help='Print at most this many detections')
+args = parser.parse_args()
+
+
+def main():
+    index_file = args.index or default_index_file(args.folder)
+    exists = os.path.exists(index_file)
+    index = DetectionIndex(index_file)
+    if args.rebuild or not exists:
+        index.rebuild(args.folder)
+
+    detections = index.query(classes=args.classes,
+                             start=args.since,
+                             end=args.until,
+                             min_confidence=args.min_conf,
+                             max_confidence=args.max_conf,
+                             min_area=args.min_area,
+                             max_area=args.max_area,
+                             limit=args.limit)
+    index.close()
+
+    writer = csv.writer(sys.stdout)
+    for detection in detections:
+        time_strg = ''
+        if detection['timestamp'] is not None:
+            time_strg = datetime.fromtimestamp(
+                detection['timestamp']).isoformat()
+        writer.writerow([detection['filename'],
+                         time_strg,
+                         detection['class_name'],
+                         f"{detection['confidence']:.3f}",
+                         *detection['box']])
+
+
+if __name__ == '__main__':
+    main()
@@ -6,16 +6,29 @@ images from the associated run with boxes drawn upon them. Optionally
 assembles these images into a video (particularly useful if the
 original images began as an image sequence exported from a video).
 
+Images and boxes are looked up in the folder's detection index (see
+scrubcam.detection_index), which is built from the detections files or
+CSVs if the folder doesn't have one yet.
+
+Images are streamed: a pool of threads decodes them and draws their
+boxes a few images ahead of the viewer, and exported frames go
+straight to the video file, so memory use doesn't grow with the
+length of the run. With --headless nothing is displayed and images
+are processed as fast as all the cores allow.
+
 """
 import os
-import csv
+import time
 import argparse
-import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 
 from viztools import draw
 
+from scrubcam.detection_index import DetectionIndex, default_index_file
+
 parser = argparse.ArgumentParser()
 parser.add_argument('path')
 parser.add_argument('msecs_per_image')
@@ -28,73 +41,168 @@ parser.add_argument('-x',
 parser.add_argument('-f',
                     '--filtering_on',
                     action='store_true',
-                    help='Export a video.')
+                    help='Only show images with target labels.')
 parser.add_argument('-l',
                     '--show_labels',
                     action='store_true',
                     help='draw labels on boxes')
+parser.add_argument('-H',
+                    '--headless',
+                    action='store_true',
+                    help='Only export video, without displaying images.')
+parser.add_argument('-o',
+                    '--output',
+                    default='output.avi',
+                    help='Exported video file.')
+parser.add_argument('-w',
+                    '--workers',
+                    type=int,
+                    help='Decoding threads (default all cores).')
+parser.add_argument('-p',
+                    '--prefetch',
+                    type=int,
+                    help='Images decoded ahead (default 2 per worker).')
 args = parser.parse_args()
 path = args.path
 msecs_per_image = int(args.msecs_per_image)
-export_video = args.export
+export_video = args.export or args.headless
 fps = int(args.fps)
 conf_threshold = float(args.conf)
+workers = args.workers or os.cpu_count() or 1
+prefetch = args.prefetch or 2 * workers
 
 FILTER_LABELS = ['giraffe']
-if(args.filtering_on):
-    print('filtering on target labels is on')
-else:
-    print('filtering on target labels is off')
-
-img_paths = glob.glob(os.path.join(path, '*.jpeg'))
-img_paths = sorted(img_paths)
-
-images = []
-key = None
-for img_path in img_paths:
-
-    img = cv2.imread(img_path)
-    img_shape = img.shape[:2][::-1]
-
-    (filepath, filename) = os.path.split(img_path)
-    csvfile = os.path.splitext(filename)[0].split('_')[0] + '.csv'
-    csv_path = os.path.join(filepath, csvfile)
-    with open(csv_path) as f:
-        csv_reader = csv.reader(f, delimiter=',')
-
-        for row in csv_reader:
-            label = row[0]
-            score = float(row[1])
-            color = (100, 200, 100)
-            bbox = [int(item) for item in row[2:]]
-
-            caption = '{} {:.2f}'.format(label, score)
-
-            def meets_criteria(use_filter_labels):
-                if use_filter_labels:
-                    return score > conf_threshold and label in FILTER_LABELS
-                else:
-                    return score > conf_threshold
-
-            if (meets_criteria(args.filtering_on)):
-                if args.show_labels:
-                    draw.labeled_box_on_image(img, bbox, caption)
-                draw.box_on_image(img, bbox, color=color)
-
-                images.append(img)
+COLOR = (100, 200, 100)
+# seconds between progress reports in headless mode
+REPORT_INTERVAL = 5
+
+
+def find_matches():
+    """Return list of (filename, lboxes) of the images to review
+
+    """
+    index_file = default_index_file(path)
+    index_exists = os.path.exists(index_file)
+    index = DetectionIndex(index_file)
+    if not index_exists:
+        index.rebuild(path)
+
+    classes = FILTER_LABELS if args.filtering_on else None
+    matches = index.query_images(classes=classes,
+                                 min_confidence=conf_threshold)
+    index.close()
+
+    # boxes strictly over the confidence threshold, as before
+    selected = []
+    for filename, _, lboxes in matches:
+        lboxes = [lbox for lbox in lboxes
+                  if lbox['confidence'] > conf_threshold]
+        if lboxes:
+            selected.append((filename, lboxes))
+
+    return selected
+
+
+def load_and_draw(filename, lboxes):
+    """Return image read from filename with its lboxes drawn on it
+
+    """
+    img = cv2.imread(os.path.join(path, filename))
+    if img is None:
+        print(f'[WARNING] could not read {filename}')
+        return None
+
+    for lbox in lboxes:
+        caption = '{} {:.2f}'.format(lbox['class_name'], lbox['confidence'])
+        if args.show_labels:
+            draw.labeled_box_on_image(img, lbox['box'], caption)
+        draw.box_on_image(img, lbox['box'], color=COLOR)
+
+    return img
+
+
+def prefetched_images(matches, executor):
+    """Generate the drawn images in order, decoded prefetch ahead
+
+    """
+    pending = deque()
+    matches = iter(matches)
+    for filename, lboxes in matches:
+        pending.append(executor.submit(load_and_draw, filename, lboxes))
+        if len(pending) >= prefetch:
+            break
+
+    try:
+        while pending:
+            img = pending.popleft().result()
+            for filename, lboxes in matches:
+                pending.append(executor.submit(load_and_draw, filename,
+                                               lboxes))
+                break
+            if img is not None:
+                yield img
+    finally:
+        # stopped early (e.g. 'q'), so don't load what won't be shown
+        for future in pending:
+            future.cancel()
+
+
+def main():
+    if args.filtering_on:
+        print('filtering on target labels is on')
+    else:
+        print('filtering on target labels is off')
+
+    matches = find_matches()
+    print(f'[INFO] {len(matches)} images to review '
+          f'({workers} workers, {prefetch} prefetched).')
+
+    video = None
+    video_shape = None
+    count = 0
+    start = time.perf_counter()
+    last_report = start
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    images = prefetched_images(matches, executor)
+    try:
+        for img in images:
+            if export_video:
+                img_shape = img.shape[:2][::-1]
+                if video is None:
+                    print(f'[INFO] exporting video to {args.output}.')
+                    video_shape = img_shape
+                    video = cv2.VideoWriter(args.output, 0, fps, video_shape)
+                if img_shape != video_shape:
+                    # VideoWriter silently drops frames of other sizes
+                    img = cv2.resize(img, video_shape)
+                video.write(img)
+            count += 1
+
+            if args.headless:
+                now = time.perf_counter()
+                if now - last_report >= REPORT_INTERVAL:
+                    print(f'[INFO] {count}/{len(matches)} frames '
+                          f'({count / (now - start):.1f} fps)')
+                    last_report = now
+            else:
                 cv2.imshow('View', img)
                 key = cv2.waitKey(msecs_per_image)
-
-    if key == ord('q'):
-        break
-
-print('Number of frames processed: {}'.format(len(images)))
-
-cv2.destroyAllWindows()
-
-if export_video:
-    print('[INFO] exporting video.')
-    video = cv2.VideoWriter('output.avi', 0, fps, img_shape)
-
-    for image in images:
-        video.write(image)
+                if key == ord('q'):
+                    break
+    finally:
+        images.close()
+        executor.shutdown(wait=True)
+        if video is not None:
+            video.release()
+        if not args.headless:
+            cv2.destroyAllWindows()
+
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print('Number of frames processed: {}'.format(count))
+    print(f'[INFO] {count} frames in {elapsed:.1f} s ({rate:.1f} fps)')
+
+
+if __name__ == '__main__':
+    main()
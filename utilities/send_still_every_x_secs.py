@@ -41,14 +41,15 @@ def main():
     if configs['PREVIEW_ON']:
         camera.start_preview()
 
+    # the server sends its command once, on connection
+    command = socket_handler.recv_command()
+    if command is None:
+        return
+    logging.info('Command: {}'.format(command))
+
     try:
         for _ in camera.capture_continuous(stream, format='jpeg'):
 
-            command = socket_handler.recv_command()
-            if command is None:
-                break
-            logging.info('Command: {}'.format(command))
-
             time.sleep(DELAY_BETWEEN_SENDS)
 
             if command == 1: